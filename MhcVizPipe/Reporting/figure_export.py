@@ -0,0 +1,138 @@
+import argparse
+import concurrent.futures
+import json
+from pathlib import Path
+from typing import List, Union
+import plotly.graph_objects as go
+import plotly.io as pio
+
+EXPORT_MODES = ['now', 'defer', 'skip']
+DEFERRED_DIR = '.deferred'
+
+
+def _start_renderer():
+    """
+    Start the kaleido renderer of a worker process so it is reused for all the figures rendered by that worker.
+    """
+    try:
+        import kaleido
+        if hasattr(kaleido, 'start_sync_server'):  # kaleido >= 1.0 starts a browser per figure unless this is used
+            kaleido.start_sync_server(silence_warnings=True)
+    except ImportError:
+        pass
+
+
+def _render_figure(spec: dict) -> str:
+    pio.write_image(json.loads(spec['figure']), spec['path'], format=spec['format'],
+                    width=spec['width'], height=spec['height'])
+    return spec['path']
+
+
+def renderer_pool(n_workers: int = 1) -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Make a pool of worker processes for rendering figures, each with its own long-lived kaleido renderer. It can be
+    given to several FigureExporters (e.g. for a batch of analyses) so the renderers are only started once.
+    :param n_workers: The number of worker processes
+    :return: The pool. It must be shut down by the caller.
+    """
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max(1, n_workers), initializer=_start_renderer)
+
+
+def render_figures(specs: List[dict], n_workers: int = 1, executor: concurrent.futures.Executor = None) -> List[str]:
+    """
+    Render figure specifications (see FigureExporter.add) to files using a pool of worker processes, each with its
+    own long-lived kaleido renderer.
+    :param specs: The figure specifications
+    :param n_workers: The number of worker processes. Ignored if an executor is given.
+    :param executor: (optional) An existing executor to render the figures with.
+    :return: List of the files written
+    """
+    if not specs:
+        return []
+    if executor is not None:
+        return list(executor.map(_render_figure, specs))
+    with renderer_pool(min(n_workers, len(specs))) as executor:
+        return list(executor.map(_render_figure, specs))
+
+
+class FigureExporter:
+    """
+    Collects figures to be saved as static images (e.g. PDF) and exports them all at once. Depending on the mode,
+    figures are rendered in parallel when export() is called ('now'), saved as JSON so they can be rendered later
+    with export_deferred_figures ('defer'), or not saved at all ('skip').
+    """
+    def __init__(self, n_workers: int = 1, mode: str = 'now', executor: concurrent.futures.Executor = None):
+        if mode not in EXPORT_MODES:
+            raise ValueError(f'mode must be one of {EXPORT_MODES}')
+        self.n_workers = n_workers
+        self.mode = mode
+        self.executor = executor
+        self.specs = []
+
+    def add(self, fig: go.Figure, path: Union[str, Path], width: int = None, height: int = None):
+        """
+        Add a figure to be exported. The figure is serialized immediately, so later changes to it are not exported.
+        :param fig: The figure
+        :param path: The file to write. The format is taken from the extension.
+        :param width: (optional) Width of the image in pixels
+        :param height: (optional) Height of the image in pixels
+        :return: None
+        """
+        if self.mode == 'skip':
+            return
+        path = Path(path)
+        self.specs.append({'figure': pio.to_json(fig, validate=False),
+                           'path': str(path),
+                           'format': path.suffix.lstrip('.'),
+                           'width': width,
+                           'height': height})
+
+    def export(self) -> List[str]:
+        """
+        Export all the collected figures.
+        :return: List of the files written. If the export is deferred, these are the JSON files to render later.
+        """
+        specs, self.specs = self.specs, []
+        if self.mode == 'now':
+            return render_figures(specs, self.n_workers, self.executor)
+        elif self.mode == 'defer':
+            written = []
+            for spec in specs:
+                deferred_dir = Path(spec['path']).parent / DEFERRED_DIR
+                deferred_dir.mkdir(exist_ok=True)
+                fname = deferred_dir / f'{Path(spec["path"]).name}.json'
+                with open(fname, 'w') as f:
+                    json.dump(spec, f)
+                written.append(str(fname))
+            return written
+        return []
+
+
+def export_deferred_figures(figure_dir: Union[str, Path], n_workers: int = 1) -> List[str]:
+    """
+    Render figures which were deferred by a FigureExporter.
+    :param figure_dir: The figures directory of an analysis. It is searched recursively for deferred figures.
+    :param n_workers: The number of worker processes
+    :return: List of the files written
+    """
+    deferred = list(Path(figure_dir).rglob(f'{DEFERRED_DIR}/*.json'))
+    specs = []
+    for fname in deferred:
+        with open(fname, 'r') as f:
+            specs.append(json.load(f))
+    written = render_figures(specs, n_workers)
+    for fname in deferred:
+        fname.unlink()
+    for directory in {fname.parent for fname in deferred}:
+        directory.rmdir()
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the figures of an MhcVizPipe analysis which was run with '
+                                                 'deferred figure export.')
+    parser.add_argument('figure_dir', type=str, help='The figures directory of the analysis.')
+    parser.add_argument('-n', '--n_workers', type=int, default=1, help='The number of worker processes.')
+    args = parser.parse_args()
+    files = export_deferred_figures(args.figure_dir, args.n_workers)
+    print(f'Rendered {len(files)} figures')
@@ -4,6 +4,9 @@ from MhcVizPipe.Tools.cl_tools import MhcToolHelper
 import plotly.graph_objects as go
 import numpy as np
 from MhcVizPipe.Tools import plotly_venn
+from MhcVizPipe.Reporting.figure_export import FigureExporter
+from MhcVizPipe.Tools.artifacts import ArtifactStore
+from MhcVizPipe.Tools.instrumentation import StageProfiler, summarize_job_profiles
 import base64
 import pandas as pd
 from upsetplotly import UpSetPlotly
@@ -14,9 +17,11 @@ from dominate import document
 import PlotlyLogo.logo as pl
 from MhcVizPipe.parameters import ROOT_DIR
 import concurrent.futures
+import contextlib
 from MhcVizPipe.parameters import Parameters
 from MhcVizPipe import __version__
 from html import unescape
+from functools import wraps
 
 
 def wrap_plotly_fig(fig: go.Figure, width: str = '100%', height: str = '100%'):
@@ -46,6 +51,20 @@ def get_plotlyjs():
     return raw(plotlyjs)
 
 
+def profiled(stage: str):
+    """
+    Time a report method as a stage of the report with the profiler of the report (see StageProfiler).
+    :param stage: The name of the stage
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.profiler.stage(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class mhc_report:
     def __init__(self,
                  analysis_results: MhcToolHelper,
@@ -53,40 +72,56 @@ class mhc_report:
                  cpus: int,
                  experiment_description: str = None,
                  submitter_name: str = None,
-                 experimental_info=None
+                 experimental_info=None,
+                 figure_exporter: FigureExporter = None,
+                 profiler: StageProfiler = None,
+                 logo_executor: concurrent.futures.Executor = None
                  ):
         self.results = analysis_results
         self.mhc_class = mhc_class
         self.experiment_description = experiment_description
         self.submitter_name = submitter_name
         self.sample_alleles = analysis_results.sample_alleles
-        self.preds = analysis_results.binding_predictions.drop_duplicates()
-        self.samples = list(self.preds['Sample'].unique())
         self.experimental_info = experimental_info
         self.cpus = cpus
         self.parameters = Parameters()
+        # static figures are collected while building the report and exported all at once at the end
+        if figure_exporter is None:
+            figure_exporter = FigureExporter(n_workers=cpus, mode=self.parameters.FIGURE_EXPORT)
+        self.figure_exporter = figure_exporter
+        # sequence logos are made by a process pool, which is shared with other analyses if one is given
+        self.logo_executor = logo_executor
+        # timings of the report sections are only recorded if a profiler is given
+        self.profiler = profiler if profiler is not None else StageProfiler('off')
+
+        with self.profiler.stage('sample_summaries'):
+            # compute everything needed for each sample from its predictions once. If the predictions are in an index
+            # on disk, only the counts are kept and the rest is computed again when it is needed, so only one sample
+            # is in memory at a time.
+            self.samples = []
+            self._sample_cache = {}
+            self._last_summary = (None, None)
+            self.best_binding_counts = {}
+            peptide_numbers = {}
+            for sample, sample_preds in self.results.iter_sample_binding_predictions():
+                sample_preds = sample_preds.drop_duplicates()
+                if len(sample_preds) > 0:
+                    self.samples.append(sample)
+                summary = self._summarize_sample(sample_preds)
+                self.best_binding_counts[sample] = summary['best_binding_counts']
+                if self.results.prediction_index is None:
+                    self._sample_cache[sample] = summary
+
+                binder_counts = sample_preds.groupby(['Allele', 'Binder'], observed=True)['Peptide'].nunique()
+                peptide_numbers[sample] = {}
+                peptide_numbers[sample]['original_total'] = len(set(self.results.original_peptides[sample]))
+                peptide_numbers[sample]['within_length'] = len(set(self.results.sample_peptides[sample]))
+                for allele in self.sample_alleles[sample]:
+                    peptide_numbers[sample][allele] = {}
+                    for strength in ['Strong', 'Weak', 'Non-binder']:
+                        peptide_numbers[sample][allele][strength] = int(binder_counts.get((allele, strength), 0))
+            self.peptide_numbers = peptide_numbers
 
-        peptide_numbers = {}
-        for sample in self.results.samples:
-            peptide_numbers[sample] = {}
-            peptide_numbers[sample]['original_total'] = len(set(self.results.original_peptides[sample]))
-            peptide_numbers[sample]['within_length'] = len(set(self.results.sample_peptides[sample]))
-            for allele in self.sample_alleles[sample]:
-                peptide_numbers[sample][allele] = {}
-                for strength in ['Strong', 'Weak', 'Non-binder']:
-                    peptide_numbers[sample][allele][strength] = len(
-                        self.preds.loc[(self.preds['Sample'] == sample) &
-                                       (self.preds['Allele'] == allele) &
-                                       (self.preds['Binder'] == strength), 'Peptide'].unique()
-                    )
-        self.peptide_numbers = peptide_numbers
-
-        pep_binding_dict = {}
-        for sample in self.results.samples:
-            counts_df = self.preds.loc[self.preds['Sample'] == sample, :]
-            counts_df = counts_df.pivot(index='Peptide', columns='Allele', values='Binder')
-            pep_binding_dict[sample] = counts_df.copy(deep=True)
-        self.pep_binding_dict = pep_binding_dict
         self.fig_dir = self.results.tmp_folder / 'figures'
         if not self.fig_dir.exists():
             self.fig_dir.mkdir()
@@ -94,16 +129,82 @@ class mhc_report:
         self.metrics = {}
         self.calculate_metrics()
 
-    def calculate_metrics(self, write_file: bool = True):
-        # get counts of binders and non-binders
-        def get_highest_binding(predictions):
-            if 'Strong' in predictions.values:
-                return 'Strong'
-            elif 'Weak' in predictions.values:
-                return 'Weak'
+    def _logo_pool(self):
+        """
+        The process pool to make the sequence logos with: the shared logo executor if there is one (it is not shut
+        down on exit), or a new pool.
+        """
+        if self.logo_executor is not None:
+            return contextlib.nullcontext(self.logo_executor)
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.cpus)
+
+    def _submit_logos(self, executor: concurrent.futures.Executor, cores: list) -> list:
+        """
+        Make sequence logos from GibbsCluster cores files using the executor. Logos which are already in the artifact
+        store are not made again, and new logos are added to it.
+        :param executor: The executor
+        :param cores: List of cores files
+        :return: List of futures for the logos
+        """
+        store: ArtifactStore = self.results.artifact_store
+        futures = []
+        for core in cores:
+            if store is None:
+                futures.append(executor.submit(make_logo, core))
+                continue
+            key = ArtifactStore.logo_key(core)
+            logo = store.load_logo(key)
+            if logo is None:
+                future = executor.submit(make_logo, core)
+                future.add_done_callback(lambda f, key=key: store.save_logo(key, f.result())
+                                         if f.exception() is None else None)
             else:
-                return 'Non-binding'
-
+                future = concurrent.futures.Future()
+                future.set_result(logo)
+            futures.append(future)
+        return futures
+
+    def _sample_summary(self, sample: str) -> dict:
+        """
+        Get the summary of a sample (see _summarize_sample). If the predictions are in an index on disk, the summary
+        of the last sample used is kept.
+        """
+        if sample in self._sample_cache:
+            return self._sample_cache[sample]
+        if self._last_summary[0] != sample:
+            sample_preds = self.results.sample_binding_predictions(sample).drop_duplicates()
+            self._last_summary = (sample, self._summarize_sample(sample_preds))
+        return self._last_summary[1]
+
+    @property
+    def pep_binding_dict(self) -> dict:
+        """
+        The binding strength of each peptide of each sample to each allele, as a dictionary of {sample: DataFrame}.
+        """
+        return {sample: self._sample_summary(sample)['binders'] for sample in self.results.samples}
+
+    def _summarize_sample(self, sample_preds: pd.DataFrame) -> dict:
+        """
+        Pivot the predictions of one sample and derive the best binding strength of each peptide and the heatmap
+        matrix.
+        :param sample_preds: The binding predictions of the sample
+        :return: dictionary with the binder and rank pivots, the best binding of each peptide and the heatmap data
+        """
+        binders = sample_preds.pivot(index='Peptide', columns='Allele', values='Binder')
+        ranks = sample_preds.pivot(index='Peptide', columns='Allele', values='Rank').astype(float)
+        best_binding = pd.Series(np.where((binders == 'Strong').any(axis=1), 'Strong',
+                                          np.where((binders == 'Weak').any(axis=1), 'Weak', 'Non-binding')),
+                                 index=binders.index)
+        heatmap = ranks.clip(upper=2.5 if self.mhc_class == 'I' else 12)
+        heatmap = heatmap.sort_values(list(heatmap.columns), ascending=True)
+        return {'binders': binders,
+                'ranks': ranks,
+                'best_binding': best_binding,
+                'best_binding_counts': best_binding.value_counts().to_dict(),
+                'heatmap': heatmap}
+
+    @profiled('calculate_metrics')
+    def calculate_metrics(self, write_file: bool = True):
         # mix two colors, input must be tuples representing RGB colors
         # adapted from here: https://stackoverflow.com/questions/25668828/how-to-create-colour-gradient-in-python
         def color_fader(c1, c2, mix=0):  # fade (linear interpolate) from color c1 (at mix=0) to c2 (mix=1)
@@ -129,11 +230,7 @@ class mhc_report:
             n_with_acceptable_length = np.sum(
                 (lengths >= self.results.min_length) & (lengths <= self.results.max_length))
 
-            counts_df = self.preds.loc[self.preds['Sample'] == sample, :]
-            counts_df = counts_df.pivot(index='Peptide', columns='Allele', values='Binder')
-            bindings = counts_df.apply(get_highest_binding, axis=1).values
-            binders, counts = np.unique(bindings, return_counts=True)
-            binder_counts = {binder: count for binder, count in zip(list(binders), (list(counts)))}
+            binder_counts = self.best_binding_counts[sample]
             if 'Non-binding' in binder_counts:
                 n_binders = n_with_acceptable_length - binder_counts['Non-binding']
             else:
@@ -194,6 +291,7 @@ class mhc_report:
                 )
         return info_div
 
+    @profiled('quality_table')
     def quick_quality_table(self, className=None):
         t = table(className=f'table table-hover table-bordered',
                   style="text-align: center",
@@ -226,6 +324,7 @@ class mhc_report:
         t.add(tablebody)
         return div(t, className=f'table-responsive {className}' if className else 'table-responsive')
 
+    @profiled('peptide_tables')
     def gen_peptide_tables(self, className=None, return_card=False):
 
         t = table(className=f'table table-hover table-bordered',
@@ -280,24 +379,12 @@ class mhc_report:
         else:
             return div(t, className=f'table-responsive {className}' if className else 'table-responsive')
 
+    @profiled('binding_histogram')
     def gen_binding_histogram(self, className=None):
-        def get_highest_binding(predictions):
-            if 'Strong' in predictions.values:
-                return 'Strong'
-            elif 'Weak' in predictions.values:
-                return 'Weak'
-            else:
-                return 'Non-binding'
-
         n_peps_fig = go.Figure()
         for sample in self.results.samples:
-            counts_df = self.preds.loc[self.preds['Sample'] == sample, :]
-            counts_df = counts_df.pivot(index='Peptide', columns='Allele', values='Binder')
-            bindings = counts_df.apply(get_highest_binding, axis=1).values
-            binders, counts = np.unique(bindings, return_counts=True)
-            counts = [counts[list(binders).index('Strong')] if 'Strong' in binders else 0,
-                      counts[list(binders).index('Weak')] if 'Weak' in binders else 0,
-                      counts[list(binders).index('Non-binding')] if 'Non-binding' in binders else 0]
+            binder_counts = self.best_binding_counts[sample]
+            counts = [binder_counts.get('Strong', 0), binder_counts.get('Weak', 0), binder_counts.get('Non-binding', 0)]
             binders = ['Strong', 'Weak', 'Non-binder']
             n_peps_fig.add_trace(go.Bar(x=binders, y=counts, name=sample))
         n_peps_fig.update_layout(margin=dict(l=20, r=20, t=20, b=20),
@@ -315,12 +402,13 @@ class mhc_report:
         n_peps_fig.update_xaxes(title_text='Binding strength')
         n_peps_fig.update_xaxes(titlefont={'size': 16}, tickfont={'size': 14})
         n_peps_fig.update_yaxes(titlefont={'size': 16}, tickfont={'size': 14})
-        n_peps_fig.write_image(str(self.fig_dir / 'binding_histogram.pdf'), engine="kaleido")
+        self.figure_exporter.add(n_peps_fig, self.fig_dir / 'binding_histogram.pdf')
         card = div(div(b('Binding Affinities'), className='card-header'), className='card')
         card.add(div(raw(n_peps_fig.to_html(full_html=False, include_plotlyjs=False)), className='card-body'))
 
         return div(card, className=className)
 
+    @profiled('length_histogram')
     def gen_length_histogram(self, className=None):
         len_dist = go.Figure()
         for sample in self.results.samples:
@@ -345,7 +433,7 @@ class mhc_report:
         len_dist.update_yaxes(titlefont={'size': 16}, tickfont={'size': 14})
         len_dist.layout.xaxis.dtick = 1
         len_dist.update_xaxes(fixedrange=True)
-        len_dist.write_image(str(self.fig_dir / 'length_distribution.pdf'), engine="kaleido")
+        self.figure_exporter.add(len_dist, self.fig_dir / 'length_distribution.pdf')
         card = div(p([b('Peptide Length Distribution '), '(maximum of 30 mers)'], className='card-header'),
                    className='card')
         card.add(div(raw(len_dist.to_html(full_html=False, include_plotlyjs=False)), className='card-body'))
@@ -353,15 +441,11 @@ class mhc_report:
 
     def sample_heatmap(self, sample: str):
         #ymax = np.max([self.peptide_numbers[sample]['total'] for sample in self.samples])
-        pivot = self.preds.loc[self.preds['Sample'] == sample, :].pivot(index='Peptide', columns='Allele',
-                                                                        values='Rank').astype(float)
+        data = self._sample_summary(sample)['heatmap']
         if self.mhc_class == 'I':
-            pivot[pivot > 2.5] = 2.5
             colorscale = [[0, '#ef553b'], [2.0 / 2.5, '#636efa'], [2.1 / 2.5, '#fdffc2'], [1, '#fdffc2']]
         else:
-            pivot[pivot > 12] = 12
             colorscale = [[0, '#ef553b'], [10 / 12, '#636efa'], [10.5 / 12, '#fdffc2'], [1, '#fdffc2']]
-        data = pivot.sort_values(list(pivot.columns), ascending=True)
 
         if self.mhc_class == 'I':
             colorbar = dict(title='%Rank',
@@ -376,7 +460,7 @@ class mhc_report:
 
         fig = go.Figure(go.Heatmap(
             z=data,
-            x=list(pivot.columns),
+            x=list(data.columns),
             colorscale=colorscale,
             colorbar=colorbar,
             #xgap=1
@@ -391,10 +475,11 @@ class mhc_report:
         fig.update_yaxes(fixedrange=True)
         fig.update_xaxes(showgrid=False)
         fig.update_yaxes(showgrid=False)
-        fig.write_image(str(self.fig_dir / f'{sample}_heatmap.pdf'), engine="kaleido")
+        self.figure_exporter.add(fig, self.fig_dir / f'{sample}_heatmap.pdf')
 
         return fig
 
+    @profiled('heatmaps')
     def gen_heatmaps(self, className=None):
         ymax = np.max([self.peptide_numbers[sample]['within_length'] for sample in self.results.samples])
         ymax += 0.01 * ymax
@@ -403,15 +488,11 @@ class mhc_report:
                                                'border-width: 1px;'
                                                'border-style: solid')
         for sample in self.results.samples:
-            pivot = self.preds.loc[self.preds['Sample'] == sample, :].pivot(index='Peptide', columns='Allele',
-                                                                  values='Rank').astype(float)
+            data = self._sample_summary(sample)['heatmap']
             if self.mhc_class == 'I':
-                pivot[pivot > 2.5] = 2.5
                 colorscale = [[0, '#ef553b'], [2.0 / 2.5, '#636efa'], [2.1 / 2.5, '#fdffc2'], [1, '#fdffc2']]
             else:
-                pivot[pivot > 12] = 12
                 colorscale = [[0, '#ef553b'], [10 / 12, '#636efa'], [10.5 / 12, '#fdffc2'], [1, '#fdffc2']]
-            data = pivot.sort_values(list(pivot.columns), ascending=True)
             n_peps = len(data)
 
             if self.mhc_class == 'I':
@@ -427,7 +508,7 @@ class mhc_report:
 
             fig = go.Figure(go.Heatmap(
                 z=data,
-                x=list(pivot.columns),
+                x=list(data.columns),
                 colorscale=colorscale,
                 colorbar=colorbar,
                 #xgap=2
@@ -462,7 +543,7 @@ class mhc_report:
                     style="margin-right: auto")
             )
 
-            fig.write_image(str(self.fig_dir / 'heatmaps_w_common_y_axis' / f'{sample}_heatmap.pdf'), engine="kaleido")
+            self.figure_exporter.add(fig, self.fig_dir / 'heatmaps_w_common_y_axis' / f'{sample}_heatmap.pdf')
 
         #card = div(className='card')
         #card.add(div(b('Binding Specificity Heatmaps'), className='card-header'))
@@ -471,6 +552,7 @@ class mhc_report:
         #return div(card, className=className)
         return heatmaps
 
+    @profiled('upset_plot')
     def gen_upset_plot(self, className=None):
         # total_peps = len([pep for s in self.results.samples for pep in s.peptides])
         total_peps = np.sum([len(self.results.sample_peptides[s]) for s in self.results.samples])
@@ -491,8 +573,7 @@ class mhc_report:
         usp_plot.update_xaxes(titlefont={'size': 16}, tickfont={'size': 14})
         usp_plot.update_yaxes(titlefont={'size': 16}, tickfont={'size': 14})
 
-        upset_fig = f'{self.fig_dir / "upsetplot.pdf"}'
-        usp_plot.write_image(upset_fig, engine='kaleido')
+        self.figure_exporter.add(usp_plot, self.fig_dir / 'upsetplot.pdf')
         n = len(self.results.samples)
         if n <= 5:
             height = '450px'
@@ -511,6 +592,7 @@ class mhc_report:
                 className = 'col-6'
         return div(card, className=className)
 
+    @profiled('sequence_logos')
     def sequence_logos(self, className=None):
         motifs = div(className=className)
         gibbs_peps = {}
@@ -536,13 +618,13 @@ class mhc_report:
 
         sample_logos = {}
         # make logos asynchronously
-        with concurrent.futures.ProcessPoolExecutor(max_workers=self.cpus) as executor:
+        with self._logo_pool() as executor:
             for sample in self.results.samples:
                 if self.results.gibbs_files[sample]['unsupervised'] is not None:
                     cores = self.results.gibbs_files[sample]['unsupervised']['cores']
                     if not isinstance(cores, list):
                         cores = [cores]
-                    sample_logos[sample] = [executor.submit(make_logo, core) for core in cores]
+                    sample_logos[sample] = self._submit_logos(executor, cores)
 
         for sample in self.results.samples:
             if sample in sample_logos.keys():
@@ -560,13 +642,13 @@ class mhc_report:
                 pep_groups = []
                 for x in range(len(cores)):
                     pep_groups.append(cores[x].name.replace('gibbs.', '')[0])
-                p_df: pd.DataFrame = self.pep_binding_dict[sample]
+                p_df: pd.DataFrame = self._sample_summary(sample)['binders']
                 width = 160 + 50*len(self.sample_alleles[sample])
                 motifs_row.add(wrap_plotly_fig(self.sample_heatmap(sample), width=f'{width}px', height='360px'))
                 logos_for_row = div(className="row")
                 motifs_row.add(div(logos_for_row, className="col"))
                 for i in range(len(logos)):
-                    logos[i][0].write_image(str(logo_dir / f'{sample}_{i}.pdf'), engine="kaleido")
+                    self.figure_exporter.add(logos[i][0], logo_dir / f'{sample}_{i}.pdf')
                     g_peps = set(gibbs_peps[sample][pep_groups[i]])  # the set of peptides found in the group
                     strong_binders = {allele: round(len(g_peps & set(p_df[p_df[allele] == "Strong"].index)) * 100 /
                                                     len(g_peps)) for allele in self.sample_alleles[sample]}
@@ -629,6 +711,7 @@ class mhc_report:
             )
         return motifs
 
+    @profiled('allele_sequence_logos')
     def supervised_sequence_logos(self, className=None):
         logo_dir = self.fig_dir / 'allele_specific_logos'
         logo_dir.mkdir()
@@ -651,7 +734,7 @@ class mhc_report:
 
         sample_logos = {}
         # make logos asynchronously
-        with concurrent.futures.ProcessPoolExecutor(max_workers=self.cpus) as executor:
+        with self._logo_pool() as executor:
             for sample in self.results.samples:
                 sample_logos[sample] = {}
                 for allele in self.sample_alleles[sample] + ['unannotated']:
@@ -659,7 +742,7 @@ class mhc_report:
                         cores = self.results.gibbs_files[sample][allele]['cores']
                         if not isinstance(cores, list):
                             cores = [cores]
-                        sample_logos[sample][allele] = [executor.submit(make_logo, core) for core in cores]
+                        sample_logos[sample][allele] = self._submit_logos(executor, cores)
 
         for sample in self.results.samples:
             for allele in self.sample_alleles[sample] + ['unannotated']:
@@ -670,7 +753,7 @@ class mhc_report:
             motifs_row = div(className='row')
             for allele in self.sample_alleles[sample]:
                 if self.results.gibbs_files[sample][allele] is not None:
-                    sample_logos[sample][allele][0][0].write_image(str(logo_dir / f'{sample}_{allele}.pdf'), engine="kaleido")
+                    self.figure_exporter.add(sample_logos[sample][allele][0][0], logo_dir / f'{sample}_{allele}.pdf')
                     motifs_row.add(
                         div(
                             [
@@ -710,7 +793,8 @@ class mhc_report:
                 for logo in logos:
                     pep_groups.append(logo.name.replace('gibbs.', '')[0])
                 for x in range(len(logos)):
-                    sample_logos[sample]['unannotated'][x][0].write_image(str(logo_dir / f'{sample}_unannotated_{x}.pdf'), engine="kaleido")
+                    self.figure_exporter.add(sample_logos[sample]['unannotated'][x][0],
+                                             logo_dir / f'{sample}_unannotated_{x}.pdf')
                     motifs_row.add(
                         div(
                             [
@@ -905,12 +989,59 @@ class mhc_report:
                             allele_logos['id'] = 'allele-gibbs'
                             allele_logos['role'] = 'tabpanel'
                             allele_logos['aria-labelledby'] = 'allele-gibbs-tab'
+                if self.profiler.enabled:
+                    hr()
+                    self.profile_tables()
 
         loc = f'{str(self.results.tmp_folder/"report.html")}'
-        with open(loc, 'w') as f:
-            f.write(doc.render().replace("&lt;", "<"))
+        with self.profiler.stage('render_html'):
+            with open(loc, 'w') as f:
+                f.write(doc.render().replace("&lt;", "<"))
+        with self.profiler.stage('figure_export'):
+            self.figure_exporter.export()
         return loc
 
+    def profile_tables(self):
+        """
+        A collapsible section with the time taken by each stage of the analysis so far and by the external tools.
+        Stages which are still running (e.g. the report itself) are not shown, but they are included in
+        profile/stage_profile.json.
+        """
+        def seconds(x):
+            return '' if x is None else f'{x:.2f}'
+
+        def megabytes(x):
+            return '' if x is None else f'{x / 1e6:.0f}'
+
+        stages = table(className='table table-sm table-bordered', style="text-align: center")
+        stages.add(thead(tr([th('Stage'), th('Wall time (s)'), th('CPU time (s)'), th('Peak memory (MB)')])))
+        with stages.add(tbody()):
+            for stage in self.profiler.summary():
+                tr([td(stage['name'], style='text-align: left'), td(seconds(stage['wall_time'])),
+                    td(seconds(stage['cpu_time'])), td(megabytes(stage['max_rss']))])
+
+        tools = table(className='table table-sm table-bordered', style="text-align: center")
+        tools.add(thead(tr([th('Tool stage'), th('Jobs'), th('Failed'), th('Elapsed (s)'), th('CPU time (s)'),
+                            th('Peak memory (MB)'), th('Peptides')])))
+        with tools.add(tbody()):
+            for stage, totals in summarize_job_profiles(self.results.run_profiles()).items():
+                cpu_time = None
+                if totals['user_time'] is not None:
+                    cpu_time = totals['user_time'] + (totals['system_time'] or 0)
+                tr([td(stage, style='text-align: left'), td(totals['n_jobs']), td(totals['n_failed']),
+                    td(seconds(totals['elapsed'])), td(seconds(cpu_time)), td(megabytes(totals['max_rss'])),
+                    td(totals['input_size'] if totals['input_size'] is not None else '')])
+
+        with details() as section:
+            summary(h3('Analysis timings', style='display: inline'), style='cursor: pointer')
+            p(f'MhcVizPipe v{__version__}, profiling mode "{self.profiler.mode}". CPU time and peak memory of the '
+              f'stages are for the MhcVizPipe process, while those of the tool stages are for the external '
+              f'processes. The complete profile is in the profile folder of the analysis archive.')
+            with div(className='row'):
+                div(stages, className='col-6 table-responsive')
+                div(tools, className='col-6 table-responsive')
+        return section
+
 
 def venn_diagram(analysis_results: MhcToolHelper) -> go.Figure:
     n_sets = len(analysis_results.samples)
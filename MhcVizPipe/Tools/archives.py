@@ -0,0 +1,296 @@
+"""
+The archives of an analysis (MVP_analysis.zip, MVP_figures.zip and MVP_report_components.zip). They are not written
+when the analysis finishes, but streamed when they are downloaded: the files are read, compressed and sent as the
+zip file is produced, so no temporary zip file is written. Files are compressed with deflate in blocks by worker
+threads, and the thousands of intermediate GibbsCluster files (images, logos, matrices, ...) are left out unless they
+are asked for.
+"""
+import concurrent.futures
+import struct
+import time
+import zlib
+from collections import deque
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Tuple, Union
+from MhcVizPipe.Reporting.figure_export import DEFERRED_DIR
+
+# the contents of each archive, see archive_members
+ARCHIVES = {'MVP_analysis.zip': ['predictions', 'metrics', 'gibbs', 'report', 'profile'],
+            'MVP_figures.zip': ['figures'],
+            'MVP_report_components.zip': ['predictions', 'metrics', 'gibbs', 'report', 'figures', 'profile']}
+# the GibbsCluster files the report is made from. The other files of the GibbsCluster runs are intermediate.
+GIBBS_RESULT_FOLDERS = ('res', 'cores')
+GIBBS_RESULT_FILES = ('gibbs.KLDvsClusters.tab',)
+# files which are already compressed are stored as they are
+COMPRESSED_SUFFIXES = ('.pdf', '.png', '.gz', '.zst', '.zip', '.parquet', '.feather')
+# size of the blocks files are read and compressed in
+BLOCK_SIZE = 2 ** 20
+COMPRESSION_LEVEL = 6
+
+_ZIP64_LIMIT = 0xFFFFFFFF
+# files larger than this may not fit in 32-bit sizes once compressed, so they get ZIP64 sizes
+_ZIP64_FILE_SIZE = 0xF0000000
+_UTF8_NAMES = 0x0800
+_DATA_DESCRIPTOR = 0x0008
+
+
+def _is_gibbs_result(relative_path: Path) -> bool:
+    parts = relative_path.parts
+    return relative_path.name in GIBBS_RESULT_FILES or any(folder in parts[:-1] for folder in GIBBS_RESULT_FOLDERS)
+
+
+def _files(directory: Path) -> List[Path]:
+    return sorted(p for p in directory.rglob('*') if p.is_file()) if directory.is_dir() else []
+
+
+def archive_members(analysis_location: Union[str, Path],
+                    archive: str,
+                    all_gibbs_files: bool = False) -> List[Tuple[Path, str]]:
+    """
+    Get the files of an archive of an analysis.
+    :param analysis_location: The directory of the analysis
+    :param archive: The name of the archive, one of ARCHIVES
+    :param all_gibbs_files: If True, all the files of the GibbsCluster runs are included, not only the results
+    :return: List of (path of the file, name of the file in the archive) tuples
+    """
+    if archive not in ARCHIVES:
+        raise ValueError(f'Unknown archive: {archive}. The archives are: {", ".join(ARCHIVES)}')
+    location = Path(analysis_location)
+    members = []
+    for part in ARCHIVES[archive]:
+        if part == 'predictions':
+            members += [(p, p.name) for p in sorted(location.glob('*_predictions.*'))]
+        elif part == 'metrics':
+            members.append((location / 'sample_metrics.txt', 'sample_metrics.txt'))
+        elif part == 'report':
+            members.append((location / 'report.html', 'report.html'))
+        elif part == 'gibbs':
+            members += [(p, p.relative_to(location).as_posix()) for p in _files(location / 'gibbs')
+                        if all_gibbs_files or _is_gibbs_result(p.relative_to(location / 'gibbs'))]
+        elif part == 'figures':
+            # the specs of deferred PDF figures are only used to render the figures later
+            members += [(p, p.relative_to(location).as_posix()) for p in _files(location / 'figures')
+                        if DEFERRED_DIR not in p.relative_to(location).parts]
+        elif part == 'profile':
+            # the profile of the analysis is only written if profiling is on
+            profile = _files(location / 'profile')
+            if profile:
+                members += [(p, p.relative_to(location).as_posix()) for p in profile]
+                if (location / 'run_profile.json').exists():
+                    members.append((location / 'run_profile.json', 'run_profile.json'))
+    return members
+
+
+def _dos_time(mtime: float) -> Tuple[int, int]:
+    t = time.localtime(mtime)
+    year = max(t.tm_year, 1980)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def _read_blocks(path: Path) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                return
+            yield block
+
+
+def _deflate_block(block: bytes, last: bool, level: int) -> bytes:
+    """
+    Compress a block of a file as raw deflate data. The blocks are compressed independently and all but the last end
+    with a full flush, so they can be concatenated into the deflate data of the whole file.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH)
+
+
+class _Member:
+    def __init__(self, path: Path, arcname: str, compress: bool):
+        stat = path.stat()
+        self.path = path
+        self.name = arcname.encode('utf-8')
+        self.size = stat.st_size
+        self.mode = stat.st_mode
+        self.time, self.date = _dos_time(stat.st_mtime)
+        self.method = zlib.DEFLATED if compress and path.suffix.lower() not in COMPRESSED_SUFFIXES else 0
+        self.zip64 = self.size >= _ZIP64_FILE_SIZE
+        self.crc = 0
+        self.compressed_size = 0
+        self.offset = 0
+
+    @property
+    def flags(self) -> int:
+        # the sizes and CRC of compressed files are only known once they are compressed, so they follow the data
+        return _UTF8_NAMES | (_DATA_DESCRIPTOR if self.method else 0)
+
+    @property
+    def version(self) -> int:
+        return 45 if self.zip64 or self.offset >= _ZIP64_LIMIT else 20
+
+    def local_header(self) -> bytes:
+        if self.method:
+            crc, compressed_size, size = 0, 0, 0
+        else:
+            crc, compressed_size, size = self.crc, self.size, self.size
+        extra = b''
+        if self.zip64:
+            extra = struct.pack('<HHQQ', 1, 16, size, compressed_size)
+            compressed_size = size = _ZIP64_LIMIT
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, self.version, self.flags, self.method, self.time, self.date,
+                           crc, compressed_size, size, len(self.name), len(extra)) + self.name + extra
+
+    def data_descriptor(self) -> bytes:
+        if self.zip64:
+            return struct.pack('<IIQQ', 0x08074b50, self.crc, self.compressed_size, self.size)
+        return struct.pack('<IIII', 0x08074b50, self.crc, self.compressed_size, self.size)
+
+    def central_directory_header(self) -> bytes:
+        size, compressed_size, offset = self.size, self.compressed_size, self.offset
+        zip64_fields = []
+        if self.zip64 or size >= _ZIP64_LIMIT or compressed_size >= _ZIP64_LIMIT:
+            zip64_fields += [size, compressed_size]
+            size = compressed_size = _ZIP64_LIMIT
+        if offset >= _ZIP64_LIMIT:
+            zip64_fields.append(offset)
+            offset = _ZIP64_LIMIT
+        extra = struct.pack(f'<HH{len(zip64_fields)}Q', 1, 8 * len(zip64_fields), *zip64_fields) if zip64_fields \
+            else b''
+        return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | self.version, self.version, self.flags,
+                           self.method, self.time, self.date, self.crc, compressed_size, size, len(self.name),
+                           len(extra), 0, 0, 0, (self.mode & 0xFFFF) << 16, offset) + self.name + extra
+
+
+def stream_zip(members: List[Tuple[Path, str]],
+               compress: bool = True,
+               n_workers: int = 1,
+               level: int = COMPRESSION_LEVEL) -> Iterator[bytes]:
+    """
+    Produce a zip file as a stream of bytes, without writing it to disk. The files are read in blocks of BLOCK_SIZE,
+    which are compressed by a pool of worker threads (zlib releases the GIL) while the previous blocks are sent.
+    Large files and archives use the ZIP64 extensions.
+    :param members: List of (path of the file, name of the file in the archive) tuples
+    :param compress: If True, files are compressed with deflate, except those which are already compressed (see
+    COMPRESSED_SUFFIXES). Otherwise they are stored.
+    :param n_workers: Number of threads compressing the blocks
+    :param level: The zlib compression level
+    :return: Iterator over the bytes of the zip file
+    """
+    members = [_Member(Path(path), arcname, compress) for path, arcname in members]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        def blocks():
+            # (member, uncompressed block, compressed block or future) for all the blocks of all the members, in order
+            for member in members:
+                if not member.method:
+                    yield member, None, None
+                    continue
+                pending = None
+                for block in _read_blocks(member.path):
+                    if pending is not None:
+                        yield member, pending, executor.submit(_deflate_block, pending, False, level)
+                    pending = block
+                pending = pending if pending is not None else b''
+                yield member, pending, executor.submit(_deflate_block, pending, True, level)
+
+        # keep the workers busy with the blocks ahead of the one being sent
+        window = deque()
+        block_iterator = blocks()
+        offset = 0
+        current = None
+        while True:
+            while len(window) < 4 * max(1, n_workers):
+                try:
+                    window.append(next(block_iterator))
+                except StopIteration:
+                    break
+            if not window:
+                break
+            member, block, compressed = window.popleft()
+            if member is not current:
+                if current is not None and current.method:
+                    descriptor = current.data_descriptor()
+                    offset += len(descriptor)
+                    yield descriptor
+                current = member
+                member.offset = offset
+                if not member.method:
+                    # stored files are read twice, to write their CRC before their data
+                    for data in _read_blocks(member.path):
+                        member.crc = zlib.crc32(data, member.crc)
+                    member.compressed_size = member.size
+                header = member.local_header()
+                offset += len(header)
+                yield header
+                if not member.method:
+                    for data in _read_blocks(member.path):
+                        offset += len(data)
+                        yield data
+                    continue
+            member.crc = zlib.crc32(block, member.crc)
+            data = compressed.result()
+            member.compressed_size += len(data)
+            offset += len(data)
+            yield data
+        if current is not None and current.method:
+            descriptor = current.data_descriptor()
+            offset += len(descriptor)
+            yield descriptor
+
+    central_directory = b''.join(member.central_directory_header() for member in members)
+    yield central_directory
+    yield _end_of_central_directory(len(members), len(central_directory), offset)
+
+
+def _end_of_central_directory(n_members: int, size: int, offset: int) -> bytes:
+    end = b''
+    if n_members >= 0xFFFF or size >= _ZIP64_LIMIT or offset >= _ZIP64_LIMIT:
+        end += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, n_members, n_members, size, offset)
+        end += struct.pack('<IIQI', 0x07064b50, 0, offset + size, 1)
+    return end + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(n_members, 0xFFFF), min(n_members, 0xFFFF),
+                             min(size, _ZIP64_LIMIT), min(offset, _ZIP64_LIMIT), 0)
+
+
+def stream_archive(analysis_location: Union[str, Path],
+                   archive: str,
+                   all_gibbs_files: bool = False,
+                   compress: bool = None,
+                   n_workers: int = None) -> Iterator[bytes]:
+    """
+    Stream an archive of an analysis, e.g. as the response to a download.
+    :param analysis_location: The directory of the analysis
+    :param archive: The name of the archive, one of ARCHIVES
+    :param all_gibbs_files: If True, all the files of the GibbsCluster runs are included, not only the results
+    :param compress: (optional) Whether to compress the files. Defaults to the "archive compression" setting.
+    :param n_workers: (optional) Number of compression threads. Defaults to the "max threads" setting.
+    :return: Iterator over the bytes of the zip file
+    """
+    from MhcVizPipe.parameters import Parameters
+    parameters = Parameters()
+    if compress is None:
+        compress = parameters.ARCHIVE_COMPRESSION == 'deflate'
+    if n_workers is None:
+        n_workers = parameters.THREADS
+    return stream_zip(archive_members(analysis_location, archive, all_gibbs_files), compress=compress,
+                      n_workers=n_workers)
+
+
+def write_archive(analysis_location: Union[str, Path],
+                  archive: str,
+                  destination: Union[str, Path, BinaryIO],
+                  all_gibbs_files: bool = False,
+                  compress: bool = None,
+                  n_workers: int = None) -> Union[str, Path, BinaryIO]:
+    """
+    Write an archive of an analysis to a file (see stream_archive).
+    :param destination: The path of the zip file, or a binary file object
+    :return: The destination
+    """
+    stream = stream_archive(analysis_location, archive, all_gibbs_files, compress, n_workers)
+    if hasattr(destination, 'write'):
+        for data in stream:
+            destination.write(data)
+    else:
+        with open(destination, 'wb') as f:
+            for data in stream:
+                f.write(data)
+    return destination
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import pickle
+import shutil
+import uuid
+from pathlib import Path
+from typing import Iterable, List, Union
+from MhcVizPipe import __version__
+
+
+def _sha256(parts: Iterable[str]) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class ArtifactStore:
+    """
+    A content-addressed store of per-sample analysis results (GibbsCluster runs) and rendered sequence logos, so that
+    they can be reused when a sample is analyzed again with the same inputs. Results are keyed on a hash of
+    everything they depend on (see sample_key and logo_key), so changing a sample's peptides or alleles, the length
+    window, a tool installation or the MhcVizPipe version results in a new key.
+    """
+    def __init__(self, location: Union[str, Path]):
+        self.location = Path(location)
+        for directory in ['gibbs', 'logos']:
+            (self.location / directory).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def sample_key(peptides: Iterable[str], alleles: List[str], mhc_class: str, min_length: int, max_length: int,
+                   tools: List[str], settings: List[str] = ()) -> str:
+        """
+        :param peptides: The sample peptides (cleaned)
+        :param alleles: The sample alleles
+        :param mhc_class: The MHC class
+        :param min_length: Minimum peptide length
+        :param max_length: Maximum peptide length
+        :param tools: Fingerprints of the tools used (see prediction_cache.tool_fingerprint)
+        :param settings: (optional) Any other settings which affect the results
+        :return: The key as a hex string
+        """
+        return _sha256([__version__, mhc_class, str(min_length), str(max_length)] + list(tools) + list(settings) +
+                       ['alleles'] + sorted(alleles) + ['peptides'] + sorted(set(peptides)))
+
+    @staticmethod
+    def logo_key(cores_file: Union[str, Path], *settings) -> str:
+        """
+        :param cores_file: The GibbsCluster cores file the logo is made from
+        :param settings: Any settings which affect the logo
+        :return: The key as a hex string
+        """
+        with open(cores_file, 'r') as f:
+            return _sha256([__version__, f.read()] + [str(x) for x in settings])
+
+    def _publish(self, tmp: Path, destination: Path):
+        # results are written to a temporary location and renamed into place, so that another analysis never sees
+        # a partially written result
+        try:
+            os.replace(tmp, destination)
+        except OSError:  # another analysis stored the same result first
+            if tmp.is_dir():
+                shutil.rmtree(tmp, ignore_errors=True)
+            elif tmp.exists():
+                tmp.unlink()
+
+    def has_gibbs(self, key: str) -> bool:
+        return (self.location / 'gibbs' / key).is_dir()
+
+    def save_gibbs(self, key: str, sample_directory: Union[str, Path]):
+        """
+        Store the GibbsCluster results of a sample.
+        :param key: The sample key
+        :param sample_directory: The directory containing the GibbsCluster runs of the sample
+        :return: None
+        """
+        if self.has_gibbs(key):
+            return
+        tmp = self.location / 'gibbs' / f'.{key}.{uuid.uuid4().hex}'
+        shutil.copytree(sample_directory, tmp)
+        self._publish(tmp, self.location / 'gibbs' / key)
+
+    def restore_gibbs(self, key: str, sample_directory: Union[str, Path]) -> bool:
+        """
+        Copy stored GibbsCluster results of a sample into an analysis.
+        :param key: The sample key
+        :param sample_directory: The directory to copy the GibbsCluster runs to. It is replaced if it exists.
+        :return: True if results were found and copied, otherwise False
+        """
+        if not self.has_gibbs(key):
+            return False
+        sample_directory = Path(sample_directory)
+        if sample_directory.exists():
+            shutil.rmtree(sample_directory)
+        shutil.copytree(self.location / 'gibbs' / key, sample_directory)
+        return True
+
+    def load_logo(self, key: str):
+        """
+        :param key: The logo key
+        :return: The stored logo, or None if it is not in the store
+        """
+        fname = self.location / 'logos' / f'{key}.pkl'
+        if not fname.exists():
+            return None
+        try:
+            with open(fname, 'rb') as f:
+                return pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            return None
+
+    def save_logo(self, key: str, logo):
+        tmp = self.location / 'logos' / f'.{key}.{uuid.uuid4().hex}'
+        with open(tmp, 'wb') as f:
+            pickle.dump(logo, f)
+        self._publish(tmp, self.location / 'logos' / f'{key}.pkl')
+
+    def clear(self):
+        for directory in ['gibbs', 'logos']:
+            shutil.rmtree(self.location / directory)
+            (self.location / directory).mkdir()
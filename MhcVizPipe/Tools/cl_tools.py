@@ -3,14 +3,26 @@ import os
 import numpy as np
 from pathlib import Path
 from MhcVizPipe.Tools.utils import clean_peptides
-from typing import List
-from MhcVizPipe.Tools.jobs import Job, _run_multiple_processes
+from typing import Callable, List, Iterator, Tuple
+import concurrent.futures
+from MhcVizPipe.Tools.jobs import Job, GibbsSweepJob, _run_multiple_processes, read_gibbs_klds, run
 from MhcVizPipe.Tools.netmhcpan_helper import NetMHCpanHelper
+from MhcVizPipe.Tools.prediction_cache import PredictionCache, tool_fingerprint
+from MhcVizPipe.Tools.artifacts import ArtifactStore
+from MhcVizPipe.Tools.instrumentation import write_run_profile
+from MhcVizPipe.Tools.prediction_table import PredictionTable, PREDICTION_COLUMNS, format_prediction_lines
+from MhcVizPipe.Tools.input_formats import require
+from MhcVizPipe.Tools.prediction_index import PredictionIndex
+from MhcVizPipe.Tools.prediction_planner import PredictionPlanner, get_allele_peptides, \
+    group_alleles_for_prediction
 import re
 import shutil
 from MhcVizPipe.Tools.utils import convert_win_2_wsl_path
 import platform
 
+# number of lines written at a time to the prediction files
+PREDICTION_WRITE_CHUNK_SIZE = 2 ** 16
+
 
 class MhcToolHelper:
     def __init__(self,
@@ -19,7 +31,9 @@ class MhcToolHelper:
                  tmp_directory: str,
                  mhc_class: str = 'I',
                  min_length: int = 8,
-                 max_length: int = 12):
+                 max_length: int = 12,
+                 prediction_cache: PredictionCache = None,
+                 prediction_planner: PredictionPlanner = None):
 
         if mhc_class == 'I' and min_length < 8:
             raise ValueError('Class I peptides must be 8 mers and longer for NetMHCpan')
@@ -58,7 +72,27 @@ class MhcToolHelper:
             self.tmp_folder.mkdir(parents=True)
         self.predictions_made = False
         self.binding_predictions: pd.DataFrame = pd.DataFrame(columns=['Sample', 'Peptide', 'Allele', 'Rank', 'Binder'])
-        self.prediction_dict: dict = None
+        self.predictions: PredictionTable = PredictionTable()
+        # for large cohorts the predictions are moved to an index on disk once they are made, see use_prediction_index
+        self.prediction_index: PredictionIndex = None
+        self.prediction_index_threshold = self.Parameters.PREDICTION_INDEX_THRESHOLD
+        self.prediction_formats = self.Parameters.PREDICTION_FORMATS
+        # if a planner is given, the predictions are shared with other analyses (see PredictionPlanner)
+        self.prediction_planner = prediction_planner
+        if prediction_cache is not None:
+            self.prediction_cache = prediction_cache
+        elif self.Parameters.PREDICTION_CACHE:
+            self.prediction_cache = PredictionCache(Path(self.Parameters.TMP_DIR) / 'prediction_cache.sqlite')
+        else:
+            self.prediction_cache = None
+        if self.Parameters.REUSE_RESULTS:
+            self.artifact_store = ArtifactStore(Path(self.Parameters.TMP_DIR) / 'artifacts')
+        else:
+            self.artifact_store = None
+        self.sample_keys = {}
+        self.reused_samples = []
+        self.gibbs_sweep = self.Parameters.GIBBS_SWEEP
+        self.gibbs_sweep_margin = self.Parameters.GIBBS_SWEEP_MARGIN
         self.gibbs_directories = []
         self.supervised_gibbs_directories = {}
         self.gibbs_cluster_lengths = {}
@@ -68,6 +102,7 @@ class MhcToolHelper:
         if self.n_threads < 1 or self.n_threads > os.cpu_count():
             self.n_threads = os.cpu_count()
         self.jobs = []
+        self.job_profiles = []
 
         # make directories to store the GibbsCluster analyses
         if Path(self.tmp_folder / 'gibbs').exists() and Path(self.tmp_folder / 'gibbs').is_dir():
@@ -85,159 +120,423 @@ class MhcToolHelper:
             for allele in alleles:
                 Path(self.tmp_folder / 'gibbs' / sample_name / allele).mkdir()
 
-    def make_binding_predictions(self):
+        if self.artifact_store is not None:
+            tools = [tool_fingerprint(self.GIBBSCLUSTER),
+                     tool_fingerprint(self.NETMHCPAN if self.mhc_class == 'I' else self.NETMHCIIPAN)]
+            for sample in self.samples:
+                self.sample_keys[sample] = ArtifactStore.sample_key(self.sample_peptides[sample],
+                                                                    self.sample_alleles[sample],
+                                                                    self.mhc_class, self.min_length, self.max_length,
+                                                                    tools,
+                                                                    settings=[self.gibbs_sweep,
+                                                                              str(self.gibbs_sweep_margin)])
+
+    def restore_artifacts(self):
+        """
+        Copy the GibbsCluster results of samples which have already been analyzed with the same inputs from the
+        artifact store. These samples are skipped when making the GibbsCluster jobs.
+        :return: The list of samples which were restored
+        """
+        if self.artifact_store is None:
+            return []
+        for sample in self.samples:
+            if sample not in self.reused_samples and \
+                    self.artifact_store.restore_gibbs(self.sample_keys[sample], self.tmp_folder / 'gibbs' / sample):
+                self.reused_samples.append(sample)
+        if self.reused_samples:
+            print(f'Reusing GibbsCluster results for samples: {", ".join(self.reused_samples)}')
+        return self.reused_samples
+
+    def save_artifacts(self):
+        """
+        Save the GibbsCluster results of all samples to the artifact store so they can be reused by later analyses.
+        :return: None
+        """
+        if self.artifact_store is None:
+            return
+        for sample in self.samples:
+            if sample not in self.reused_samples:
+                self.artifact_store.save_gibbs(self.sample_keys[sample], self.tmp_folder / 'gibbs' / sample)
+
+    def make_binding_predictions(self, multi_allele: bool = True, max_extra_fraction: float = 0.25,
+                                 on_sample_predicted: Callable[[str, pd.DataFrame], None] = None):
         """
         Run NetMHCpan or NetMHCIIpan to make binding predictions for all samples. Peptide lists are grouped by allele
         rather than sample to reduce processing time when peptides exist in multiple samples.
+        :param multi_allele: If True, alleles with similar peptide sets are predicted together in a single NetMHCpan
+        run (using the union of their peptides) rather than running NetMHCpan once per allele.
+        :param max_extra_fraction: The maximum fraction of unnecessary predictions (i.e. predictions for peptides
+        which are not in any sample with the allele) allowed when grouping alleles. Only used if multi_allele is True.
+        :param on_sample_predicted: (optional) A function which is called with the name and binding predictions of
+        each sample as soon as the predictions for all of its alleles are done.
+        If the analysis has a prediction planner, the predictions are taken from the planner (which only predicts the
+        pairs it has not predicted yet) and multi_allele is not used.
         :return:
         """
-        # get the list of unique alleles
-        alleles = []
-        for sample in self.sample_info:
-            alleles += [x.strip() for x in sample['sample-alleles'].split(',')]
-        alleles = set(alleles)
-
         # get sets of peptides per allele
-        allele_peptides = {}
-        for allele in alleles:
-            allele_peps = []
-            for sample in self.sample_info:
-                if allele in sample['sample-alleles']:
-                    allele_peps += self.sample_peptides[sample['sample-name']]
-            allele_peptides[allele] = list(set(allele_peps))
+        allele_peptides = get_allele_peptides({sample: self.sample_alleles[sample] for sample in self.samples},
+                                              self.sample_peptides)
+        allele_peptides = {allele: list(peptides) for allele, peptides in allele_peptides.items()}
+
+        if multi_allele and self.prediction_planner is None:
+            allele_groups = group_alleles_for_prediction(allele_peptides, max_extra_fraction=max_extra_fraction)
+        else:
+            allele_groups = [[allele] for allele in allele_peptides.keys()]
 
         # run the prediction tool
-        all_predictions = {}
-        for allele, peptides in allele_peptides.items():
-            netmhcpan = NetMHCpanHelper(peptides=peptides,
-                                        alleles=[allele],
-                                        mhc_class=self.mhc_class,
-                                        n_threads=self.Parameters.THREADS,
-                                        tmp_dir=str(self.tmp_folder),
-                                        netmhcpan=self.NETMHCPAN,
-                                        netmhc2pan=self.NETMHCIIPAN,
-                                        min_length=self.min_length,
-                                        max_length=self.max_length)
-
-            predictions = netmhcpan.predict_dict()
-            all_predictions[allele] = {pep: {} for pep in peptides}
-            for pep in peptides:
-                all_predictions[allele][pep] = predictions[pep][allele]
-        self.prediction_dict = all_predictions
+        prediction_tables = []
+        predicted_alleles = set()
+        notified = set()
+        for group in allele_groups:
+            group_peptides = list(set().union(*[allele_peptides[allele] for allele in group]))
+            if self.prediction_planner is not None:
+                predictions = self.prediction_planner.predictions(group, group_peptides)
+                self.job_profiles += self.prediction_planner.take_job_profiles()
+            else:
+                netmhcpan = NetMHCpanHelper(peptides=group_peptides,
+                                            alleles=group,
+                                            mhc_class=self.mhc_class,
+                                            n_threads=self.Parameters.THREADS,
+                                            tmp_dir=str(self.tmp_folder),
+                                            netmhcpan=self.NETMHCPAN,
+                                            netmhc2pan=self.NETMHCIIPAN,
+                                            min_length=self.min_length,
+                                            max_length=self.max_length,
+                                            cache=self.prediction_cache)
+
+                predictions = netmhcpan.predict_table()
+                self.job_profiles += netmhcpan.job_profiles
+            for allele in group:
+                prediction_tables.append(
+                    PredictionTable(predictions.select(alleles=[allele], peptides=allele_peptides[allele]))
+                )
+            predicted_alleles.update(group)
+            if on_sample_predicted is not None:
+                ready = [sample for sample in self.samples
+                         if sample not in notified and set(self.sample_alleles[sample]) <= predicted_alleles]
+                if ready:
+                    self.predictions = PredictionTable.concat(prediction_tables)
+                    for sample in ready:
+                        on_sample_predicted(sample, self._join_binding_predictions([sample]))
+                        notified.add(sample)
+        self.predictions = PredictionTable.concat(prediction_tables)
+        if self.prediction_cache is not None and self.prediction_planner is None:
+            print(f'Prediction cache hits: {self.prediction_cache.hits}, misses: {self.prediction_cache.misses}')
+
+        if self.use_prediction_index():
+            # the predictions are only read from the index from now on, one sample at a time
+            self.prediction_index = PredictionIndex.build(self.predictions, self.tmp_folder / 'prediction_index')
+            self.predictions = PredictionTable()
+            self.binding_predictions = None
+            print(f'Binding predictions indexed in {self.prediction_index.directory} '
+                  f'({self.prediction_index.disk_usage() / 2**20:.0f} MB)')
+            return
 
         # add all predictions to the self.binding_predictions DataTable
-        for sample in self.sample_info:
-            rows = []
-            for allele, peptides in allele_peptides.items():
-                if allele not in sample['sample-alleles']:
-                    continue
-                for pep in peptides:
-                    if pep not in self.sample_peptides[sample['sample-name']]:
-                        continue
-                    rows.append([sample['sample-name'],
-                                 pep,
-                                 allele,
-                                 all_predictions[allele][pep]['EL_Rank'],
-                                 all_predictions[allele][pep]['Binder']])
-            self.binding_predictions = self.binding_predictions.append(
-                pd.DataFrame(columns=['Sample', 'Peptide', 'Allele', 'Rank', 'Binder'], data=rows),
-                ignore_index=True
-            )
+        self.binding_predictions = self._join_binding_predictions(self.samples)
+
+    def use_prediction_index(self) -> bool:
+        """
+        Whether the predictions should be kept in an on-disk PredictionIndex rather than in memory. This is the case
+        when the number of binding predictions of the samples (peptides times alleles, summed over the samples)
+        reaches the "prediction index threshold" setting. A negative threshold turns the index off.
+        """
+        if self.prediction_index_threshold < 0:
+            return False
+        n_predictions = sum(len(set(self.sample_peptides[sample])) * len(self.sample_alleles[sample])
+                            for sample in self.samples)
+        return n_predictions >= self.prediction_index_threshold
+
+    def sample_binding_predictions(self, sample: str) -> pd.DataFrame:
+        """
+        Get the binding predictions of one sample, from the prediction index if there is one.
+        :param sample: The sample
+        :return: DataFrame with columns Sample, Peptide, Allele, Rank, Binder (see _join_binding_predictions)
+        """
+        if self.prediction_index is None:
+            return self.binding_predictions.loc[self.binding_predictions['Sample'] == sample, :]
+        predictions = self.prediction_index.lookup(set(self.sample_peptides[sample]), self.sample_alleles[sample])
+        predictions = predictions[['Peptide', 'Allele', 'EL_Rank', 'Binder']].rename(columns={'EL_Rank': 'Rank'})
+        predictions.insert(0, 'Sample', pd.Categorical([sample] * len(predictions), categories=self.samples))
+        return predictions.astype({'Allele': 'category'})
+
+    def iter_sample_binding_predictions(self) -> Iterator[Tuple[str, pd.DataFrame]]:
+        """
+        Iterate over the binding predictions of each sample. Only one sample is read from the prediction index at a
+        time.
+        :return: Iterator over (sample, DataFrame of binding predictions) tuples
+        """
+        if self.prediction_index is None:
+            groups = dict(tuple(self.binding_predictions.groupby('Sample', observed=True, sort=False)))
+            for sample in self.samples:
+                yield sample, groups.get(sample, self.binding_predictions.iloc[0:0])
+        else:
+            for sample in self.samples:
+                yield sample, self.sample_binding_predictions(sample)
+
+    def _join_binding_predictions(self, samples: List[str]) -> pd.DataFrame:
+        """
+        Join the sample peptides and sample alleles with the prediction table.
+        :param samples: The samples to include
+        :return: DataFrame with columns Sample, Peptide, Allele, Rank, Binder
+        """
+        sample_peptides = [list(set(self.sample_peptides[sample])) for sample in samples]
+        membership = pd.DataFrame({'Sample': np.repeat(samples, [len(peps) for peps in sample_peptides]),
+                                   'Peptide': [pep for peps in sample_peptides for pep in peps]})
+        sample_alleles = pd.DataFrame([(sample, allele) for sample in samples for allele in self.sample_alleles[sample]],
+                                      columns=['Sample', 'Allele'])
+        predictions = self.predictions.frame[['Allele', 'Peptide', 'EL_Rank', 'Binder']].astype(
+            {'Allele': str, 'Peptide': str}
+        ).rename(columns={'EL_Rank': 'Rank'})
+        binding_predictions = membership.merge(sample_alleles, on='Sample').merge(predictions,
+                                                                                  on=['Allele', 'Peptide'])
+        return binding_predictions[['Sample', 'Peptide', 'Allele', 'Rank', 'Binder']].astype(
+            {'Sample': 'category', 'Allele': 'category'}
+        )
 
     def write_binding_predictions(self):
-        samples = self.binding_predictions['Sample'].unique()
-        for sample in samples:
-            peptides = list(self.binding_predictions.loc[self.binding_predictions['Sample'] == sample, 'Peptide'].unique())
-            alleles = list(self.binding_predictions.loc[self.binding_predictions['Sample'] == sample, 'Allele'].unique())
-            with open(self.tmp_folder / f'{sample}_netMHC{"II" if self.mhc_class == "II" else ""}pan_predictions.tsv', 'w') as f:
-                keys = list(self.prediction_dict[alleles[0]][peptides[0]].keys())
-                header = ['Allele', 'Peptide'] + keys
-                f.write('\t'.join(header) + '\n')
-                for allele in alleles:
-                    for peptide in peptides:
-                        keys = self.prediction_dict[allele][peptide].keys()
-                        to_write = [allele, peptide] + [str(self.prediction_dict[allele][peptide][k]) for k in keys]
-                        f.write('\t'.join(to_write) + '\n')
+        """
+        Write the predictions of each sample to <sample>_netMHCpan_predictions.tsv (or _netMHCIIpan_), ordered by
+        allele then peptide, and to Parquet and/or Feather files if they are in the "prediction formats" setting.
+        Each prediction is formatted once, however many samples it is in, and the lines of each sample are written in
+        chunks of PREDICTION_WRITE_CHUNK_SIZE.
+        :return: None
+        """
+        for file_format in self.prediction_formats:
+            if file_format != 'tsv':
+                require(file_format)
+        if self.prediction_index is not None:
+            for sample in self.samples:
+                sample_predictions = self.prediction_index.lookup(list(set(self.sample_peptides[sample])),
+                                                                  self.sample_alleles[sample])
+                if len(sample_predictions) > 0:
+                    self._write_sample_predictions(sample, sample_predictions,
+                                                   format_prediction_lines(sample_predictions))
+            return
+
+        frame = self.predictions.frame
+        lines = np.array(format_prediction_lines(frame), dtype=object)
+        for sample, rows in self._sample_prediction_rows():
+            self._write_sample_predictions(sample, frame.iloc[rows], lines[rows])
+
+    def _sample_prediction_rows(self) -> Iterator[Tuple[str, np.ndarray]]:
+        """
+        Find the rows of the prediction table for each sample with a single join of the binding predictions and the
+        prediction table on the category codes of the alleles and peptides.
+        :return: Iterator over (sample, rows of self.predictions.frame ordered by allele then peptide) tuples
+        """
+        frame = self.predictions.frame
+        binding_predictions = self.binding_predictions
+        alleles = frame['Allele'].cat.categories
+        samples = pd.Categorical(binding_predictions['Sample'], categories=self.samples)
+        allele_codes = pd.Categorical(binding_predictions['Allele'], categories=alleles).codes
+        # the position of each allele in the alleles of each sample
+        allele_order = np.zeros((len(self.samples), len(alleles)), dtype=np.int32)
+        for i, sample in enumerate(self.samples):
+            for j, allele in enumerate(self.sample_alleles[sample]):
+                if allele in alleles:
+                    allele_order[i, alleles.get_loc(allele)] = j
+        sample_rows = pd.DataFrame({
+            'Sample': samples,
+            'allele_order': allele_order[samples.codes, allele_codes],
+            'allele': allele_codes.astype(np.int32),
+            'peptide': pd.Categorical(binding_predictions['Peptide'],
+                                      categories=frame['Peptide'].cat.categories).codes.astype(np.int32)
+        })
+        table_rows = pd.DataFrame({'allele': frame['Allele'].cat.codes.values.astype(np.int32),
+                                   'peptide': frame['Peptide'].cat.codes.values.astype(np.int32),
+                                   'row': np.arange(len(frame))})
+        sample_rows = sample_rows.merge(table_rows, on=['allele', 'peptide'])
+        # the binding predictions are ordered by peptide, a stable sort keeps that order for each allele
+        sample_rows = sample_rows.sort_values('allele_order', kind='stable')
+        for sample, rows in sample_rows.groupby('Sample', observed=True, sort=False):
+            yield sample, rows['row'].values
+
+    def _write_sample_predictions(self, sample: str, sample_predictions: pd.DataFrame, lines: List[str]):
+        filename = self.tmp_folder / f'{sample}_netMHC{"II" if self.mhc_class == "II" else ""}pan_predictions'
+        with open(f'{filename}.tsv', 'w') as f:
+            f.write('\t'.join(PREDICTION_COLUMNS) + '\n')
+            for start in range(0, len(lines), PREDICTION_WRITE_CHUNK_SIZE):
+                f.write('\n'.join(lines[start:start + PREDICTION_WRITE_CHUNK_SIZE]) + '\n')
+        if len(self.prediction_formats) == 1:
+            return
+        # the categories of the prediction table hold the peptides of all the samples
+        table = sample_predictions[PREDICTION_COLUMNS].astype({'Allele': str, 'Peptide': str}).reset_index(drop=True)
+        if 'parquet' in self.prediction_formats:
+            table.to_parquet(f'{filename}.parquet', index=False)
+        if 'feather' in self.prediction_formats:
+            table.to_feather(f'{filename}.feather')
 
     def make_cluster_with_gibbscluster_jobs(self):
-        os.chdir(self.tmp_folder)
+        self.restore_artifacts()
         for sample in self.samples:
-            fname = Path(self.tmp_folder, f'{sample}_forgibbs.csv')
-            peps = np.array(clean_peptides(self.sample_peptides[sample]))
-            if len(peps) < 20:
-                self.not_enough_peptides.append(sample)
+            if sample in self.reused_samples:
                 continue
-            lengths = np.vectorize(len)(peps)
-            peps = peps[(lengths >= self.min_length) & (lengths <= self.max_length)]
-            peps.tofile(str(fname), '\n', '%s')
+            self.jobs += self._gibbscluster_jobs(sample)
+
+    def _gibbscluster_jobs(self, sample: str) -> List[Job]:
+        """
+        Make the unsupervised GibbsCluster jobs of a sample. These only depend on the sample peptides.
+        """
+        jobs = []
+        fname = Path(self.tmp_folder, f'{sample}_forgibbs.csv')
+        peps = np.array(clean_peptides(self.sample_peptides[sample], min_length=self.min_length,
+                                       max_length=self.max_length))
+        if len(peps) < 20:
+            self.not_enough_peptides.append(sample)
+            return jobs
+        peps.tofile(str(fname), '\n', '%s')
+
+        # if we are in windows, convert the filepath to the WSL path
+        if platform.system().lower() == 'windows':
+            fname = convert_win_2_wsl_path(fname)
 
-            # if we are in windows, convert the filepath to the WSL path
-            if platform.system().lower() == 'windows':
-                fname = convert_win_2_wsl_path(fname)
+        def command(groups: str):
+            if self.mhc_class == 'I':
+                return f'{self.GIBBSCLUSTER} -f {fname} -P {groups}groups ' \
+                       f'-g {groups} -k 1 -T -j 2 -C -D 4 -I 1 -G'.split(' ')
+            else:
+                return f'{self.GIBBSCLUSTER} -f {fname} -P {groups}groups ' \
+                       f'-g {groups} -k 1 -T -j 2 -G'.split(' ')
 
-            n_groups = 6  # search for up to 6 motifs
+        working_directory = self.tmp_folder/'gibbs'/sample/'unsupervised'
+        n_groups = 6  # search for up to 6 motifs
+        if self.gibbs_sweep == 'single':
+            # one GibbsCluster run which tries all the numbers of groups
+            jobs.append(Job(command=command(f'1-{n_groups}'),
+                            working_directory=working_directory,
+                            id=f'gibbscluster_1-{n_groups}groups',
+                            sample=sample,
+                            stage='gibbscluster_unsupervised',
+                            input_size=len(peps)))
+        elif self.gibbs_sweep == 'adaptive':
+            jobs.append(GibbsSweepJob(commands=[command(str(groups)) for groups in range(1, n_groups+1)],
+                                      working_directory=working_directory,
+                                      id='gibbscluster_sweep',
+                                      margin=self.gibbs_sweep_margin,
+                                      sample=sample,
+                                      stage='gibbscluster_unsupervised',
+                                      input_size=len(peps)))
+        else:
             for groups in range(1, n_groups+1):
-                if self.mhc_class == 'I':
-                    command = f'{self.GIBBSCLUSTER} -f {fname} -P {groups}groups ' \
-                              f'-g {groups} -k 1 -T -j 2 -C -D 4 -I 1 -G'.split(' ')
-                else:
-                    command = f'{self.GIBBSCLUSTER} -f {fname} -P {groups}groups ' \
-                              f'-g {groups} -k 1 -T -j 2 -G'.split(' ')
-
-                job = Job(command=command,
-                          working_directory=self.tmp_folder/'gibbs'/sample/'unsupervised',
-                          id=f'gibbscluster_{groups}groups')
-                self.jobs.append(job)
+                job = Job(command=command(str(groups)),
+                          working_directory=working_directory,
+                          id=f'gibbscluster_{groups}groups',
+                          sample=sample,
+                          stage='gibbscluster_unsupervised',
+                          input_size=len(peps))
+                jobs.append(job)
+        return jobs
 
     def make_cluster_with_gibbscluster_by_allele_jobs(self):
-        os.chdir(self.tmp_folder)
-        for sample in self.samples:
-            alleles = self.sample_alleles[sample]
-            self.supervised_gibbs_directories[sample] = {}
-            sample_peps = self.binding_predictions.loc[self.binding_predictions['Sample'] == sample, :]
-            allele_peps = {}
-            for allele in alleles:
-                allele_peps[allele] = set(list(sample_peps.loc[(sample_peps['Allele'] == allele) &
-                                                               ((sample_peps['Binder'] == 'Strong') |
-                                                                (sample_peps['Binder'] == 'Weak')), 'Peptide'].unique()))
+        self.restore_artifacts()
+        for sample, sample_peps in self.iter_sample_binding_predictions():
+            if sample in self.reused_samples:
+                continue
+            self.jobs += self._gibbscluster_by_allele_jobs(sample, sample_peps)
 
-            allele_peps['unannotated'] = set(list(sample_peps['Peptide']))
-            for allele in alleles:
-                allele_peps['unannotated'] = allele_peps['unannotated'] - allele_peps[allele]
-
-            for allele, peps in allele_peps.items():
-                fname = Path(self.tmp_folder, f"{allele}_{sample}_forgibbs.csv")
-
-                peps = np.array(list(allele_peps[allele]))
-                if len(peps) < 20:
-                    self.not_enough_peptides.append(f'{allele}_{sample}')
-                else:
-                    lengths = np.vectorize(len)(peps)
-                    peps = peps[(lengths >= self.min_length) & (lengths <= self.max_length)]
-
-                    peps.tofile(str(fname), '\n', '%s')
-
-                    # if we are in windows, convert the filepath to the WSL path
-                    if platform.system().lower() == 'windows':
-                        fname = convert_win_2_wsl_path(fname)
-
-                    n_groups = 2 if allele == 'unannotated' else 1
-                    for g in range(1, n_groups+1):
-                        if self.mhc_class == 'I':
-                            if 'kb' in allele.lower():
-                                length = 8
-                            else:
-                                length = 9
-                            command = f'{self.GIBBSCLUSTER} -f {fname} -P {g}groups ' \
-                                      f'-l {str(length)} -g {g} -k 1 -T -j 2 -C -D 4 -I 1 -G'.split(' ')
+    def _gibbscluster_by_allele_jobs(self, sample: str, sample_peps: pd.DataFrame) -> List[Job]:
+        """
+        Make the allele-specific GibbsCluster jobs of a sample.
+        :param sample: The sample
+        :param sample_peps: The binding predictions of the sample (see _join_binding_predictions)
+        :return: List of jobs
+        """
+        jobs = []
+        alleles = self.sample_alleles[sample]
+        self.supervised_gibbs_directories[sample] = {}
+        allele_peps = {}
+        for allele in alleles:
+            allele_peps[allele] = set(list(sample_peps.loc[(sample_peps['Allele'] == allele) &
+                                                           ((sample_peps['Binder'] == 'Strong') |
+                                                            (sample_peps['Binder'] == 'Weak')), 'Peptide'].unique()))
+
+        allele_peps['unannotated'] = set(list(sample_peps['Peptide']))
+        for allele in alleles:
+            allele_peps['unannotated'] = allele_peps['unannotated'] - allele_peps[allele]
+
+        for allele, peps in allele_peps.items():
+            fname = Path(self.tmp_folder, f"{allele}_{sample}_forgibbs.csv")
+
+            peps = np.array(list(allele_peps[allele]))
+            if len(peps) < 20:
+                self.not_enough_peptides.append(f'{allele}_{sample}')
+            else:
+                lengths = np.vectorize(len)(peps)
+                peps = peps[(lengths >= self.min_length) & (lengths <= self.max_length)]
+
+                peps.tofile(str(fname), '\n', '%s')
+
+                # if we are in windows, convert the filepath to the WSL path
+                if platform.system().lower() == 'windows':
+                    fname = convert_win_2_wsl_path(fname)
+
+                n_groups = 2 if allele == 'unannotated' else 1
+                for g in range(1, n_groups+1):
+                    if self.mhc_class == 'I':
+                        if 'kb' in allele.lower():
+                            length = 8
                         else:
-                            command = f'{self.GIBBSCLUSTER} -f {fname} -P {g}groups ' \
-                                      f'-g {g} -k 1 -T -j 2 -G'.split(' ')
+                            length = 9
+                        command = f'{self.GIBBSCLUSTER} -f {fname} -P {g}groups ' \
+                                  f'-l {str(length)} -g {g} -k 1 -T -j 2 -C -D 4 -I 1 -G'.split(' ')
+                    else:
+                        command = f'{self.GIBBSCLUSTER} -f {fname} -P {g}groups ' \
+                                  f'-g {g} -k 1 -T -j 2 -G'.split(' ')
+
+                    job = Job(command=command,
+                              working_directory=self.tmp_folder/'gibbs'/sample/allele,
+                              id=f'gibbscluster_{g}groups',
+                              sample=sample,
+                              stage='gibbscluster_allele_specific',
+                              input_size=len(peps))
+                    jobs.append(job)
+        return jobs
+
+    def run_predictions_and_gibbscluster(self, progress: Callable[[str], None] = None):
+        """
+        Make the binding predictions and run GibbsCluster, starting each job as soon as its inputs are ready rather
+        than one step after another. The unsupervised GibbsCluster jobs do not depend on the predictions, so they
+        start right away and run alongside NetMHCpan. The allele-specific jobs of a sample start as soon as the
+        predictions for all of its alleles are done. The CPU scheduler keeps the total number of processes within
+        the CPU budget.
+        :param progress: (optional) A function which is called with "gibbscluster" when the predictions are done and
+        only GibbsCluster jobs are left.
+        :return: None
+        """
+        self.restore_artifacts()
+        futures = []
+        jobs = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            try:
+                unsupervised_jobs = []
+                for sample in self.samples:
+                    if sample not in self.reused_samples:
+                        unsupervised_jobs += self._gibbscluster_jobs(sample)
+                # longest runs (most groups) first
+                unsupervised_jobs.sort(key=lambda x: x.id, reverse=True)
+                jobs += unsupervised_jobs
+                futures += [executor.submit(run, job) for job in unsupervised_jobs]
+
+                def start_allele_jobs(sample: str, sample_peps: pd.DataFrame):
+                    if sample not in self.reused_samples:
+                        allele_jobs = self._gibbscluster_by_allele_jobs(sample, sample_peps)
+                        jobs.extend(allele_jobs)
+                        futures.extend(executor.submit(run, job) for job in allele_jobs)
 
-                        job = Job(command=command,
-                                  working_directory=self.tmp_folder/'gibbs'/sample/allele,
-                                  id=f'gibbscluster_{g}groups')
-                        self.jobs.append(job)
+                self.make_binding_predictions(on_sample_predicted=start_allele_jobs)
+                self.write_binding_predictions()
+            except BaseException:
+                # the executor waits for its jobs when it is shut down, so the GibbsCluster jobs are cancelled and
+                # stopped rather than finished before the error is raised
+                for future in futures:
+                    future.cancel()
+                for job in jobs:
+                    job.stop()
+                raise
+            if progress is not None:
+                progress('gibbscluster')
+            self.jobs = [future.result() for future in futures]
 
     def find_best_files(self):
         for sample in self.samples:
@@ -252,15 +551,15 @@ class MhcToolHelper:
                 best_n_motifs = 0
                 best_grouping_dir = ''
                 for grouping in sample_dirs:
-                    with open(grouping/'images'/'gibbs.KLDvsClusters.tab', 'r') as f:
-                        klds = np.array(f.readlines()[1].strip().split()[1:], dtype=float)
+                    # a directory holds several numbers of groups if GibbsCluster was run with a range (e.g. -g 1-6)
+                    for n_groups, klds in read_gibbs_klds(grouping).items():
                         score = np.sum(klds)
                         n_motifs = np.sum(klds != 0)
-                    if score > high_score:
-                        best_grouping = grouping.stem[0]
-                        best_grouping_dir = Path(grouping)
-                        high_score = score
-                        best_n_motifs = n_motifs
+                        if score > high_score:
+                            best_grouping = str(n_groups)
+                            best_grouping_dir = Path(grouping)
+                            high_score = score
+                            best_n_motifs = n_motifs
                 if best_grouping == '':
                     self.gibbs_files[sample][run] = None
                     continue
@@ -270,7 +569,7 @@ class MhcToolHelper:
                 self.gibbs_files[sample][run]['n_motifs'] = best_n_motifs
                 self.gibbs_files[sample][run]['cores'] = [x for x in
                                                                       list(Path(best_grouping_dir / 'cores').glob('*'))
-                                                                      if 'of' in x.name]
+                                                                      if x.name.endswith(f'of{best_grouping}.core')]
                 self.gibbs_files[sample][run]['pep_groups_file'] = best_grouping_dir/'res'/f'gibbs.{best_grouping}g.ds.out'
                 with open(best_grouping_dir/'res'/f'gibbs.{best_grouping}g.out', 'r') as f:
                     contents = f.read()
@@ -291,6 +590,20 @@ class MhcToolHelper:
                 self.gibbs_files[sample][allele]['pep_groups_file'] = \
                     self.gibbs_files[sample][allele]['directory'] / 'res' / f'gibbs.1g.ds.out'
 
+    def write_run_profile(self):
+        """
+        Write the time and resources used by every NetMHCpan/NetMHCIIpan and GibbsCluster process of the analysis,
+        and a summary by stage, to run_profile.json in the analysis directory.
+        :return: None
+        """
+        write_run_profile(self.run_profiles(), self.tmp_folder / 'run_profile.json')
+
+    def run_profiles(self) -> List[dict]:
+        """
+        :return: The profiles of all the NetMHCpan/NetMHCIIpan and GibbsCluster jobs run so far (see ProfiledJob.profile)
+        """
+        return self.job_profiles + [job.profile() for job in self.jobs]
+
     def order_gibbs_runs(self):
         self.jobs.sort(key=lambda x: x.id, reverse=True)
 
@@ -298,4 +611,6 @@ class MhcToolHelper:
         self.jobs = _run_multiple_processes(self.jobs, n_processes=int(self.Parameters.THREADS))
 
     def clear_jobs(self):
+        # keep the profiles of the jobs which were run for write_run_profile
+        self.job_profiles += [job.profile() for job in self.jobs if job.started is not None]
         self.jobs = []
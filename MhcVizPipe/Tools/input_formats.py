@@ -0,0 +1,185 @@
+"""
+Readers for the compressed and columnar files peptides can be loaded from, besides plain text:
+- gzip and zstd compressed text
+- Parquet and Arrow (IPC file/Feather v2 or IPC stream) tables, of which only the peptide column is read
+Formats are recognized by the first bytes of the files, not their names. zstd needs the zstandard package and
+Parquet/Arrow need pyarrow. They are optional: pip install MhcVizPipe[zstd] or MhcVizPipe[parquet]
+"""
+import gzip
+import io
+from importlib import import_module
+from os import PathLike
+from typing import Iterator, List, Union
+
+# the first bytes of each format
+MAGIC_NUMBERS = {'gzip': b'\x1f\x8b',
+                 'zstd': b'\x28\xb5\x2f\xfd',
+                 'parquet': b'PAR1',
+                 'arrow': b'ARROW1',
+                 'arrow_stream': b'\xff\xff\xff\xff'}
+COLUMNAR_FORMATS = ('parquet', 'arrow', 'arrow_stream')
+# the package needed for each format and the pip extra which installs it
+REQUIREMENTS = {'zstd': ('zstandard', 'zstd'),
+                'parquet': ('pyarrow', 'parquet'),
+                'arrow': ('pyarrow', 'parquet'),
+                'arrow_stream': ('pyarrow', 'parquet'),
+                'feather': ('pyarrow', 'parquet')}
+# number of rows read at a time from Parquet and Arrow files
+COLUMN_BATCH_SIZE = 2 ** 20
+
+
+def detect_format(data: bytes) -> str:
+    """
+    Detect the format of a file from its first bytes.
+    :param data: The first (at least 8) bytes of the file
+    :return: One of the MAGIC_NUMBERS keys, or "text"
+    """
+    for file_format, magic_number in MAGIC_NUMBERS.items():
+        if data.startswith(magic_number):
+            return file_format
+    return 'text'
+
+
+def file_format(filepath: Union[str, PathLike]) -> str:
+    """
+    Detect the format of a file, see detect_format.
+    """
+    with open(filepath, 'rb') as f:
+        return detect_format(f.read(8))
+
+
+def require(file_format: str):
+    """
+    Import the optional package needed to read or write a file format (see REQUIREMENTS).
+    :param file_format: The format, e.g. "zstd" or "parquet"
+    :return: The package
+    """
+    module, extra = REQUIREMENTS[file_format]
+    try:
+        return import_module(module)
+    except ImportError:
+        raise ImportError(f'{file_format.capitalize()} files require the {module} package. Install it with: '
+                          f'pip install {module} (or pip install MhcVizPipe[{extra}])') from None
+
+
+def open_text(filepath: Union[str, PathLike]):
+    """
+    Open a text file, which may be gzip or zstd compressed, for reading.
+    :param filepath: Path to the file
+    :return: A text file object. Newlines are not translated, as for the csv module.
+    """
+    compression = file_format(filepath)
+    if compression == 'gzip':
+        return gzip.open(filepath, 'rt', newline='')
+    if compression == 'zstd':
+        zstandard = require('zstd')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb')), newline='')
+    if compression in COLUMNAR_FORMATS:
+        raise ValueError(f'{filepath} is a {compression} file, not a text file.')
+    return open(filepath, 'r', newline='')
+
+
+def _open_table(source: Union[str, PathLike, bytes], table_format: str):
+    """
+    Open a Parquet or Arrow table without reading it. Files are memory-mapped, so only the parts of the file which
+    are used are read.
+    :return: A ParquetFile or an Arrow IPC reader
+    """
+    pa = require(table_format)
+    source = pa.py_buffer(source) if isinstance(source, bytes) else pa.memory_map(str(source))
+    if table_format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(source)
+    import pyarrow.ipc
+    if table_format == 'arrow':
+        return pyarrow.ipc.open_file(source)
+    return pyarrow.ipc.open_stream(source)
+
+
+def _record_batches(table, table_format: str, column: str):
+    """
+    Iterate over the record batches of a table. Only the given column is read from Parquet files, the other columns
+    of Arrow batches are left unused in the memory-mapped file.
+    """
+    if table_format == 'parquet':
+        yield from table.iter_batches(batch_size=COLUMN_BATCH_SIZE, columns=[column])
+    elif table_format == 'arrow':
+        for i in range(table.num_record_batches):
+            yield table.get_batch(i)
+    else:
+        yield from table
+
+
+def _schema(table, table_format: str):
+    return table.schema_arrow if table_format == 'parquet' else table.schema
+
+
+def _is_text(data_type) -> bool:
+    """
+    Check if a column holds text: string and large_string columns (written by pandas >= 3 and polars), and
+    dictionary-encoded (e.g. categorical) columns of either.
+    """
+    import pyarrow as pa
+    if pa.types.is_dictionary(data_type):
+        data_type = data_type.value_type
+    return pa.types.is_string(data_type) or pa.types.is_large_string(data_type)
+
+
+def iter_column(source: Union[str, PathLike, bytes],
+                column: str = None,
+                table_format: str = None) -> Iterator[List[str]]:
+    """
+    Read one column of a Parquet or Arrow table in batches of COLUMN_BATCH_SIZE rows. Only this column is read from
+    the file.
+    :param source: Path to the file, or its contents
+    :param column: The name of the column. Can be left out if the table only has one column.
+    :param table_format: (optional) "parquet", "arrow" or "arrow_stream". Detected from the file if not given.
+    :return: Iterator over lists of strings. Missing values are empty strings.
+    """
+    if table_format is None:
+        table_format = detect_format(source[:8]) if isinstance(source, bytes) else file_format(source)
+    table = _open_table(source, table_format)
+    names = _schema(table, table_format).names
+    if column is None:
+        if len(names) != 1:
+            raise ValueError(f'The table has several columns, the column containing the peptides must be given. '
+                             f'The columns are: {", ".join(names)}')
+        column = names[0]
+    if column not in names:
+        raise ValueError(f'The column "{column}" is not in the table. The columns are: {", ".join(names)}')
+
+    import pyarrow as pa
+    for batch in _record_batches(table, table_format, column):
+        values = batch.column(column)
+        if not pa.types.is_string(values.type):
+            values = values.cast(pa.string())
+        for offset in range(0, len(values), COLUMN_BATCH_SIZE):
+            yield values.slice(offset, COLUMN_BATCH_SIZE).fill_null('').to_pylist()
+
+
+def upload_to_text(data: bytes) -> str:
+    """
+    Convert the contents of an uploaded file to text. Compressed files are decompressed, and the text columns of
+    Parquet and Arrow tables are converted to a tab-delimited table (or a list of peptides if there is only one).
+    :param data: The contents of the file
+    :return: The text
+    """
+    upload_format = detect_format(data[:8])
+    if upload_format == 'gzip':
+        data = gzip.decompress(data)
+    elif upload_format == 'zstd':
+        zstandard = require('zstd')
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    elif upload_format in COLUMNAR_FORMATS:
+        import pyarrow as pa
+        table = _open_table(data, upload_format)
+        text_columns = [field.name for field in _schema(table, upload_format) if _is_text(field.type)]
+        if upload_format == 'parquet':
+            table = table.read(columns=text_columns)
+        else:
+            table = table.read_all().select(text_columns)
+        table = pa.table([column.cast(pa.string()) for column in table.columns], names=table.column_names)
+        # a single column is uploaded as a list of peptides, without its header. Several columns are uploaded as a
+        # table with a header, from which the peptide column is chosen.
+        return table.to_pandas().to_csv(sep='\t', index=False, header=len(text_columns) > 1)
+    return data.decode('utf-8')
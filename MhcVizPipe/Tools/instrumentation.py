@@ -0,0 +1,261 @@
+import cProfile
+import json
+import os
+import platform
+import pstats
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Union
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PROFILING_MODES = ['off', 'stages', 'cprofile']
+
+
+def wait_for_process(p: subprocess.Popen) -> dict:
+    """
+    Wait for a process to finish and get its resource usage. The process must not have been waited for already
+    (e.g. with Popen.wait or Popen.communicate). Popen.returncode is set.
+    :param p: The process
+    :return: Dictionary with user_time and system_time (seconds) and max_rss (bytes). The values are None if resource
+    usage is not available on this platform.
+    """
+    if not hasattr(os, 'wait4'):  # Windows
+        p.wait()
+        return {'user_time': None, 'system_time': None, 'max_rss': None}
+    while True:
+        try:
+            _, status, rusage = os.wait4(p.pid, 0)
+            break
+        except InterruptedError:
+            continue
+    p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+    return {'user_time': rusage.ru_utime, 'system_time': rusage.ru_stime, 'max_rss': max_rss}
+
+
+class ProfiledJob:
+    """
+    Base class for jobs which run external processes and record the time and resources they use. If a job runs more
+    than one process, the times are summed and the peak memory is the largest of the processes.
+    """
+    def __init__(self, stage: str = None, input_size: int = None):
+        self.stage = stage
+        self.input_size = input_size
+        self.started = None
+        self.finished = None
+        self.wall_time = 0.0
+        self.user_time = None
+        self.system_time = None
+        self.max_rss = None
+        self.n_processes = 0
+
+    def _record_usage(self, started: float, usage: dict):
+        if self.started is None:
+            self.started = started
+        self.finished = time.time()
+        self.wall_time += self.finished - started
+        self.n_processes += 1
+        for key in ['user_time', 'system_time']:
+            if usage[key] is not None:
+                setattr(self, key, (getattr(self, key) or 0.0) + usage[key])
+        if usage['max_rss'] is not None:
+            self.max_rss = max(self.max_rss or 0, usage['max_rss'])
+
+    def profile(self) -> dict:
+        """
+        :return: The recorded timing and resource usage of the job as a dictionary
+        """
+        command = self.command if isinstance(self.command, str) else ' '.join(str(x) for x in self.command)
+        return {'stage': self.stage,
+                'command': command,
+                'sample': self.sample,
+                'input_size': self.input_size,
+                'returncode': self.returncode,
+                'n_processes': self.n_processes,
+                'started': self.started,
+                'finished': self.finished,
+                'wall_time': self.wall_time,
+                'user_time': self.user_time,
+                'system_time': self.system_time,
+                'max_rss': self.max_rss}
+
+
+def summarize_job_profiles(profiles: List[dict]) -> dict:
+    """
+    Aggregate job profiles by stage.
+    :param profiles: List of job profiles (see ProfiledJob.profile)
+    :return: Dictionary of {stage: summary}. "elapsed" is the time from the start of the first job of the stage to the
+    end of the last one, while "wall_time", "user_time" and "system_time" are summed over the jobs.
+    """
+    stages = {}
+    for profile in profiles:
+        stages.setdefault(profile['stage'] or 'other', []).append(profile)
+    summary = {}
+    for stage, stage_profiles in stages.items():
+        started = [p['started'] for p in stage_profiles if p['started'] is not None]
+        finished = [p['finished'] for p in stage_profiles if p['finished'] is not None]
+
+        def total(key):
+            values = [p[key] for p in stage_profiles if p[key] is not None]
+            return sum(values) if values else None
+
+        max_rss = [p['max_rss'] for p in stage_profiles if p['max_rss'] is not None]
+        summary[stage] = {'n_jobs': len(stage_profiles),
+                          'n_failed': sum(p['returncode'] not in [0, None] for p in stage_profiles),
+                          'elapsed': max(finished) - min(started) if started and finished else None,
+                          'wall_time': total('wall_time'),
+                          'user_time': total('user_time'),
+                          'system_time': total('system_time'),
+                          'max_rss': max(max_rss) if max_rss else None,
+                          'input_size': total('input_size')}
+    return summary
+
+
+def write_run_profile(profiles: List[dict], fname: Union[str, Path]):
+    """
+    Write job profiles and their summary by stage to a JSON file.
+    :param profiles: List of job profiles (see ProfiledJob.profile)
+    :param fname: The file to write
+    :return: None
+    """
+    with open(fname, 'w') as f:
+        json.dump({'stages': summarize_job_profiles(profiles), 'jobs': profiles}, f, indent=2)
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class StageProfiler:
+    """
+    Times the stages of an analysis run in this process (e.g. the predictions, the report sections and the archives).
+    Stages can be nested, in which case they are named after their parents (e.g. "report/heatmaps"). In "cprofile"
+    mode, the Python profiler also runs during each stage. The Python profiles of nested stages are kept separately, so
+    the profile of a stage does not include its sub-stages. Only the thread which entered a stage is profiled. In "off"
+    mode nothing is recorded.
+    """
+    def __init__(self, mode: str = 'stages', n_functions: int = 25):
+        """
+        :param mode: One of "off", "stages" or "cprofile"
+        :param n_functions: The number of functions with the highest cumulative time to keep for each stage profiled
+        with cProfile
+        """
+        if mode not in PROFILING_MODES:
+            raise ValueError(f'mode must be one of {PROFILING_MODES}')
+        self.mode = mode
+        self.enabled = mode != 'off'
+        self.n_functions = n_functions
+        self.started = time.time()
+        self.stages = []
+        self._stack = []
+        self._cprofiles = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time everything run inside the context as a stage.
+        :param name: The name of the stage
+        """
+        if not self.enabled:
+            yield
+            return
+        parent = self._stack[-1] if self._stack else None
+        if parent is not None:
+            name = f'{parent["name"]}/{name}'
+            if parent['cprofile'] is not None:
+                parent['cprofile'].disable()
+        current = {'name': name, 'cprofile': cProfile.Profile() if self.mode == 'cprofile' else None}
+        self._stack.append(current)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        if current['cprofile'] is not None:
+            current['cprofile'].enable()
+        try:
+            yield
+        finally:
+            if current['cprofile'] is not None:
+                current['cprofile'].disable()
+                self._cprofiles.setdefault(name, []).append(current['cprofile'])
+            self.stages.append({'name': name,
+                                'wall_time': time.perf_counter() - wall_start,
+                                'cpu_time': time.process_time() - cpu_start,
+                                'max_rss': _peak_rss()})
+            self._stack.pop()
+            if parent is not None and parent['cprofile'] is not None:
+                parent['cprofile'].enable()
+
+    def summary(self) -> List[dict]:
+        """
+        :return: The stages in the order they started, with their wall time, CPU time (of the whole process, in
+        seconds) and the peak memory use of the process when they finished (bytes). Stages which ran more than once
+        are added up.
+        """
+        summary = {}
+        for record in self.stages:
+            if record['name'] not in summary:
+                summary[record['name']] = {'name': record['name'], 'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                                           'max_rss': None}
+            stage = summary[record['name']]
+            stage['calls'] += 1
+            stage['wall_time'] += record['wall_time']
+            stage['cpu_time'] += record['cpu_time']
+            if record['max_rss'] is not None:
+                stage['max_rss'] = max(stage['max_rss'] or 0, record['max_rss'])
+        # stages finish after their sub-stages, but should be listed before them
+        order = {}
+        for record in self.stages:
+            order.setdefault(record['name'].split('/')[0], len(order))
+        return sorted(summary.values(), key=lambda x: (order[x['name'].split('/')[0]], x['name'].count('/') > 0))
+
+    def _top_functions(self, name: str) -> List[dict]:
+        stats = pstats.Stats(*self._cprofiles[name]).stats
+        functions = sorted(stats.items(), key=lambda x: x[1][3], reverse=True)[:self.n_functions]
+        return [{'function': f'{func} ({fname}:{line})', 'calls': nc, 'total_time': tt, 'cumulative_time': ct}
+                for (fname, line, func), (cc, nc, tt, ct, callers) in functions]
+
+    def profile(self) -> dict:
+        """
+        :return: The stage timings, with the functions which took the most time in each stage if cProfile was used
+        """
+        from MhcVizPipe import __version__
+        stages = self.summary()
+        for stage in stages:
+            if stage['name'] in self._cprofiles:
+                stage['top_functions'] = self._top_functions(stage['name'])
+        return {'mhcvizpipe_version': __version__,
+                'python_version': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'mode': self.mode,
+                'started': self.started,
+                'stages': stages}
+
+    def write(self, directory: Union[str, Path]) -> List[Path]:
+        """
+        Write the profile to stage_profile.json in a directory. In "cprofile" mode, the Python profile of each stage
+        is also written to <stage>.prof, which can be opened with pstats or tools like snakeviz.
+        :param directory: The directory to write the files to. It is created if it does not exist.
+        :return: The files which were written
+        """
+        if not self.enabled:
+            return []
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        files = [directory / 'stage_profile.json']
+        with open(files[0], 'w') as f:
+            json.dump(self.profile(), f, indent=2)
+        for name, profiles in self._cprofiles.items():
+            files.append(directory / f'{name.replace("/", ".")}.prof')
+            pstats.Stats(*profiles).dump_stats(str(files[-1]))
+        return files
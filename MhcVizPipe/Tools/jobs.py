@@ -1,18 +1,25 @@
-from typing import Union, List, Tuple
+from typing import Union, List, Tuple, Dict
 import subprocess
+import tempfile
+import time
 from multiprocessing import Pool
-import os
 from pathlib import Path
 from datetime import datetime
+import numpy as np
+from MhcVizPipe.Tools.scheduler import get_scheduler
+from MhcVizPipe.Tools.instrumentation import ProfiledJob, wait_for_process
 
 
-class Job:
+class Job(ProfiledJob):
     def __init__(self,
                  command: Union[str, List[str]],
                  working_directory: Union[str, Path, None],
                  id: Union[str, None],
-                 sample=None):
-
+                 sample=None,
+                 weight: int = 1,
+                 stage: str = None,
+                 input_size: int = None):
+        super().__init__(stage=stage, input_size=input_size)
         self.command = command
         self.working_directory = working_directory
         self.id = id
@@ -22,16 +29,102 @@ class Job:
         self.stdout = ''
         self.stderr = ''
         self.sample = sample
+        self.weight = weight
+        self.stopped = False
+        self._process = None
 
-    def run(self):
-        if self.working_directory is not None:
-            os.chdir(self.working_directory)
+    def stop(self):
+        """
+        Stop the job: the process is terminated if it is running, and it is not started if it has not started yet.
+        Can be called from another thread than the one running the job.
+        """
+        self.stopped = True
+        process = self._process
+        if process is not None and process.poll() is None:
+            process.terminate()
 
+    def run(self):
         command = self.command.split(' ') if isinstance(self.command, str) else self.command
-        p = subprocess.Popen(command, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        self.stdout, self.stderr = p.communicate()
+        with get_scheduler().acquire(self.weight):
+            self._run(command)
         self.time_end = str(datetime.now()).replace(' ', '')
+
+    def _run(self, command: List[str]):
+        if self.stopped:
+            return
+        started = time.time()
+        # the output goes to temporary files rather than pipes so the process can be waited for directly, which
+        # gives its resource usage
+        with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+            p = subprocess.Popen(command, stderr=stderr, stdout=stdout, cwd=self.working_directory)
+            self._process = p
+            # in case the job was stopped while the process was starting
+            if self.stopped:
+                p.terminate()
+            usage = wait_for_process(p)
+            self._process = None
+            stdout.seek(0)
+            stderr.seek(0)
+            self.stdout, self.stderr = stdout.read(), stderr.read()
         self.returncode = p.returncode
+        self._record_usage(started, usage)
+
+
+def read_gibbs_klds(gibbs_directory: Union[str, Path]) -> Dict[int, np.ndarray]:
+    """
+    Read the KLD of each cluster from the output of a GibbsCluster run.
+    :param gibbs_directory: The output directory of the run
+    :return: Dictionary of {number of groups: array of cluster KLDs}. There is one entry per number of groups run
+    (i.e. more than one if GibbsCluster was run with a range of groups, e.g. -g 1-6).
+    """
+    klds = {}
+    with open(Path(gibbs_directory)/'images'/'gibbs.KLDvsClusters.tab', 'r') as f:
+        for line in f.readlines()[1:]:
+            line = line.strip().split()
+            if len(line) < 2:
+                continue
+            klds[int(line[0])] = np.array(line[1:], dtype=float)
+    return klds
+
+
+class GibbsSweepJob(Job):
+    """
+    Runs GibbsCluster for an increasing number of groups, one command at a time, and stops once the summed KLD of
+    the clusters improves by less than `margin` (relative to the best so far) from one number of groups to the next.
+    """
+    def __init__(self,
+                 commands: List[List[str]],
+                 working_directory: Union[str, Path],
+                 id: Union[str, None],
+                 margin: float = 0.05,
+                 sample=None,
+                 weight: int = 1,
+                 stage: str = None,
+                 input_size: int = None):
+        super().__init__(command=commands[0], working_directory=working_directory, id=id, sample=sample,
+                         weight=weight, stage=stage, input_size=input_size)
+        self.commands = commands
+        self.margin = margin
+        self.n_runs = 0
+
+    def run(self):
+        best_score = None
+        for command in self.commands:
+            existing = set(Path(self.working_directory).iterdir())
+            self.command = command
+            with get_scheduler().acquire(self.weight):
+                self._run(command)
+            if self.stopped:
+                break
+            self.n_runs += 1
+            new_directories = [x for x in Path(self.working_directory).iterdir() if x not in existing and x.is_dir()]
+            if self.returncode != 0 or len(new_directories) != 1:
+                break
+            score = np.sum([np.sum(k) for k in read_gibbs_klds(new_directories[0]).values()])
+            if best_score is not None and score <= best_score * (1 + self.margin):
+                break
+            best_score = score if best_score is None else max(score, best_score)
+        self.time_end = str(datetime.now()).replace(' ', '')
 
 
 def run(job: Job):
@@ -40,7 +133,8 @@ def run(job: Job):
 
 
 def _run_multiple_processes(jobs: List[Job], n_processes: int):
+    # hand out jobs one at a time as workers become free, in the order they are given
     pool = Pool(n_processes)
-    returns = pool.map(run, jobs)
+    returns = list(pool.imap_unordered(run, jobs, chunksize=1))
     pool.close()
     return returns
@@ -2,32 +2,127 @@ from pathlib import Path
 from typing import List, Union
 import re
 import os
-import random
+import heapq
+from array import array
 from itertools import islice
 from datetime import datetime
 import subprocess
+import time
 from multiprocessing import Pool
 from uuid import uuid4
-import pandas as pd
 import tempfile
 import platform
-from MhcVizPipe.Tools.utils import convert_win_2_wsl_path
+from MhcVizPipe.Tools.utils import convert_win_2_wsl_path, clean_peptide_batch
+from MhcVizPipe.Tools.prediction_cache import PredictionCache, tool_fingerprint
+from MhcVizPipe.Tools.prediction_table import PredictionTable
+from MhcVizPipe.Tools.scheduler import get_scheduler
+from MhcVizPipe.Tools.instrumentation import ProfiledJob, wait_for_process
 
 common_aa = "ARNDCQEGHILKMFPSTWYV"
+_UNCOMMON_AA = re.compile(f'[^{common_aa}]')
 TMP_DIR = str(Path(tempfile.gettempdir(), 'pynetmhcpan').expanduser())
 
 
+BINDER_LABELS = ('Non-binder', 'Weak', 'Strong')
+
+
 def chunk_list(it, size):
     it = iter(it)
     return iter(lambda: tuple(islice(it, size)), ())
 
 
-class Job:
+class NetMHCOutputParser:
+    """
+    Incrementally parses NetMHCpan or NetMHCIIpan output, one line at a time, into compact typed arrays. Lines which
+    are not predictions (headers, comments, messages) are kept in self.log.
+    """
+    def __init__(self, mhc_class: str = 'I'):
+        self.mhc_class = mhc_class
+        if mhc_class == 'I':
+            self.allele_idx = 1
+            self.peptide_idx = 2
+            self.el_score_idx = 11
+            self.el_rank_idx = 12
+            self.aff_score_idx = 13
+            self.aff_rank_idx = 14
+            self.aff_nM_idx = 15
+            self.strong_cutoff = 0.5
+            self.weak_cutoff = 2.0
+        else:
+            self.allele_idx = 1
+            self.peptide_idx = 2
+            self.el_score_idx = 7
+            self.el_rank_idx = 8
+            self.aff_score_idx = 10
+            self.aff_nM_idx = 11
+            self.aff_rank_idx = 12
+            self.strong_cutoff = 2.0
+            self.weak_cutoff = 10.0
+        self.alleles: List[str] = []
+        self._allele_codes = {}
+        self.peptides: List[str] = []
+        self.allele = array('H')
+        self.el_score = array('d')
+        self.el_rank = array('d')
+        self.aff_score = array('d')
+        self.aff_rank = array('d')
+        self.aff_nM = array('d')
+        self.binder = array('b')  # index into BINDER_LABELS
+        self.log: List[str] = []
+
+    def __len__(self):
+        return len(self.peptides)
+
+    def feed(self, line: str):
+        fields = line.split()
+        if not fields or fields[0] == '#' or not fields[0].isnumeric():
+            if line.strip():
+                self.log.append(line.rstrip('\n'))
+            return
+        allele = fields[self.allele_idx].replace('*', '')
+        if allele not in self._allele_codes:
+            self._allele_codes[allele] = len(self.alleles)
+            self.alleles.append(allele)
+        el_rank = float(fields[self.el_rank_idx])
+        if el_rank <= self.strong_cutoff:
+            binder = 2
+        elif el_rank <= self.weak_cutoff:
+            binder = 1
+        else:
+            binder = 0
+        self.peptides.append(fields[self.peptide_idx])
+        self.allele.append(self._allele_codes[allele])
+        self.el_score.append(float(fields[self.el_score_idx]))
+        self.el_rank.append(el_rank)
+        self.aff_score.append(float(fields[self.aff_score_idx]))
+        self.aff_rank.append(float(fields[self.aff_rank_idx]))
+        self.aff_nM.append(float(fields[self.aff_nM_idx]))
+        self.binder.append(binder)
+
+    def records(self):
+        """
+        Iterate over the parsed predictions.
+        :return: Generator of (peptide, allele, {field: value})
+        """
+        for i in range(len(self.peptides)):
+            yield self.peptides[i], self.alleles[self.allele[i]], {'el_rank': self.el_rank[i],
+                                                                   'el_score': self.el_score[i],
+                                                                   'aff_rank': self.aff_rank[i],
+                                                                   'aff_score': self.aff_score[i],
+                                                                   'aff_nM': self.aff_nM[i],
+                                                                   'binder': BINDER_LABELS[self.binder[i]]}
+
+
+class Job(ProfiledJob):
     def __init__(self,
                  command: Union[str, List[str]],
                  working_directory: Union[str, Path, None],
-                 sample=None):
-
+                 sample=None,
+                 peptides=None,
+                 parser: NetMHCOutputParser = None,
+                 weight: int = 1,
+                 stage: str = None):
+        super().__init__(stage=stage, input_size=len(peptides) if peptides is not None else None)
         self.command = command
         self.working_directory = working_directory
         self.returncode = None
@@ -36,16 +131,40 @@ class Job:
         self.stdout: bytes = b''
         self.stderr: bytes = b''
         self.sample = sample
+        self.weight = weight
+        self.peptides = peptides if peptides is not None else []
+        self.parser = parser
 
     def run(self):
-        if self.working_directory is not None:
-            os.chdir(self.working_directory)
-
         command = self.command.split(' ') if isinstance(self.command, str) else self.command
-        p = subprocess.Popen(command, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        self.stdout, self.stderr = p.communicate()
+        with get_scheduler().acquire(self.weight):
+            self._run(command)
         self.time_end = str(datetime.now()).replace(' ', '')
+
+    def _run(self, command: List[str]):
+        started = time.time()
+        if self.parser is None:
+            with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+                p = subprocess.Popen(command, stderr=stderr, stdout=stdout, cwd=self.working_directory)
+                usage = wait_for_process(p)
+                stdout.seek(0)
+                stderr.seek(0)
+                self.stdout, self.stderr = stdout.read(), stderr.read()
+        else:
+            # parse the output as it is produced rather than holding all of it in memory. Only the lines which are
+            # not predictions are kept in self.stdout
+            with tempfile.TemporaryFile() as stderr:
+                p = subprocess.Popen(command, stderr=stderr, stdout=subprocess.PIPE, universal_newlines=True,
+                                     cwd=self.working_directory)
+                for line in p.stdout:
+                    self.parser.feed(line)
+                p.stdout.close()
+                usage = wait_for_process(p)
+                stderr.seek(0)
+                self.stderr = stderr.read()
+            self.stdout = '\n'.join(self.parser.log).encode()
         self.returncode = p.returncode
+        self._record_usage(started, usage)
 
 
 def run(job: Job):
@@ -54,12 +173,59 @@ def run(job: Job):
 
 
 def _run_multiple_processes(jobs: List[Job], n_processes: int):
+    # jobs are handed out one at a time as workers become free, so the jobs should be ordered from most to least
+    # expensive to keep all the workers busy until the end
     pool = Pool(n_processes)
-    returns = pool.map(run, jobs)
+    returns = list(pool.imap_unordered(run, jobs, chunksize=1))
     pool.close()
     return returns
 
 
+def estimate_peptide_cost(peptide: str, mhc_class: str) -> float:
+    """
+    Estimate the relative cost of predicting one peptide. NetMHCpan tries insertions and deletions to fit longer
+    peptides to the 9-mer binding core and NetMHCIIpan scans every 9-mer core of the peptide, so in both cases
+    longer peptides take longer to predict.
+    :param peptide: The peptide sequence
+    :param mhc_class: I or II
+    :return: The relative cost (a 9-mer peptide has a cost of 1)
+    """
+    if mhc_class == 'I':
+        return 1.0 + 0.5 * abs(len(peptide) - 9)
+    else:
+        return float(max(1, len(peptide) - 8))
+
+
+def make_work_units(peptides: List[str],
+                    mhc_class: str,
+                    n_threads: int,
+                    units_per_thread: int = 4,
+                    min_unit_size: int = 50) -> List[List[str]]:
+    """
+    Split peptides into work units of approximately equal estimated cost. There are several units per thread so
+    that units can be handed out dynamically as workers become free, and the number of units is always a multiple of
+    the number of threads so that no worker is left idle during the last round. Peptides are assigned to units greedily
+    from the most to the least expensive (longest processing time first), so each unit gets a mix of peptide lengths.
+    :param peptides: The peptides to split
+    :param mhc_class: I or II
+    :param n_threads: The number of worker processes
+    :param units_per_thread: The number of work units to make per worker process
+    :param min_unit_size: The minimum number of peptides in a work unit
+    :return: List of work units, ordered from the most to the least expensive
+    """
+    units_per_thread = max(1, min(units_per_thread, len(peptides) // (min_unit_size * n_threads)))
+    n_units = n_threads * units_per_thread
+    units = [[] for _ in range(n_units)]
+    heap = [(0.0, i) for i in range(n_units)]
+    costs = {pep: estimate_peptide_cost(pep, mhc_class) for pep in peptides}
+    for pep in sorted(peptides, key=lambda x: costs[x], reverse=True):
+        unit_cost, i = heapq.heappop(heap)
+        units[i].append(pep)
+        heapq.heappush(heap, (unit_cost + costs[pep], i))
+    unit_costs = {i: cost for cost, i in heap}
+    return [units[i] for i in sorted(unit_costs, key=lambda i: unit_costs[i], reverse=True) if units[i]]
+
+
 def remove_modifications(peptides: Union[List[str], str]):
     if isinstance(peptides, str):
         return ''.join(re.findall('[a-zA-Z]+', peptides))
@@ -86,11 +252,7 @@ def remove_previous_and_next_aa(peptides: Union[List[str], str]):
 
 
 def replace_uncommon_aas(peptide):
-    pep = peptide
-    for aa in peptide:
-        if aa not in common_aa:
-            pep = pep.replace(aa, 'X')
-    return pep
+    return _UNCOMMON_AA.sub('X', peptide)
 
 
 def create_netmhcpan_peptide_index(peptide_list):
@@ -121,9 +283,11 @@ class NetMHCpanHelper:
                  netmhcpan='netMHCpan',
                  netmhc2pan='netMHCIIpan',
                  min_length=8,
-                 max_length=12):
+                 max_length=12,
+                 cache: PredictionCache = None):
         """
         Helper class to run NetMHCpan on multiple CPUs from Python. Can annotated a file with peptides in it.
+        If a PredictionCache is given, only peptides which are not already in the cache are sent to NetMHCpan.
         """
 
         self.NETMHCPAN = netmhcpan
@@ -138,16 +302,17 @@ class NetMHCpanHelper:
                 alleles = [alleles]
         self.alleles = alleles
         self.peptides = []
-
-        # keep only peptides with acceptable lengths
-        peptides = [x for x in peptides if min_length <= len(x) <= max_length]
+        self.min_length = min_length
+        self.max_length = max_length
+        self.rejected_peptides = {}
 
         if peptides is not None:
             self.add_peptides(peptides)
             self.netmhcpan_peptides = create_netmhcpan_peptide_index(self.peptides)
         else:
             self.netmhcpan_peptides = dict()
-        self.predictions = {x: {} for x in self.peptides}
+        self.predictions = PredictionTable()
+        self._prediction_parts: List[PredictionTable] = []
         self.wd = Path(output_dir) if output_dir else Path(os.getcwd())
         self.temp_dir = Path(tmp_dir) / 'PyNetMHCpan'
         if self.wd and not self.wd.exists():
@@ -161,18 +326,31 @@ class NetMHCpanHelper:
         else:
             self.n_threads = n_threads
         self.jobs = []
+        self.job_profiles = []
         # self.add_peptides(peptides)
         self.mhc_class: str = mhc_class
+        self.cache = cache
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.tool_fingerprint = tool_fingerprint(self.NETMHCPAN if mhc_class == 'I' else self.NETMHCIIPAN)
+        self.prediction_mode = f'class_{mhc_class}-BA'
 
     def add_peptides(self, peptides: List[str]):
+        """
+        Clean the peptides and add the ones with acceptable lengths. Peptides with uncommon amino acids are kept, they
+        are given to NetMHCpan with X in place of the uncommon amino acids. The number of peptides rejected for each
+        reason is added to self.rejected_peptides.
+        """
         if not self.peptides:
             self.peptides = []
-        peptides = remove_previous_and_next_aa(peptides)
-        peptides = remove_modifications(peptides)
+        peptides, rejected = clean_peptide_batch(peptides, self.min_length, self.max_length, keep_uncommon=True)
+        for reason, n in rejected.items():
+            self.rejected_peptides[reason] = self.rejected_peptides.get(reason, 0) + n
 
         self.peptides += peptides
         self.netmhcpan_peptides = create_netmhcpan_peptide_index(self.peptides)
-        self.predictions = {pep: {} for pep in self.peptides}
+        self.predictions = PredictionTable()
+        self._prediction_parts = []
 
     def _make_binding_prediction_jobs(self):
         if not self.peptides:
@@ -186,10 +364,14 @@ class NetMHCpanHelper:
         else:
             peptides = self.peptides
         peptides = list(set(peptides))  # remove any duplicate sequences
-        random.shuffle(peptides)  # we need to shuffle them so we don't end up with files filled with peptide lengths that take a LONG time to compute (this actually is a very significant speed up)
-
+        if self.cache is not None:
+            peptides = self._get_cached_predictions(peptides)
+            if len(peptides) == 0:
+                return
+        # split the peptides into many work units of similar cost (estimated from peptide length) so that long
+        # peptides, which take a LONG time to compute, are spread evenly and all the workers finish together
         if len(peptides) > 100:
-            chunks = chunk_list(peptides, int(len(peptides)/self.n_threads))
+            chunks = make_work_units(peptides, self.mhc_class, self.n_threads)
         else:
             chunks = [peptides]
         job_number = 1
@@ -214,11 +396,43 @@ class NetMHCpanHelper:
                 command = f'{self.NETMHCIIPAN} -inptype 1 -f {fname} -a {",".join(self.alleles)} -BA'.split(' ')
 
             job = Job(command=command,
-                      working_directory=self.temp_dir)
+                      working_directory=self.temp_dir,
+                      peptides=chunk,
+                      parser=NetMHCOutputParser(self.mhc_class),
+                      stage='netmhcpan' if self.mhc_class == 'I' else 'netmhciipan')
             self.jobs.append(job)
             job_number += 1
 
+    def _get_cached_predictions(self, peptides: List[str]) -> List[str]:
+        """
+        Add any predictions found in the cache to the predictions.
+        :param peptides: The (NetMHCpan-formatted) peptides to be predicted
+        :return: The peptides which need to be predicted, i.e. those not in the cache for all alleles
+        """
+        cached = {allele: self.cache.lookup(self.tool_fingerprint, self.prediction_mode, allele, peptides)
+                  for allele in self.alleles}
+        to_predict = []
+        found = []
+        for pep in peptides:
+            if all(pep in cached[allele] for allele in self.alleles):
+                found.append(pep)
+            else:
+                to_predict.append(pep)
+        self._prediction_parts.append(
+            PredictionTable.from_records((pep, allele, cached[allele][pep]) for allele in self.alleles for pep in found)
+        )
+        self.cache_hits = len(found)
+        self.cache_misses = len(to_predict)
+        print(f'Prediction cache: {self.cache_hits} peptides found, {self.cache_misses} peptides to predict')
+        return to_predict
+
+    def _store_predictions_in_cache(self):
+        for job in self.jobs:
+            self.cache.store(self.tool_fingerprint, self.prediction_mode, job.parser.records())
+
     def _run_jobs(self):
+        if not self.jobs:
+            return
         self.jobs = _run_multiple_processes(self.jobs, n_processes=self.n_threads)
         for job in self.jobs:
             if job.returncode != 0:
@@ -238,58 +452,18 @@ class NetMHCpanHelper:
                 raise ChildProcessError('ERROR: There was a problem in NetMHCpan. '
                                         'See the above output for possible information.')
 
-            self._parse_netmhc_output(job.stdout.decode())
+            self._add_parsed_predictions(job.parser)
 
         #self.predictions.to_csv(str(Path(self.temp_dir) / f'netMHCpan_predictions.csv'))
 
-    def _parse_netmhc_output(self, stdout: str):
-        lines = stdout.split('\n')
-        if self.mhc_class == 'I':
-            allele_idx = 1
-            peptide_idx = 2
-            el_score_idx = 11
-            el_rank_idx = 12
-            aff_score_idx = 13
-            aff_rank_idx = 14
-            aff_nM_idx = 15
-            strong_cutoff = 0.5
-            weak_cutoff = 2.0
-        else:
-            allele_idx = 1
-            peptide_idx = 2
-            el_score_idx = 7
-            el_rank_idx = 8
-            aff_score_idx = 10
-            aff_nM_idx = 11
-            aff_rank_idx = 12
-            strong_cutoff = 2.0
-            weak_cutoff = 10.0
-        for line in lines:
-            line = line.strip()
-            line = line.split()
-            if not line or line[0] == '#' or not line[0].isnumeric():
-                continue
-            allele = line[allele_idx].replace('*', '')
-            peptide = line[peptide_idx]
-            el_rank = float(line[el_rank_idx])
-            el_score = float(line[el_score_idx])
-            aff_rank = float(line[aff_rank_idx])
-            aff_score = float(line[aff_score_idx])
-            aff_nM  = float(line[aff_nM_idx])
-
-            if float(el_rank) <= strong_cutoff:
-                binder = 'Strong'
-            elif float(el_rank) <= weak_cutoff:
-                binder = 'Weak'
-            else:
-                binder = 'Non-binder'
+    def _add_parsed_predictions(self, parser: NetMHCOutputParser):
+        self._prediction_parts.append(PredictionTable.from_parser(parser))
 
-            self.predictions[peptide][allele] = {'el_rank': el_rank,
-                                                 'el_score': el_score,
-                                                 'aff_rank': aff_rank,
-                                                 'aff_score': aff_score,
-                                                 'aff_nM': aff_nM,
-                                                 'binder': binder}
+    def _parse_netmhc_output(self, stdout: str):
+        parser = NetMHCOutputParser(self.mhc_class)
+        for line in stdout.split('\n'):
+            parser.feed(line)
+        self._add_parsed_predictions(parser)
 
     def make_predictions(self):
         self.temp_dir = self.temp_dir / str(uuid4())
@@ -297,48 +471,41 @@ class NetMHCpanHelper:
         self._make_binding_prediction_jobs()
         self._run_jobs()
         self._aggregate_netmhcpan_results()
+        if self.cache is not None:
+            self._store_predictions_in_cache()
+        self.predictions = PredictionTable.concat(self._prediction_parts)
+        self._prediction_parts = []
+        self.job_profiles += [job.profile() for job in self.jobs]
         self._clear_jobs()
 
-    def predict_df(self):
+    def predict_table(self) -> PredictionTable:
+        """
+        Make predictions for all peptides and alleles.
+        :return: A PredictionTable containing the original peptide sequences
+        """
         self.make_predictions()
-        df_columns = ['Peptide', 'Allele', 'EL_score', 'EL_Rank', 'Aff_Score', 'Aff_Rank', 'Aff_nM', 'Binder']
-        data = []
-        for allele in self.alleles:
-            for pep in self.peptides:
-                netmhc_pep = self.netmhcpan_peptides[pep]
-                data.append([pep,
-                             allele,
-                             self.predictions[netmhc_pep][allele]['el_score'],
-                             self.predictions[netmhc_pep][allele]['el_rank'],
-                             self.predictions[netmhc_pep][allele]['aff_score'],
-                             self.predictions[netmhc_pep][allele]['aff_rank'],
-                             self.predictions[netmhc_pep][allele]['aff_nM'],
-                             self.predictions[netmhc_pep][allele]['binder']])
-        df = pd.DataFrame(data=data, columns=df_columns)
-        if not self.check_prediction_peptides(list(df['Peptide'])):
+        table = self.predictions.map_peptides(self.netmhcpan_peptides)
+        if not self.check_prediction_peptides(table.peptides):
             raise RuntimeError("Not all peptides were present in one or more of the NetMHCpan predictions. Check "
                                "the terminal window (console, command prompt, PowerShell, etc.) for any error "
                                "messages.")
-        return df
+        return table
+
+    def predict_df(self):
+        df_columns = ['Peptide', 'Allele', 'EL_score', 'EL_Rank', 'Aff_Score', 'Aff_Rank', 'Aff_nM', 'Binder']
+        df = self.predict_table().frame[df_columns]
+        return df.astype({'Peptide': str, 'Allele': str, 'Binder': str})
 
     def predict_dict(self):
-        self.make_predictions()
-        predictions = {}
-        for pep in self.peptides:
-            predictions[pep] = {}
-            for allele in self.alleles:
-                predictions[pep][allele] = {}
-                netmhc_pep = self.netmhcpan_peptides[pep]
-                predictions[pep][allele]['EL_score'] = self.predictions[netmhc_pep][allele]['el_score']
-                predictions[pep][allele]['EL_Rank'] = self.predictions[netmhc_pep][allele]['el_rank']
-                predictions[pep][allele]['Aff_Score'] = self.predictions[netmhc_pep][allele]['aff_score']
-                predictions[pep][allele]['Aff_Rank'] = self.predictions[netmhc_pep][allele]['aff_rank']
-                predictions[pep][allele]['Aff_nM'] = self.predictions[netmhc_pep][allele]['aff_nM']
-                predictions[pep][allele]['Binder'] = self.predictions[netmhc_pep][allele]['binder']
-        if not self.check_prediction_peptides(list(predictions.keys())):
-            raise RuntimeError("Not all peptides were present in one or more of the NetMHCpan predictions. Check "
-                               "the terminal window (console, command prompt, PowerShell, etc.) for any error "
-                               "messages.")
+        df = self.predict_df()
+        predictions = {pep: {} for pep in self.peptides}
+        for row in df.itertuples(index=False):
+            predictions[row.Peptide][row.Allele] = {'EL_score': row.EL_score,
+                                                    'EL_Rank': row.EL_Rank,
+                                                    'Aff_Score': row.Aff_Score,
+                                                    'Aff_Rank': row.Aff_Rank,
+                                                    'Aff_nM': row.Aff_nM,
+                                                    'Binder': row.Binder}
         return predictions
 
     def check_prediction_peptides(self, prediction_peptides: List[str]) -> bool:
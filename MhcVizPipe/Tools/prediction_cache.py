@@ -0,0 +1,103 @@
+import os
+import shutil
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, Tuple, Union
+
+# the fields stored for each (tool, mode, allele, peptide). These are the keys used in NetMHCpanHelper.predictions
+PREDICTION_FIELDS = ['el_score', 'el_rank', 'aff_score', 'aff_rank', 'aff_nM', 'binder']
+
+# sqlite has a limit on the number of variables in a single statement, so lookups are done in batches
+_LOOKUP_BATCH_SIZE = 500
+
+
+def tool_fingerprint(executable: str) -> str:
+    """
+    Create a string identifying a specific installation of a prediction tool. The resolved path, size and
+    modification time of the executable are used so that cached predictions are never shared between different
+    versions (or installations) of a tool.
+    :param executable: The command used to call the tool (e.g. netMHCpan, or "wsl /mnt/c/.../netMHCpan4.1")
+    :return: The fingerprint as a string
+    """
+    parts = executable.split(' ')
+    fingerprint = [executable]
+    for part in parts:
+        path = shutil.which(part) or part
+        if Path(path).is_file():
+            path = os.path.realpath(path)
+            stat = os.stat(path)
+            fingerprint += [path, str(stat.st_size), str(stat.st_mtime_ns)]
+    return '|'.join(fingerprint)
+
+
+class PredictionCache:
+    """
+    A persistent on-disk cache of binding predictions. Predictions are keyed on the tool fingerprint (see
+    tool_fingerprint), the prediction mode (e.g. class and -BA), the allele and the peptide. The cache is an SQLite
+    database, so it can safely be shared by several analyses running at the same time.
+    """
+    def __init__(self, location: Union[str, Path]):
+        self.location = Path(location)
+        if not self.location.parent.exists():
+            self.location.parent.mkdir(parents=True)
+        self.hits = 0
+        self.misses = 0
+        with self._connect() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS predictions ('
+                        'tool TEXT, mode TEXT, allele TEXT, peptide TEXT, '
+                        'el_score REAL, el_rank REAL, aff_score REAL, aff_rank REAL, aff_nM REAL, binder TEXT, '
+                        'PRIMARY KEY (tool, mode, allele, peptide)) WITHOUT ROWID')
+
+    def _connect(self):
+        return sqlite3.connect(str(self.location), timeout=60)
+
+    def lookup(self, tool: str, mode: str, allele: str, peptides: Iterable[str]) -> Dict[str, dict]:
+        """
+        Look up cached predictions for a list of peptides.
+        :param tool: The tool fingerprint
+        :param mode: The prediction mode
+        :param allele: The allele
+        :param peptides: The peptides to look up
+        :return: A dictionary of {peptide: {field: value}} for the peptides found in the cache
+        """
+        peptides = list(peptides)
+        found = {}
+        con = self._connect()
+        try:
+            for i in range(0, len(peptides), _LOOKUP_BATCH_SIZE):
+                batch = peptides[i:i + _LOOKUP_BATCH_SIZE]
+                rows = con.execute(f'SELECT peptide, {", ".join(PREDICTION_FIELDS)} FROM predictions '
+                                   f'WHERE tool = ? AND mode = ? AND allele = ? '
+                                   f'AND peptide IN ({", ".join("?" * len(batch))})',
+                                   [tool, mode, allele] + batch)
+                for row in rows:
+                    found[row[0]] = dict(zip(PREDICTION_FIELDS, row[1:]))
+        finally:
+            con.close()
+        self.hits += len(found)
+        self.misses += len(set(peptides)) - len(found)
+        return found
+
+    def store(self, tool: str, mode: str, records: Iterable[Tuple[str, str, Dict[str, object]]]):
+        """
+        Store predictions in the cache.
+        :param tool: The tool fingerprint
+        :param mode: The prediction mode
+        :param records: (peptide, allele, {field: value}) records, e.g. from NetMHCOutputParser.records
+        :return: None
+        """
+        rows = [[tool, mode, allele, peptide] + [values[field] for field in PREDICTION_FIELDS]
+                for peptide, allele, values in records]
+        if not rows:
+            return
+        with self._connect() as con:
+            con.executemany(f'INSERT OR REPLACE INTO predictions VALUES ({", ".join("?" * 10)})', rows)
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        with self._connect() as con:
+            con.execute('DELETE FROM predictions')
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,134 @@
+import json
+from pathlib import Path
+from typing import Iterable, List, Union
+import numpy as np
+import pandas as pd
+from MhcVizPipe.Tools.prediction_table import PredictionTable, PREDICTION_COLUMNS, SCORE_COLUMNS, BINDER_CATEGORIES
+
+# the scores of each allele are stored in one record per peptide. Peptides which were not predicted for the allele
+# have a binder code of -1.
+SCORE_DTYPE = np.dtype([(column, np.float32) for column in SCORE_COLUMNS] + [('Binder', np.int8)])
+INDEX_VERSION = 1
+
+
+class PredictionIndex:
+    """
+    A read-only, memory-mapped index of binding predictions on disk, for cohorts whose predictions do not fit in
+    memory. The index is a directory containing:
+    - peptides.npy: the sorted peptides of the cohort, as fixed-width byte strings. The position of a peptide in this
+      array is its ID.
+    - <n>.npy: one array of scores (see SCORE_DTYPE) per allele, with one record per peptide ID
+    - index.json: the alleles (the n-th allele is stored in <n>.npy) and the number of peptides
+    Queries only read the pages of the files which hold the requested peptides, so the memory used scales with the
+    size of the query (e.g. one sample) rather than with the cohort.
+    """
+    def __init__(self, directory: Union[str, Path]):
+        """
+        Open an index built with PredictionIndex.build.
+        :param directory: The directory of the index
+        """
+        self.directory = Path(directory)
+        with open(self.directory / 'index.json', 'r') as f:
+            info = json.load(f)
+        if info['version'] != INDEX_VERSION:
+            raise ValueError(f'{self.directory} is a version {info["version"]} prediction index, this version of '
+                             f'MhcVizPipe reads version {INDEX_VERSION}.')
+        self.alleles: List[str] = info['alleles']
+        self.n_peptides: int = info['n_peptides']
+        self.peptides = np.load(self.directory / 'peptides.npy', mmap_mode='r')
+        self._scores = {}
+
+    @classmethod
+    def build(cls, table: PredictionTable, directory: Union[str, Path]) -> 'PredictionIndex':
+        """
+        Write the predictions of a table to an index. The score arrays are written one allele at a time.
+        :param table: The predictions
+        :param directory: The directory to write the index to. It is created if it does not exist.
+        :return: The opened index
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        frame = table.frame
+        peptide_categories = np.asarray(frame['Peptide'].cat.categories, dtype=str)
+        peptides = np.char.encode(peptide_categories, 'ascii') if len(peptide_categories) else np.array([], 'S1')
+        order = np.argsort(peptides, kind='stable')
+        # maps the category codes of the table to peptide IDs
+        peptide_ids = np.empty(len(order), dtype=np.int64)
+        peptide_ids[order] = np.arange(len(order))
+        np.save(directory / 'peptides.npy', peptides[order])
+
+        alleles = [str(allele) for allele in frame['Allele'].cat.categories]
+        allele_codes = frame['Allele'].cat.codes.values
+        peptide_codes = frame['Peptide'].cat.codes.values
+        binder_codes = frame['Binder'].cat.codes.values
+        for i in range(len(alleles)):
+            rows = np.flatnonzero(allele_codes == i)
+            scores = np.lib.format.open_memmap(directory / f'{i}.npy', mode='w+', dtype=SCORE_DTYPE,
+                                               shape=(len(order),))
+            for column in SCORE_COLUMNS:
+                scores[column] = np.nan
+            scores['Binder'] = -1
+            ids = peptide_ids[peptide_codes[rows]]
+            for column in SCORE_COLUMNS:
+                scores[column][ids] = frame[column].values[rows]
+            scores['Binder'][ids] = binder_codes[rows]
+            scores.flush()
+            del scores
+        with open(directory / 'index.json', 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'alleles': alleles, 'n_peptides': len(order)}, f)
+        return cls(directory)
+
+    def _allele_scores(self, allele: str) -> np.memmap:
+        if allele not in self._scores:
+            self._scores[allele] = np.load(self.directory / f'{self.alleles.index(allele)}.npy', mmap_mode='r')
+        return self._scores[allele]
+
+    def peptide_ids(self, peptides: Iterable[str]) -> np.ndarray:
+        """
+        Get the IDs of peptides.
+        :param peptides: The peptides
+        :return: Array of IDs, -1 for peptides which are not in the index
+        """
+        query = np.char.encode(np.asarray(list(peptides), dtype=str), 'ascii')
+        if len(query) == 0 or self.n_peptides == 0:
+            return np.full(len(query), -1, dtype=np.int64)
+        ids = np.searchsorted(self.peptides, query)
+        found = ids < self.n_peptides
+        found[found] = self.peptides[ids[found]] == query[found]
+        return np.where(found, ids, -1)
+
+    def lookup(self, peptides: Iterable[str], alleles: Iterable[str]) -> pd.DataFrame:
+        """
+        Get the predictions of the peptides for the alleles. Only the parts of the index holding these peptides are
+        read.
+        :param peptides: The peptides
+        :param alleles: The alleles
+        :return: A DataFrame with the columns in PREDICTION_COLUMNS, ordered by allele then peptide (in the order they
+        were given). Pairs which are not in the index are left out.
+        """
+        peptides = np.asarray(list(peptides), dtype=str)
+        alleles = [allele for allele in alleles if allele in self.alleles]
+        ids = self.peptide_ids(peptides)
+        found = ids >= 0
+        peptides, ids = peptides[found], ids[found]
+        # reading the IDs in order is faster on memory-mapped files
+        order = np.argsort(ids, kind='stable')
+        parts = []
+        for allele in alleles:
+            scores = np.empty(len(ids), dtype=SCORE_DTYPE)
+            scores[order] = self._allele_scores(allele)[ids[order]]
+            predicted = scores['Binder'] >= 0
+            part = {'Allele': np.full(predicted.sum(), allele, dtype=object), 'Peptide': peptides[predicted]}
+            for column in SCORE_COLUMNS:
+                part[column] = scores[column][predicted]
+            part['Binder'] = pd.Categorical.from_codes(scores['Binder'][predicted], categories=BINDER_CATEGORIES)
+            parts.append(pd.DataFrame(part))
+        if not parts:
+            return PredictionTable().frame.astype({'Allele': str, 'Peptide': str})
+        return pd.concat(parts, ignore_index=True)[PREDICTION_COLUMNS]
+
+    def disk_usage(self) -> int:
+        """
+        :return: The size of the index on disk in bytes
+        """
+        return sum(f.stat().st_size for f in self.directory.glob('*'))
@@ -0,0 +1,200 @@
+from pathlib import Path
+from typing import Dict, Iterable, List, Set
+from MhcVizPipe.Tools.netmhcpan_helper import NetMHCpanHelper
+from MhcVizPipe.Tools.prediction_cache import PredictionCache
+from MhcVizPipe.Tools.prediction_table import PredictionTable
+from MhcVizPipe.Tools.utils import convert_win_2_wsl_path
+import platform
+
+
+def group_alleles_for_prediction(allele_peptides: Dict[str, List[str]],
+                                 max_extra_fraction: float = 0.25) -> List[List[str]]:
+    """
+    Group alleles so that each group can be predicted in a single NetMHCpan run using the union of the peptides of
+    the alleles in the group. An allele is only added to a group if the fraction of unnecessary predictions in the
+    group (peptides predicted for an allele which were not requested for it) stays at or below max_extra_fraction.
+    :param allele_peptides: Dictionary of form {allele: [peptides]}
+    :param max_extra_fraction: The maximum allowed fraction of unnecessary predictions in a group.
+    :return: List of allele groups, e.g. [['HLA-A02:01', 'HLA-B07:02'], ['HLA-C07:02']]
+    """
+    groups = []  # list of [alleles, union of peptides, number of requested predictions]
+    for allele in sorted(allele_peptides, key=lambda a: len(allele_peptides[a]), reverse=True):
+        peptides = set(allele_peptides[allele])
+        best_group = None
+        best_extra = None
+        for group in groups:
+            union = group[1] | peptides
+            n_predictions = len(union) * (len(group[0]) + 1)
+            extra = (n_predictions - (group[2] + len(peptides))) / n_predictions if n_predictions else 0
+            if extra <= max_extra_fraction and (best_extra is None or extra < best_extra):
+                best_group = group
+                best_extra = extra
+        if best_group is None:
+            groups.append([[allele], peptides, len(peptides)])
+        else:
+            best_group[0].append(allele)
+            best_group[1] |= peptides
+            best_group[2] += len(peptides)
+    return [group[0] for group in groups]
+
+
+def get_allele_peptides(sample_alleles: Dict[str, List[str]],
+                        sample_peptides: Dict[str, List[str]]) -> Dict[str, Set[str]]:
+    """
+    Get the peptides to predict for each allele: the union of the peptides of all the samples with the allele.
+    :param sample_alleles: Dictionary of {sample: [alleles]}
+    :param sample_peptides: Dictionary of {sample: [peptides]}
+    :return: Dictionary of {allele: set of peptides}
+    """
+    allele_peptides = {}
+    for sample, alleles in sample_alleles.items():
+        for allele in alleles:
+            allele_peptides.setdefault(allele, set()).update(sample_peptides[sample])
+    return allele_peptides
+
+
+class PredictionPlanner:
+    """
+    Plans the binding predictions of several analyses (e.g. a batch of analyses from the command line) so that each
+    (peptide, allele) pair is only predicted once, however many analyses it appears in. The analyses are added first,
+    then the union of their (peptide, allele) pairs is predicted in as few NetMHCpan runs as possible and each
+    analysis gets its predictions from the planner (see MhcToolHelper). Pairs which were not planned are predicted
+    when they are requested. All the predictions are kept in memory until the planner is discarded.
+    """
+    def __init__(self,
+                 mhc_class: str = 'I',
+                 n_threads: int = 0,
+                 tmp_dir: str = None,
+                 cache: PredictionCache = None,
+                 max_extra_fraction: float = 0.25):
+        """
+        :param mhc_class: The MHC class of the analyses, I or II
+        :param n_threads: Number of NetMHCpan processes to run at the same time. Defaults to the "max threads" setting.
+        :param tmp_dir: (optional) Directory for the NetMHCpan input files. Defaults to the temp directory setting.
+        :param cache: (optional) A PredictionCache. Pairs found in it are not predicted again.
+        :param max_extra_fraction: See group_alleles_for_prediction
+        """
+        from MhcVizPipe.parameters import Parameters
+        parameters = Parameters()
+        self.mhc_class = mhc_class
+        self.n_threads = n_threads if n_threads else parameters.THREADS
+        self.tmp_dir = Path(tmp_dir if tmp_dir else parameters.TMP_DIR)
+        self.cache = cache
+        self.max_extra_fraction = max_extra_fraction
+        if platform.system().lower() != 'windows':
+            self.NETMHCPAN = parameters.NETMHCPAN
+            self.NETMHCIIPAN = parameters.NETMHCIIPAN
+        else:
+            self.NETMHCPAN = 'wsl ' + convert_win_2_wsl_path(parameters.NETMHCPAN)
+            self.NETMHCIIPAN = 'wsl ' + convert_win_2_wsl_path(parameters.NETMHCIIPAN)
+        self.pending: Dict[str, Set[str]] = {}  # {allele: peptides} still to predict
+        self.predicted: Dict[str, Set[str]] = {}  # {allele: peptides} already predicted
+        self.n_analyses = 0
+        self.requested_pairs = 0  # summed over the analyses
+        self.job_profiles = []  # of the runs not yet claimed by an analysis (see take_job_profiles)
+        self._table = PredictionTable()
+
+    def add(self,
+            sample_alleles: Dict[str, List[str]],
+            sample_peptides: Dict[str, List[str]],
+            min_length: int = None,
+            max_length: int = None):
+        """
+        Add the (peptide, allele) pairs of an analysis to the plan.
+        :param sample_alleles: Dictionary of {sample: [alleles]}
+        :param sample_peptides: Dictionary of {sample: [peptides]}. These should be cleaned.
+        :param min_length: (optional) Minimum peptide length of the analysis
+        :param max_length: (optional) Maximum peptide length of the analysis
+        :return: None
+        """
+        self.n_analyses += 1
+        if min_length is not None or max_length is not None:
+            min_length = min_length if min_length is not None else 0
+            max_length = max_length if max_length is not None else float('inf')
+            sample_peptides = {sample: [pep for pep in peptides if min_length <= len(pep) <= max_length]
+                               for sample, peptides in sample_peptides.items()}
+        for allele, peptides in get_allele_peptides(sample_alleles, sample_peptides).items():
+            self.requested_pairs += len(peptides)
+            self._add_pending(allele, peptides)
+
+    def _add_pending(self, allele: str, peptides: Iterable[str]):
+        new = set(peptides) - self.predicted.get(allele, set())
+        if new:
+            self.pending.setdefault(allele, set()).update(new)
+
+    @property
+    def unique_pairs(self) -> int:
+        """
+        The number of distinct (peptide, allele) pairs planned or predicted.
+        """
+        alleles = set(self.pending) | set(self.predicted)
+        return sum(len(self.pending.get(allele, set()) | self.predicted.get(allele, set())) for allele in alleles)
+
+    def describe(self) -> str:
+        """
+        Describe the plan, e.g. "3 analyses, 30000 (peptide, allele) pairs, 12000 distinct (60% shared)".
+        """
+        unique = self.unique_pairs
+        shared = 1 - unique / self.requested_pairs if self.requested_pairs else 0
+        return f'{self.n_analyses} analyses, {self.requested_pairs} (peptide, allele) pairs, {unique} distinct ' \
+               f'({shared:.0%} shared)'
+
+    def predict(self):
+        """
+        Predict all the pending (peptide, allele) pairs. Alleles with similar peptides are predicted together (see
+        group_alleles_for_prediction). If a NetMHCpan run fails, the pairs of the groups which were not predicted are
+        left pending, so they are predicted again when they are requested.
+        :return: None
+        """
+        pending = {allele: peptides for allele, peptides in self.pending.items() if peptides}
+        if not pending:
+            return
+        tables = [self._table]
+        done = []  # (alleles, peptides) of the groups which were predicted
+        try:
+            for group in group_alleles_for_prediction(pending, max_extra_fraction=self.max_extra_fraction):
+                group_peptides = list(set().union(*[pending[allele] for allele in group]))
+                lengths = [len(pep) for pep in group_peptides]
+                netmhcpan = NetMHCpanHelper(peptides=group_peptides,
+                                            alleles=group,
+                                            mhc_class=self.mhc_class,
+                                            n_threads=self.n_threads,
+                                            tmp_dir=str(self.tmp_dir),
+                                            netmhcpan=self.NETMHCPAN,
+                                            netmhc2pan=self.NETMHCIIPAN,
+                                            min_length=min(lengths),
+                                            max_length=max(lengths),
+                                            cache=self.cache)
+                tables.append(netmhcpan.predict_table())
+                self.job_profiles += netmhcpan.job_profiles
+                done.append((group, group_peptides))
+        finally:
+            self._table = PredictionTable.concat(tables)
+            # the union of the peptides was predicted for every allele of the group
+            for group, group_peptides in done:
+                for allele in group:
+                    self.predicted.setdefault(allele, set()).update(group_peptides)
+                    self.pending.pop(allele, None)
+
+    def take_job_profiles(self) -> List[dict]:
+        """
+        Get the profiles of the NetMHCpan runs made since the last call, so that each run is only counted in the run
+        profile of one analysis (the first one to use the predictions of the run).
+        :return: List of job profiles (see ProfiledJob.profile)
+        """
+        profiles = self.job_profiles
+        self.job_profiles = []
+        return profiles
+
+    def predictions(self, alleles: List[str], peptides: Iterable[str]) -> PredictionTable:
+        """
+        Get the predictions of the peptides for the alleles, predicting any pairs which were not planned.
+        :param alleles: The alleles
+        :param peptides: The peptides
+        :return: A PredictionTable
+        """
+        peptides = set(peptides)
+        for allele in alleles:
+            self._add_pending(allele, peptides)
+        self.predict()
+        return PredictionTable(self._table.select(alleles=alleles, peptides=peptides))
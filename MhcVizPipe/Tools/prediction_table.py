@@ -0,0 +1,149 @@
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+import pandas as pd
+
+SCORE_COLUMNS = ['EL_score', 'EL_Rank', 'Aff_Score', 'Aff_Rank', 'Aff_nM']
+PREDICTION_COLUMNS = ['Allele', 'Peptide'] + SCORE_COLUMNS + ['Binder']
+# the order of the categories matches the binder codes used by NetMHCOutputParser
+BINDER_CATEGORIES = ['Non-binder', 'Weak', 'Strong']
+
+# maps the field names used by NetMHCpanHelper and the prediction cache to the column names of the table
+_FIELD_COLUMNS = {'el_score': 'EL_score', 'el_rank': 'EL_Rank', 'aff_score': 'Aff_Score', 'aff_rank': 'Aff_Rank',
+                  'aff_nM': 'Aff_nM', 'binder': 'Binder'}
+
+
+def format_prediction_lines(frame: pd.DataFrame) -> List[str]:
+    """
+    Format rows of predictions as tab-delimited lines, with the values written the same way as by DataFrame.to_csv.
+    Each column is converted to text in one vectorized operation.
+    :param frame: DataFrame with the columns in PREDICTION_COLUMNS
+    :return: List of lines, without line endings
+    """
+    columns = []
+    for column in PREDICTION_COLUMNS:
+        values = frame[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # missing values have the code -1, i.e. the empty string appended to the categories
+            text = np.append(np.asarray(values.cat.categories, dtype=str), '')[values.cat.codes.values]
+        elif column in SCORE_COLUMNS:
+            # the scores have a fixed number of decimals and many repeated values, so each distinct value is only
+            # converted once
+            distinct, inverse = np.unique(values.values, return_inverse=True)
+            text = np.where(np.isnan(distinct), '', distinct.astype(str))[inverse.reshape(-1)]
+        else:
+            text = values.values.astype(str)
+        columns.append(text.tolist())
+    return list(map('\t'.join, zip(*columns)))
+
+
+def _binder_column(codes: Iterable[int]) -> pd.Categorical:
+    return pd.Categorical.from_codes(np.asarray(codes, dtype=np.int8), categories=BINDER_CATEGORIES)
+
+
+class PredictionTable:
+    """
+    A compact columnar table of binding predictions. Peptides, alleles and binder classes are stored as pandas
+    categoricals and scores as float32, which is several times smaller than nested dictionaries of the form
+    {peptide: {allele: {field: value}}}.
+    """
+    def __init__(self, frame: pd.DataFrame = None):
+        if frame is None:
+            frame = pd.DataFrame({column: [] for column in PREDICTION_COLUMNS})
+        self.frame = self._compact(frame[PREDICTION_COLUMNS])
+
+    @staticmethod
+    def _compact(frame: pd.DataFrame) -> pd.DataFrame:
+        frame = frame.reset_index(drop=True)
+        frame = frame.astype({'Allele': 'category', 'Peptide': 'category'})
+        frame = frame.astype({column: np.float32 for column in SCORE_COLUMNS})
+        if not isinstance(frame['Binder'].dtype, pd.CategoricalDtype) \
+                or list(frame['Binder'].cat.categories) != BINDER_CATEGORIES:
+            frame['Binder'] = pd.Categorical(frame['Binder'], categories=BINDER_CATEGORIES)
+        return frame
+
+    @classmethod
+    def from_parser(cls, parser) -> 'PredictionTable':
+        """
+        Create a table from a NetMHCOutputParser.
+        """
+        frame = pd.DataFrame({
+            'Allele': pd.Categorical.from_codes(np.asarray(parser.allele, dtype=np.int32), categories=parser.alleles),
+            'Peptide': pd.Categorical(parser.peptides),
+            'EL_score': np.asarray(parser.el_score, dtype=np.float32),
+            'EL_Rank': np.asarray(parser.el_rank, dtype=np.float32),
+            'Aff_Score': np.asarray(parser.aff_score, dtype=np.float32),
+            'Aff_Rank': np.asarray(parser.aff_rank, dtype=np.float32),
+            'Aff_nM': np.asarray(parser.aff_nM, dtype=np.float32),
+            'Binder': _binder_column(parser.binder)
+        })
+        return cls(frame)
+
+    @classmethod
+    def from_records(cls, records: Iterable[Tuple[str, str, Dict[str, object]]]) -> 'PredictionTable':
+        """
+        Create a table from (peptide, allele, {field: value}) records, e.g. from NetMHCOutputParser.records or the
+        prediction cache.
+        """
+        data = {column: [] for column in PREDICTION_COLUMNS}
+        for peptide, allele, values in records:
+            data['Peptide'].append(peptide)
+            data['Allele'].append(allele)
+            for field, column in _FIELD_COLUMNS.items():
+                data[column].append(values[field])
+        return cls(pd.DataFrame(data))
+
+    @classmethod
+    def concat(cls, tables: List['PredictionTable']) -> 'PredictionTable':
+        tables = [t for t in tables if len(t) > 0]
+        if not tables:
+            return cls()
+        # categoricals with different categories are combined as objects and converted back by the constructor
+        return cls(pd.concat([t.frame for t in tables], ignore_index=True))
+
+    def __len__(self):
+        return len(self.frame)
+
+    @property
+    def peptides(self) -> List[str]:
+        return list(self.frame['Peptide'].unique())
+
+    @property
+    def alleles(self) -> List[str]:
+        return list(self.frame['Allele'].unique())
+
+    def select(self, alleles: Iterable[str] = None, peptides: Iterable[str] = None) -> pd.DataFrame:
+        """
+        Get the predictions for the given alleles and/or peptides.
+        :param alleles: (optional) Only return predictions for these alleles
+        :param peptides: (optional) Only return predictions for these peptides
+        :return: A DataFrame with the columns in PREDICTION_COLUMNS
+        """
+        mask = np.ones(len(self.frame), dtype=bool)
+        if alleles is not None:
+            mask &= self.frame['Allele'].isin(list(alleles)).values
+        if peptides is not None:
+            mask &= self.frame['Peptide'].isin(list(peptides)).values
+        return self.frame.loc[mask]
+
+    def map_peptides(self, mapping: Dict[str, str]) -> 'PredictionTable':
+        """
+        Map the peptides in the table back to the original peptide sequences, e.g. when uncommon amino acids were
+        replaced with X before being sent to NetMHCpan. Several original peptides can map to the same peptide.
+        :param mapping: Dictionary of form {original peptide: peptide in the table}
+        :return: A new PredictionTable containing the original peptides
+        """
+        if all(original == mapped for original, mapped in mapping.items()):
+            return self
+        peptide_map = pd.DataFrame({'Original': list(mapping.keys()), 'Peptide': list(mapping.values())})
+        frame = self.frame.astype({'Peptide': str}).merge(peptide_map, on='Peptide')
+        frame['Peptide'] = frame['Original']
+        return PredictionTable(frame)
+
+    def drop_duplicates(self) -> 'PredictionTable':
+        return PredictionTable(self.frame.drop_duplicates(subset=['Allele', 'Peptide'], keep='last'))
+
+    def memory_usage(self) -> int:
+        """
+        :return: The memory used by the table in bytes
+        """
+        return int(self.frame.memory_usage(deep=True).sum())
@@ -0,0 +1,122 @@
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def _try_lock(f) -> bool:
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            # the files are opened for appending, so the position has to be moved to the byte which _unlock unlocks
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+def _lock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        while not _try_lock(f):
+            time.sleep(0.1)
+
+
+def _unlock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class CpuScheduler:
+    """
+    A host-wide CPU budget shared by all the external tools (NetMHCpan, NetMHCIIpan and GibbsCluster) run by
+    MhcVizPipe. The budget is a set of slot files in a directory and a job must hold a lock on `weight` slots while it
+    runs. Because the slots are file locks, the budget is shared by every process using the same directory (e.g.
+    several analyses running at the same time from the GUI), and the slots of a process are released by the operating
+    system if it is killed.
+    """
+    def __init__(self, location: Union[str, Path], n_slots: int, poll_interval: float = 0.05):
+        self.location = Path(location)
+        self.location.mkdir(parents=True, exist_ok=True)
+        self.n_slots = max(1, n_slots)
+        self.poll_interval = poll_interval
+
+    def _open(self, name: str):
+        f = open(self.location / name, 'a+')
+        if fcntl is None and os.path.getsize(f.name) == 0:
+            f.write('\0')  # msvcrt locks a byte range, so the file can't be empty
+            f.flush()
+        return f
+
+    @contextmanager
+    def acquire(self, weight: int = 1):
+        """
+        Wait until `weight` CPU slots are free and hold them for the duration of the context.
+        :param weight: The number of CPUs the job uses. It is capped at the size of the budget.
+        """
+        weight = max(1, min(weight, self.n_slots))
+        held: List = []
+        held_slots = set()
+        # only one process at a time collects slots. It keeps the slots it has while waiting for more, so jobs
+        # with large weights are not starved by jobs with small weights
+        with self._open('admission.lock') as admission:
+            _lock(admission)
+            try:
+                while len(held) < weight:
+                    for i in range(self.n_slots):
+                        if len(held) == weight:
+                            break
+                        if i in held_slots:
+                            continue
+                        f = self._open(f'slot_{i}.lock')
+                        if not _try_lock(f):
+                            f.close()
+                            continue
+                        held.append(f)
+                        held_slots.add(i)
+                    if len(held) < weight:
+                        time.sleep(self.poll_interval)
+            except BaseException:
+                self._release(held)
+                raise
+            finally:
+                _unlock(admission)
+        try:
+            yield
+        finally:
+            self._release(held)
+
+    @staticmethod
+    def _release(held: List):
+        for f in held:
+            _unlock(f)
+            f.close()
+
+
+_scheduler = None
+
+
+def get_scheduler() -> CpuScheduler:
+    """
+    Get the CPU scheduler of this process. The budget is "max threads" from the settings and the slot files are kept
+    in the temp directory, so every analysis using the same settings shares it.
+    """
+    global _scheduler
+    if _scheduler is None:
+        from MhcVizPipe.parameters import Parameters
+        parameters = Parameters()
+        _scheduler = CpuScheduler(Path(parameters.TMP_DIR) / 'cpu_slots', parameters.THREADS)
+    return _scheduler
@@ -1,12 +1,25 @@
-import re
-from typing import Union
+import csv
+import string
+from itertools import compress
+from typing import Dict, Iterator, List, Tuple, Union
 from os import PathLike
-import zipfile
 from pathlib import Path
-from os import walk as os_walk
+import numpy as np
+from MhcVizPipe.Tools.input_formats import COLUMNAR_FORMATS, file_format, iter_column, open_text
 
 common_aa = "ARNDCQEGHILKMFPSTWYV"
 
+# the reasons a peptide can be rejected by clean_peptide_batch, in the order they are checked
+REJECTION_REASONS = ('empty', 'uncommon amino acids', 'too short', 'too long')
+
+# byte lookup tables used by clean_peptide_batch. Newlines separate the peptides, so they are always kept.
+_IS_LETTER = np.zeros(256, dtype=bool)
+_IS_LETTER[np.frombuffer((string.ascii_letters + '\n').encode(), dtype=np.uint8)] = True
+_IS_COMMON_AA = np.zeros(256, dtype=bool)
+_IS_COMMON_AA[np.frombuffer((common_aa + '\n').encode(), dtype=np.uint8)] = True
+_TO_UPPER = np.arange(256, dtype=np.uint8)
+_TO_UPPER[np.frombuffer(string.ascii_lowercase.encode(), dtype=np.uint8)] -= 32
+
 
 def remove_previous_and_next_aa(peptide: str):
     """
@@ -21,22 +34,89 @@ def remove_previous_and_next_aa(peptide: str):
     return peptide
 
 
-def clean_peptides(peptide_list, verbose=False):
-    unmodified_peps = []
+def clean_peptide_batch(peptides: List[str],
+                        min_length: int = None,
+                        max_length: int = None,
+                        keep_uncommon: bool = False) -> Tuple[List[str], Dict[str, int]]:
+    """
+    Clean a list of peptides in one pass: previous and next amino acids (e.g. A.AKLNCNAA.K) and modifications
+    (anything which is not a letter) are removed and the peptides are upper-cased. Then peptides which are empty,
+    contain amino acids other than the 20 common ones or are outside the length window are rejected.
+    All the peptides are joined into one byte array and cleaned with NumPy, so this is fast even for millions of
+    peptides.
+    :param peptides: List of peptides
+    :param min_length: (optional) Minimum length of the cleaned peptides
+    :param max_length: (optional) Maximum length of the cleaned peptides
+    :param keep_uncommon: Keep peptides with uncommon amino acids (e.g. X or U) instead of rejecting them
+    :return: The cleaned peptides (in their original order) and the number of peptides rejected for each reason
+    (see REJECTION_REASONS).
+    """
+    rejected = {reason: 0 for reason in REJECTION_REASONS}
+    if len(peptides) == 0:
+        return [], rejected
+    # the peptides are separated (and surrounded) by newlines, so each peptide lies between two newlines
+    data = np.frombuffer(('\n' + '\n'.join(peptides) + '\n').encode(), dtype=np.uint8)
+    if np.count_nonzero(data == 10) != len(peptides) + 1:
+        peptides = [pep.replace('\n', '') for pep in peptides]
+        data = np.frombuffer(('\n' + '\n'.join(peptides) + '\n').encode(), dtype=np.uint8)
+
+    # remove the previous and next amino acids along with the letters, i.e. "X." at the start and ".X" at the end
+    keep = _IS_LETTER[data]
+    dots = np.flatnonzero(data == ord('.'))
+    dots = dots[(dots >= 2) & (dots < len(data) - 2)]
+    keep[dots[data[dots - 2] == 10] - 1] = False
+    keep[dots[data[dots + 2] == 10] + 1] = False
+    data = _TO_UPPER[data[keep]]
+
+    newlines = np.flatnonzero(data == 10)
+    lengths = np.diff(newlines) - 1
+    empty = lengths == 0
+    accepted = ~empty
+    rejected['empty'] = int(np.count_nonzero(empty))
+    if not keep_uncommon:
+        uncommon = np.zeros(len(lengths), dtype=bool)
+        uncommon[np.searchsorted(newlines, np.flatnonzero(~_IS_COMMON_AA[data])) - 1] = True
+        rejected['uncommon amino acids'] = int(np.count_nonzero(accepted & uncommon))
+        accepted &= ~uncommon
+    if min_length is not None:
+        rejected['too short'] = int(np.count_nonzero(accepted & (lengths < min_length)))
+        accepted &= lengths >= min_length
+    if max_length is not None:
+        rejected['too long'] = int(np.count_nonzero(accepted & (lengths > max_length)))
+        accepted &= lengths <= max_length
+
+    cleaned = data[1:-1].tobytes().decode().split('\n')
+    return list(compress(cleaned, accepted.tolist())), rejected
+
+
+def clean_peptides(peptide_list, verbose=False, min_length: int = None, max_length: int = None):
+    """
+    Remove previous and next amino acids and modifications from the peptides and keep the ones which only contain
+    common amino acids (and, optionally, are within a length window). See clean_peptide_batch.
+    :param peptide_list: List of peptides
+    :param verbose: Print how many peptides were rejected, and why
+    :param min_length: (optional) Minimum peptide length
+    :param max_length: (optional) Maximum peptide length
+    :return: List of the cleaned peptides
+    """
     if verbose:
         print('Removing peptide modifications')
-    for pep in peptide_list:
-        pep = remove_previous_and_next_aa(pep)
-        pep = ''.join(re.findall('[a-zA-Z]+', pep))
-        pep = pep.upper()
-        incompatible_aa = False
-        for aa in pep:
-            if aa not in common_aa:
-                incompatible_aa = True
-                break
-        if not incompatible_aa:
-            unmodified_peps.append(pep)
-    return unmodified_peps
+    peptides, rejected = clean_peptide_batch(peptide_list, min_length, max_length)
+    if verbose:
+        print(f'Kept {len(peptides)} of {len(peptide_list)} peptides. {describe_rejections(rejected)}')
+    return peptides
+
+
+def describe_rejections(rejected: Dict[str, int]):
+    """
+    Describe the rejections counted by clean_peptide_batch, e.g. "Rejected: 3 too short, 1 too long".
+    :param rejected: Dictionary of {reason: number of peptides}
+    :return: A string
+    """
+    reasons = [f'{n} {reason}' for reason, n in rejected.items() if n > 0]
+    if not reasons:
+        return 'None rejected.'
+    return f'Rejected: {", ".join(reasons)}.'
 
 
 def sanitize_sample_name(sample_name: str):
@@ -46,73 +126,193 @@ def sanitize_sample_name(sample_name: str):
     return sample_name
 
 
-def load_peptide_file(filepath: Union[str, PathLike], peptide_column: str = None, delimiter: str = None):
+DELIMITERS = {'comma': ',', 'tab': '\t'}
+
+
+class PeptideFileReader:
+    def __init__(self,
+                 filepath: Union[str, PathLike],
+                 peptide_column: str = None,
+                 delimiter: str = None,
+                 chunk_size: int = 2 ** 24):
+        """
+        Read the peptides of a text file in chunks, so large search engine exports (e.g. from PEAKS, MaxQuant or
+        MSFragger) are never loaded into memory all at once. The file is either a list of peptides (one per line), a
+        delimited table with a header, in which case the peptide column is selected by its header, or a Parquet or
+        Arrow table, of which only the peptide column is read. Text files can be gzip or zstd compressed (see
+        input_formats).
+        :param filepath: Path to the file
+        :param peptide_column: (optional) The header of the column containing the peptides. It can be left out for
+        Parquet and Arrow tables with a single column.
+        :param delimiter: (optional) The delimiter of the table: "comma", "tab" or the delimiter itself. If a
+        peptide_column is given but no delimiter, the delimiter is guessed from the header.
+        :param chunk_size: Approximate number of characters per chunk of text (the chunks end at the end of a line)
+        """
+        if delimiter is not None and peptide_column is None:
+            raise ValueError('The peptide_column must be defined for multi-column files.')
+        self.filepath = filepath
+        self.peptide_column = peptide_column
+        self.delimiter = DELIMITERS.get(delimiter, delimiter)
+        self.chunk_size = chunk_size
+        # counts from the last call to read()
+        self.n_peptides = 0
+        self.n_duplicates = 0
+        self.rejected = {reason: 0 for reason in REJECTION_REASONS}
+
+    def chunks(self) -> Iterator[List[str]]:
+        """
+        Iterate over the peptides of the file (stripped, but not cleaned) in chunks.
+        """
+        table_format = file_format(self.filepath)
+        if table_format in COLUMNAR_FORMATS:
+            for chunk in iter_column(self.filepath, self.peptide_column, table_format):
+                yield [pep.strip() for pep in chunk]
+            return
+
+        with open_text(self.filepath) as f:
+            if self.peptide_column is None:
+                while True:
+                    lines = f.readlines(self.chunk_size)
+                    if not lines:
+                        return
+                    yield [line.strip() for line in lines]
+
+            header = f.readline().lstrip('\ufeff')  # tables saved by Excel can start with a byte order mark
+            delimiter = self.delimiter
+            if delimiter is None:
+                delimiter = '\t' if '\t' in header else ','
+            columns = [column.strip() for column in next(csv.reader([header], delimiter=delimiter))]
+            if self.peptide_column not in columns:
+                raise ValueError(f'The column "{self.peptide_column}" is not in the header of {self.filepath}. '
+                                 f'The columns are: {", ".join(columns)}')
+            index = columns.index(self.peptide_column)
+            while True:
+                lines = f.readlines(self.chunk_size)
+                if not lines:
+                    return
+                # splitting the lines is much faster than the csv module, which is only needed for quoted fields
+                if any('"' in line for line in lines):
+                    rows = csv.reader(lines, delimiter=delimiter)
+                else:
+                    rows = (line.split(delimiter, index + 1) for line in lines)
+                yield [row[index].strip() for row in rows if len(row) > index]
+
+    def read(self,
+             clean: bool = True,
+             unique: bool = True,
+             min_length: int = None,
+             max_length: int = None) -> List[str]:
+        """
+        Read the peptides of the file, cleaning (see clean_peptide_batch) and removing duplicates chunk by chunk, so
+        only the peptides which are kept are held in memory. The number of peptides read, duplicates and rejections
+        are kept in self.n_peptides, self.n_duplicates and self.rejected.
+        :param clean: Clean the peptides
+        :param unique: Remove duplicate peptides, keeping the first occurrence of each
+        :param min_length: (optional) Minimum length of the cleaned peptides
+        :param max_length: (optional) Maximum length of the cleaned peptides
+        :return: List of peptides
+        """
+        self.n_peptides = 0
+        self.n_duplicates = 0
+        self.rejected = {reason: 0 for reason in REJECTION_REASONS}
+        peptides = {} if unique else []  # a dictionary keeps the order of the peptides
+        n_kept = 0
+        for chunk in self.chunks():
+            self.n_peptides += len(chunk)
+            if clean:
+                chunk, rejected = clean_peptide_batch(chunk, min_length, max_length)
+                for reason, n in rejected.items():
+                    self.rejected[reason] += n
+            n_kept += len(chunk)
+            if unique:
+                peptides.update(dict.fromkeys(chunk))
+            else:
+                peptides += chunk
+        self.n_duplicates = n_kept - len(peptides)
+        return list(peptides)
+
+    def describe(self):
+        """
+        Describe the last read, e.g. "1000 peptides read, 800 kept (150 duplicates). Rejected: 50 too long."
+        """
+        n_kept = self.n_peptides - self.n_duplicates - sum(self.rejected.values())
+        return f'{self.n_peptides} peptides read, {n_kept} kept ({self.n_duplicates} duplicates). ' \
+               f'{describe_rejections(self.rejected)}'
+
+
+def load_peptide_file(filepath: Union[str, PathLike],
+                      peptide_column: str = None,
+                      delimiter: str = None,
+                      clean: bool = False,
+                      unique: bool = False):
     """
-    Load a peptide list from a text file. If the file has multiple columns, you must indicate if it
-    is comma- or tab-delimited and the header of the column containing the peptides.
+    Load a peptide list from a text file (optionally gzip or zstd compressed) or a Parquet or Arrow table. If the file
+    has multiple columns, you must indicate the header of the column containing the peptides and, optionally, if it is
+    comma- or tab-delimited. The file is read in chunks, see PeptideFileReader.
     :param filepath: Path to the file
     :param peptide_column: (optional) The header of the column containing the peptides
-    :param delimiter: (optional) The delimiter, if it is a multi-column file.
+    :param delimiter: (optional) The delimiter, if it is a multi-column file: "comma" or "tab".
+    :param clean: Clean the peptides while reading the file (see clean_peptide_batch)
+    :param unique: Remove duplicate peptides while reading the file
     :return: List of strings - the peptide sequences.
     """
-    if not peptide_column == delimiter and None in [peptide_column, delimiter]:
-        raise ValueError('Both peptide_column and delimiter must be defined for multi-column files.')
-
-    peptides = []
-    with open(filepath, 'r') as f:
-        lines = f.readlines()
-        if delimiter:
-            if delimiter == 'comma':
-                delimiter = ','
-            else:
-                delimiter = '\t'
-            header_index = lines[0].strip().index(peptide_column)
-            for line in lines[1:]:
-                peptides.append(line.strip().split(delimiter)[header_index])
-        else:
-            for line in lines:
-                peptides.append(line.strip())
-
-    return peptides
+    return PeptideFileReader(filepath, peptide_column, delimiter).read(clean=clean, unique=unique)
 
 
 def load_template_file(filepath: Union[str, PathLike]):
     """
-    Load a template file for use with MhcVizPipe command line interface.
+    Load a template file for use with MhcVizPipe command line interface. The files in the template can be in any
+    format read by PeptideFileReader, and the template itself can be compressed.
     :param filepath: Path to the file.
     :return: List of dictionaries of form [{'file': filepath, 'alleles': [list of alleles]}, ... ]
     """
-    with open(filepath, 'r') as f:
+    with open_text(filepath) as f:
         lines = [l.strip().split() for l in f.readlines()]
     samples = []
     for line in lines:
+        if len(line) == 0:
+            continue
         if len(line) == 1:
             raise ValueError('Each file in the template must have at least one alleles assigned to it.')
-        if line == '':
-            continue
         samples.append({'file': line[0], 'alleles': line[1:]})
     return samples
 
 
-def package_report(analysis_location):
-    zip_out = f'{analysis_location}/MVP_report_components.zip'
-    with zipfile.ZipFile(zip_out, 'w', zipfile.ZIP_STORED) as zipf:
-        netmhcpan_files = [str(x) for x in Path(analysis_location).glob('*_predictions.tsv')]
-        for f in netmhcpan_files:
-            zipf.write(f, arcname=Path(f).name)
-        zipf.write(str(Path(analysis_location) / 'sample_metrics.txt'), arcname='sample_metrics.txt')
-        for root, dirs, files in os_walk(f'{analysis_location}/gibbs'):
-            for file in files:
-                p = Path(root, file)
-                zipf.write(str(p), p.relative_to(analysis_location))
-        zipf.write(f'{analysis_location}/report.html', 'report.html')
-
-        for root, dirs, files in os_walk(f'{analysis_location}/figures'):
-            for file in files:
-                p = Path(root, file)
-                zipf.write(str(p), p.relative_to(analysis_location))
-
-    return zip_out
+MANIFEST_COLUMNS = ['template', 'mhc_class', 'output', 'max_length', 'description', 'name', 'exp_info']
+
+
+def load_manifest(filepath: Union[str, PathLike]):
+    """
+    Load a manifest of analyses for the batch mode of the command line interface. The manifest is a tab-delimited file
+    with a header. The "template" column (a template file, see load_template_file) is required. The other columns are
+    optional and override the command line options for their analysis: "mhc_class", "output" (the directory the
+    report is published in), "max_length", "description", "name" and "exp_info". Empty lines and lines starting with
+    "#" are skipped.
+    :param filepath: Path to the manifest
+    :return: List of dictionaries of form [{'template': filepath, 'mhc_class': 'I', ...}, ...]. Columns which are
+    missing or empty are left out.
+    """
+    with open_text(filepath) as f:
+        lines = [l.rstrip('\r\n') for l in f.readlines() if l.strip() and not l.startswith('#')]
+    if not lines:
+        return []
+    header = [x.strip() for x in lines[0].split('\t')]
+    if 'template' not in header:
+        raise ValueError(f'The manifest must have a "template" column. The columns are: {", ".join(header)}')
+    unknown = [x for x in header if x not in MANIFEST_COLUMNS]
+    if unknown:
+        raise ValueError(f'Unknown column(s) in the manifest: {", ".join(unknown)}. '
+                         f'The possible columns are: {", ".join(MANIFEST_COLUMNS)}')
+    analyses = []
+    for line in lines[1:]:
+        values = [x.strip() for x in line.split('\t')]
+        analysis = {column: value for column, value in zip(header, values) if value}
+        if 'template' not in analysis:
+            raise ValueError(f'Each analysis in the manifest must have a template: {line}')
+        if 'max_length' in analysis:
+            analysis['max_length'] = int(analysis['max_length'])
+        analyses.append(analysis)
+    return analyses
 
 
 def check_alleles(allele_list, good_alleles):
@@ -1,15 +1,20 @@
 import argparse
 from argparse import RawDescriptionHelpFormatter
-from MhcVizPipe.Tools.cl_tools import MhcToolHelper
 from MhcVizPipe.Tools.utils import sanitize_sample_name, check_alleles,\
-    clean_peptides, load_template_file, load_peptide_file, package_report
-from MhcVizPipe.Reporting import report
+    PeptideFileReader, load_template_file, load_manifest
+from MhcVizPipe.Tools.archives import write_archive
+from MhcVizPipe.pipeline import run_analysis, AnalysisResources, STAGE_DESCRIPTIONS
+from MhcVizPipe.Tools.instrumentation import StageProfiler
 from MhcVizPipe.parameters import Parameters, ROOT_DIR
 from pathlib import Path
 from os import getcwd
 from datetime import datetime
 from os.path import expanduser
+from time import perf_counter
+from typing import Dict, List, Tuple
 import shutil
+import sys
+import traceback
 
 
 Parameters = Parameters()
@@ -36,12 +41,24 @@ parser.add_argument('-t', '--template', type=str,
                          'with different alleles at the same time. The first column must be the file paths, and the '
                          'respective alleles can be put in the following columns, up to 6 per sample.')
 parser.add_argument('-d', '--delimiter', type=str, required=False, choices=['comma', 'tab'],
-                    help='Delimiter if the file is delimited (e.g. for .csv use "comma").')
+                    help='Delimiter if the file is delimited (e.g. for .csv use "comma"). If it is not given for a '
+                         'multi-column file, it is guessed from the header.')
 parser.add_argument('-H', '--column_header', type=str, required=False, help='The name of the column containing the peptide '
-                                                                            'list, if it is a multi-column file.')
+                                                                            'list, if it is a multi-column file (e.g. '
+                                                                            'a PEAKS, MaxQuant or MSFragger export). '
+                                                                            'The files can be gzipped.')
 parser.add_argument('-a', '--alleles', type=str, nargs='+',
                     help='MHC alleles, spaces separated if more than one.')
-parser.add_argument('-c', '--mhc_class', type=str, choices=['I', 'II'], required=True, help='MHC class')
+parser.add_argument('-b', '--manifest', type=str,
+                    help='Batch mode: a tab-delimited file with a header listing the analyses to run, one template '
+                         '(see --template) per line in a "template" column. The optional columns "mhc_class", '
+                         '"output", "max_length", "description", "name" and "exp_info" override the options given '
+                         'on the command line for their analysis. All the analyses are run in this process and share '
+                         'the prediction cache and the worker pools. Each report is published in its "output" '
+                         'directory, by default a directory named after the template in the publish directory, and a '
+                         'summary of all the analyses is written to batch_summary.tsv in the publish directory.')
+parser.add_argument('-c', '--mhc_class', type=str, choices=['I', 'II'], required=False,
+                    help='MHC class. Required, except in batch mode if the manifest has a "mhc_class" column.')
 parser.add_argument('-m', '--max_length', type=int, default=None, required=False,
                     help='Maximum peptide length to consider as "acceptable" in the analysis. Defaults to 9 for class '
                          'I and 22 for class II.')
@@ -57,96 +74,266 @@ parser.add_argument('-e', '--exp_info', type=str, default='',
                          'this format (including quotes): "A: Z; B: Y; C: X;" etc... where ABC(etc.) are field names '
                          '(e.g. cell line, # of cells, MS Instrument, etc) and ZYX(etc) are details describing the '
                          'field (e.g. JY cell line, 10e6, Orbitrap Fusion, etc.).')
+parser.add_argument('--profile', type=str, nargs='?', const='stages', default=None,
+                    choices=['off', 'stages', 'cprofile'],
+                    help='Time each stage of the analysis. Use "--profile cprofile" to also run the Python profiler '
+                         'during each stage. The timings are shown at the end of the report and saved in the profile '
+                         'folder of MVP_report_components.zip. Defaults to the "profiling" setting in the config '
+                         'file.')
+parser.add_argument('--gibbs_results_only', action='store_true',
+                    help='Only put the GibbsCluster result files (res, cores and the KLD table) in '
+                         'MVP_report_components.zip, and leave out its intermediate files. This makes the archive much '
+                         'smaller.')
 parser.add_argument('--standalone', action='store_true', help='Run MVP in from a standalone installation (i.e. '
                                                               'not installed from PIP). You don\'t usually need to '
                                                               'invoke this as it is done automatically from the '
                                                               'bash script included in the standalone MhcVizPipe '
                                                               'distribution.')
 
-if __name__ == '__main__':
-    netmhcpan_alleles = []
-    args = parser.parse_args()
-    dir = getcwd()
-
-    print(f'File(s): {args.files if args.files else args.template}')
-    print(f'Output directory: {args.publish_directory}')
+def load_allele_list(mhc_class: str) -> List[str]:
+    """
+    Load the alleles known by NetMHCpan (class I) or NetMHCIIpan (class II).
+    """
+    alleles = []
+    with open(Path(ROOT_DIR, 'assets', f'class_{mhc_class}_alleles.txt')) as f:
+        for allele in f.readlines():
+            allele = allele.strip()
+            alleles.append(allele)
+    return alleles
 
-    if args.mhc_class == 'I':
-        with open(Path(ROOT_DIR, 'assets', 'class_I_alleles.txt')) as f:
-            for allele in f.readlines():
-                allele = allele.strip()
-                netmhcpan_alleles.append(allele)
-    else:
-        with open(Path(ROOT_DIR, 'assets', 'class_II_alleles.txt')) as f:
-            for allele in f.readlines():
-                allele = allele.strip()
-                netmhcpan_alleles.append(allele)
 
+def load_samples(netmhcpan_alleles: List[str],
+                 template: str = None,
+                 files: List[str] = None,
+                 alleles: List[str] = None,
+                 column_header: str = None,
+                 delimiter: str = None) -> Tuple[List[dict], Dict[str, List[str]]]:
+    """
+    Load and clean the peptides of the samples in a template, or of files which all have the same alleles.
+    :param netmhcpan_alleles: The alleles known by the prediction tool, see load_allele_list
+    :return: The sample information (as in the GUI sample table) and a dictionary of {sample: [peptides]}
+    """
     sample_info = []
     sample_peptides = {}
+    if template:
+        files_alleles = load_template_file(template)
+    else:
+        files_alleles = [{'file': file, 'alleles': alleles} for file in files]
+    for file in files_alleles:
+        check_alleles(file['alleles'], netmhcpan_alleles)
+        sample_name = sanitize_sample_name(Path(file['file']).name)
+        sample_info.append({'sample-name': sample_name,
+                            'sample-description': '',
+                            'sample-alleles': ', '.join(file['alleles'])})
+        reader = PeptideFileReader(file['file'], column_header, delimiter)
+        sample_peptides[sample_name] = reader.read()
+        print(f'{sample_name}: {reader.describe()}')
+    return sample_info, sample_peptides
+
+
+def length_window(mhc_class: str, max_length: int = None) -> Tuple[int, int]:
+    """
+    The minimum and maximum peptide lengths of an analysis. The maximum length defaults to 12 for class I and 22 for
+    class II.
+    """
+    if max_length is None:
+        max_length = 12 if mhc_class == 'I' else 22
+    return (8 if mhc_class == 'I' else 9), max_length
+
+
+def run_cli_analysis(mhc_class: str,
+                     publish_directory: str,
+                     netmhcpan_alleles: List[str],
+                     template: str = None,
+                     files: List[str] = None,
+                     alleles: List[str] = None,
+                     column_header: str = None,
+                     delimiter: str = None,
+                     max_length: int = None,
+                     description: str = '',
+                     name: str = '',
+                     exp_info: str = '',
+                     profile: str = None,
+                     resources: AnalysisResources = None,
+                     samples: Tuple[List[dict], Dict[str, List[str]]] = None,
+                     all_gibbs_files: bool = True) -> dict:
+    """
+    Run an analysis of the samples in a template, or of files which all have the same alleles, and publish the report
+    and its components.
+    :param netmhcpan_alleles: The alleles known by the prediction tool, see load_allele_list
+    :param resources: (optional) AnalysisResources shared with other analyses
+    :param samples: (optional) The samples, if they are already loaded (see load_samples)
+    :param all_gibbs_files: If False, only the GibbsCluster result files are put in the archive
+    :return: Dictionary with the number of samples and peptides and the location of the published report
+    """
     time = str(datetime.now()).replace(' ', '_')
     analysis_location = str(Path(Parameters.TMP_DIR) / time)
+    profiler = StageProfiler(profile if profile else Parameters.PROFILING)
 
-    if args.template:
-        files_alleles = load_template_file(args.template)
-        for file in files_alleles:
-            check_alleles(file['alleles'], netmhcpan_alleles)
-            sample_name = sanitize_sample_name(Path(file['file']).name)
-            sample_info.append({'sample-name': sample_name,
-                                'sample-description': '',
-                                'sample-alleles': ', '.join(file['alleles'])})
-            sample_peptides[sample_name] = clean_peptides(load_peptide_file(file['file']))
-    else:
-        files = args.files
-        alleles = args.alleles
-        check_alleles(alleles, netmhcpan_alleles)
-        for file in files:
-            sample_name = sanitize_sample_name(Path(file).name)
-            sample_info.append({'sample-name': sample_name,
-                                'sample-description': '',
-                                'sample-alleles': ', '.join(alleles)})
-            sample_peptides[sample_name] = clean_peptides(load_peptide_file(file))
-    if args.max_length is not None:
-        max_length = args.max_length
-    else:
-        if args.mhc_class == 'I':
-            max_length = 12
-        else:
-            max_length = 22
-    cl_tools = MhcToolHelper(
-        sample_info_datatable=sample_info,
-        mhc_class=args.mhc_class,
-        sample_peptides=sample_peptides,
-        tmp_directory=analysis_location,
-        min_length=8 if args.mhc_class == 'I' else 9,
-        max_length=max_length
-    )
-
-    exp_info = args.exp_info.replace('; ', '\n').replace(';', '\n')
-    print(f'Running NetMHC{args.mhc_class if args.mhc_class == "II" else ""}pan')
-    cl_tools.make_binding_predictions()
-    print(f'Writing binding predictions')
-    cl_tools.write_binding_predictions()
-    print('Running GibbsCluster')
-    cl_tools.make_cluster_with_gibbscluster_jobs()
-    cl_tools.make_cluster_with_gibbscluster_by_allele_jobs()
-    cl_tools.order_gibbs_runs()
-    cl_tools.run_jobs()
-    cl_tools.find_best_files()
-    print('Creating report')
-    analysis = report.mhc_report(cl_tools,
-                                 args.mhc_class,
-                                 Parameters.THREADS,
-                                 args.description,
-                                 args.name,
-                                 exp_info)
-    _ = analysis.make_report()
-    print('Creating report archive')
-    packaged_report = package_report(analysis_location)
-    report_location = Path(args.publish_directory)
+    if samples is None:
+        with profiler.stage('load_peptides'):
+            samples = load_samples(netmhcpan_alleles, template, files, alleles, column_header, delimiter)
+    sample_info, sample_peptides = samples
+    min_length, max_length = length_window(mhc_class, max_length)
+    exp_info = exp_info.replace('; ', '\n').replace(';', '\n')
+    run_analysis(sample_info_datatable=sample_info,
+                 sample_peptides=sample_peptides,
+                 mhc_class=mhc_class,
+                 analysis_location=analysis_location,
+                 min_length=min_length,
+                 max_length=max_length,
+                 description=description,
+                 submitter_name=name,
+                 exp_info=exp_info,
+                 progress=lambda stage: print(STAGE_DESCRIPTIONS[stage]),
+                 profiler=profiler,
+                 resources=resources)
+    report_location = Path(publish_directory)
     if not report_location.exists():
-        report_location.mkdir()
+        report_location.mkdir(parents=True)
+    print('Creating report archive')
+    # the archive is written directly to the publish directory
+    packaged_report = report_location / 'MVP_report_components.zip'
+    with profiler.stage('archives'):
+        write_archive(analysis_location, 'MVP_report_components.zip', packaged_report,
+                      all_gibbs_files=all_gibbs_files)
+    # the profile in the archive was written at the end of the analysis, the one on disk also times the archive
+    profiler.write(Path(analysis_location) / 'profile')
     report = Path(analysis_location) / 'report.html'
     shutil.copy(report, str(report_location / 'report.html'))
-    shutil.copy(packaged_report, str(report_location / 'MVP_report_components.zip'))
+    if profiler.enabled:
+        print(f'Profile written to {Path(analysis_location) / "profile"}')
+    return {'samples': len(sample_info),
+            'peptides': sum(len(peptides) for peptides in sample_peptides.values()),
+            'report': str(report_location / 'report.html')}
+
+
+def run_batch(args) -> bool:
+    """
+    Run all the analyses of a manifest (see load_manifest) in this process, sharing the allele lists, prediction
+    cache and worker pools. The samples of all the analyses are loaded first and the binding predictions of the whole
+    batch are planned together, so a (peptide, allele) pair found in several analyses is only predicted once. A failed
+    analysis does not stop the batch. A summary is printed and written to batch_summary.tsv in the publish directory.
+    :return: True if all the analyses succeeded
+    """
+    manifest = load_manifest(args.manifest)
+    allele_lists = {}
+    summary = []
+    with AnalysisResources() as resources:
+        # load the samples of every analysis and add their peptides to the prediction plan
+        analyses = []
+        for i, analysis in enumerate(manifest):
+            template = analysis['template']
+            mhc_class = analysis.get('mhc_class', args.mhc_class)
+            output = analysis.get('output', str(Path(args.publish_directory) / Path(template).stem))
+            print(f'\nLoading analysis {i + 1} of {len(manifest)}: {template}')
+            result = {'template': template, 'mhc_class': mhc_class, 'status': 'done', 'samples': '',
+                      'peptides': '', 'seconds': '', 'output': output, 'error': ''}
+            samples = None
+            start = perf_counter()
+            try:
+                if mhc_class not in ['I', 'II']:
+                    raise ValueError(f'The MHC class must be I or II, not {mhc_class}. Give it with -c/--mhc_class '
+                                     f'or in the mhc_class column of the manifest.')
+                if mhc_class not in allele_lists:
+                    allele_lists[mhc_class] = load_allele_list(mhc_class)
+                samples = load_samples(allele_lists[mhc_class], template, column_header=args.column_header,
+                                       delimiter=args.delimiter)
+                sample_info, sample_peptides = samples
+                min_length, max_length = length_window(mhc_class, analysis.get('max_length', args.max_length))
+                resources.prediction_planner(mhc_class).add(
+                    {sample['sample-name']: sample['sample-alleles'].split(', ') for sample in sample_info},
+                    sample_peptides, min_length=min_length, max_length=max_length)
+            except Exception as e:
+                traceback.print_exc()
+                result['status'] = 'failed'
+                result['error'] = str(e).replace('\t', ' ').replace('\n', ' ')
+            result['seconds'] = perf_counter() - start
+            analyses.append((analysis, result, samples))
+
+        # predict the union of the (peptide, allele) pairs of the batch. If this fails, each analysis predicts its own
+        # pairs, so only the analyses with a problem fail.
+        for mhc_class, planner in resources.prediction_planners.items():
+            print(f'\nBinding predictions of the class {mhc_class} analyses: {planner.describe()}')
+            try:
+                planner.predict()
+            except Exception:
+                traceback.print_exc()
+                print('The predictions of the batch failed, the analyses will be predicted one at a time.')
+
+        for i, (analysis, result, samples) in enumerate(analyses):
+            if result['status'] == 'failed':
+                result['seconds'] = f'{result["seconds"]:.1f}'
+                summary.append(result)
+                continue
+            print(f'\nAnalysis {i + 1} of {len(manifest)}: {result["template"]}')
+            print(f'Output directory: {result["output"]}')
+            start = perf_counter() - result['seconds']
+            try:
+                result.update(run_cli_analysis(mhc_class=result['mhc_class'],
+                                               publish_directory=result['output'],
+                                               netmhcpan_alleles=allele_lists[result['mhc_class']],
+                                               template=result['template'],
+                                               column_header=args.column_header,
+                                               delimiter=args.delimiter,
+                                               max_length=analysis.get('max_length', args.max_length),
+                                               description=analysis.get('description', args.description),
+                                               name=analysis.get('name', args.name),
+                                               exp_info=analysis.get('exp_info', args.exp_info),
+                                               profile=args.profile,
+                                               resources=resources,
+                                               samples=samples,
+                                               all_gibbs_files=not args.gibbs_results_only))
+            except Exception as e:
+                traceback.print_exc()
+                result['status'] = 'failed'
+                result['error'] = str(e).replace('\t', ' ').replace('\n', ' ')
+            result['seconds'] = f'{perf_counter() - start:.1f}'
+            result.pop('report', None)
+            summary.append(result)
+
+    columns = ['template', 'mhc_class', 'status', 'samples', 'peptides', 'seconds', 'output', 'error']
+    publish_directory = Path(args.publish_directory)
+    publish_directory.mkdir(parents=True, exist_ok=True)
+    with open(publish_directory / 'batch_summary.tsv', 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for result in summary:
+            f.write('\t'.join(str(result[column]) for column in columns) + '\n')
+    n_failed = len([result for result in summary if result['status'] == 'failed'])
+    print(f'\nBatch summary ({len(summary) - n_failed} done, {n_failed} failed):')
+    for result in summary:
+        print(f'{result["status"]:<8}{result["seconds"]:>10} s  {result["template"]}  {result["error"]}')
+    print(f'Summary written to {publish_directory / "batch_summary.tsv"}')
+    return n_failed == 0
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    dir = getcwd()
+
+    if args.manifest:
+        print(f'Manifest: {args.manifest}')
+        print(f'Output directory: {args.publish_directory}')
+        success = run_batch(args)
+        print('Done!\n')
+        sys.exit(0 if success else 1)
+
+    if not args.mhc_class:
+        parser.error('the following arguments are required: -c/--mhc_class')
+    print(f'File(s): {args.files if args.files else args.template}')
+    print(f'Output directory: {args.publish_directory}')
+    run_cli_analysis(mhc_class=args.mhc_class,
+                     publish_directory=args.publish_directory,
+                     netmhcpan_alleles=load_allele_list(args.mhc_class),
+                     template=args.template,
+                     files=args.files,
+                     alleles=args.alleles,
+                     column_header=args.column_header,
+                     delimiter=args.delimiter,
+                     max_length=args.max_length,
+                     description=args.description,
+                     name=args.name,
+                     exp_info=args.exp_info,
+                     profile=args.profile,
+                     all_gibbs_files=not args.gibbs_results_only)
     print('Done!\n')
@@ -13,19 +13,20 @@ from dash.exceptions import PreventUpdate
 from random import uniform
 from datetime import datetime
 from pathlib import Path
-from MhcVizPipe.Reporting import report
-from MhcVizPipe.Tools.cl_tools import MhcToolHelper
+from MhcVizPipe import job_queue
+from MhcVizPipe.job_queue import AnalysisQueue
+from MhcVizPipe.pipeline import STAGES, STAGE_DESCRIPTIONS
 import flask
 from sys import argv
 from urllib.parse import quote as urlquote
 from MhcVizPipe.parameters import ROOT_DIR, default_config_file, config_file
 from MhcVizPipe.parameters import Parameters
 from MhcVizPipe.Tools.utils import clean_peptides, sanitize_sample_name
+from MhcVizPipe.Tools.input_formats import upload_to_text
+from MhcVizPipe.Tools.archives import ARCHIVES, stream_archive
 from waitress import serve
 from warnings import simplefilter, catch_warnings
 import traceback
-import zipfile
-from os import walk as os_walk
 from os.path import islink
 from os import unlink
 from subprocess import Popen
@@ -60,6 +61,21 @@ with open(Path(ROOT_DIR, 'assets', 'class_II_alleles.txt')) as f:
         allele = allele.strip()
         class_ii_alleles.append({'label': allele, 'value': allele})
 
+_analysis_queue = None
+
+
+def get_analysis_queue() -> AnalysisQueue:
+    """
+    Get the queue which runs the analyses submitted from the GUI in background processes.
+    """
+    global _analysis_queue
+    if _analysis_queue is None:
+        _analysis_queue = AnalysisQueue(Path(Parameters.TMP_DIR) / 'analysis_queue.sqlite',
+                                        max_concurrent=Parameters.MAX_CONCURRENT_ANALYSES)
+        _analysis_queue.start()
+    return _analysis_queue
+
+
 def lab_logo():
     lab_logo = base64.b64encode(
         open(str(Path(ROOT_DIR) / 'assets/logo_CARONLAB_horizontal.jpg'), 'rb').read()).decode()
@@ -69,6 +85,8 @@ def lab_logo():
 
 app.layout = html.Div(children=[
     dcc.Store(id='peptides', data={}),
+    dcc.Store(id='analysis-job', data=None),
+    dcc.Interval(id='analysis-poll', interval=2000, disabled=True),
     html.Div('', id='tmp-folder', hidden=True),
 
     dbc.Modal(
@@ -157,7 +175,7 @@ app.layout = html.Div(children=[
                 children=[
                     'Drag and drop one or more files in this area, or ',
                     html.Button('Click to Select File(s)', style={'color': 'black'}),
-                    ' (.txt, .csv, .tsv)'
+                    ' (.txt, .csv, .tsv, optionally gzipped, or .parquet, .arrow)'
                 ],
                 style={
                     'lineHeight': '60px',
@@ -507,7 +525,16 @@ app.layout = html.Div(children=[
     ),
 
 
-    dcc.Loading([html.A(id='loading', hidden=True)], fullscreen=True),
+    html.Div(
+        [
+            html.P(id='analysis-progress', style={'margin-top': '10px'}),
+            html.Button(id='cancel-analysis',
+                        children='Cancel analysis',
+                        className='btn btn-outline-secondary',
+                        hidden=True)
+        ],
+        style={'text-align': 'center'}
+    ),
 
 
     html.P(children='Advanced algorithm options:', style={'font-weight': 'bold', 'margin-top': '3em'}, hidden=True),
@@ -561,7 +588,9 @@ app.layout = html.Div(children=[
                                                           'font-size': '12pt', 'font-weight': 'bold'}),
                                             ' - Save all analysis results in a zip file. This includes NetMHCpan or '
                                             'NetMHCIIpan predictions, GibbsCluster results and the final HTML report. '
-                                            'Note that GibbsCluster reports do not include Logos.'
+                                            'Note that GibbsCluster reports do not include Logos, and that only the '
+                                            'GibbsCluster result files are included. The intermediate files can be '
+                                            'downloaded by adding ?gibbs=all to the end of the link.'
                                         ],
                                         style={'margin-top': '1em', 'margin-left': '1em'}
                                     )
@@ -749,7 +778,7 @@ def add_peptides_or_alleles(contents, select_n_clicks, add_alleles_n_clicks, can
             contents = contents[0]
             content_type, content_string = contents.split(',')
             decoded = base64.b64decode(content_string)
-            lines = io.StringIO(decoded.decode('utf-8')).readlines()
+            lines = io.StringIO(upload_to_text(decoded)).readlines()
             try:
                 if ',' in lines[0]:
                     return ''.join(lines), True, [{'label': x, 'value': x} for x in lines[0].split(',')], f'File: {filename}', peptide_data, filename, sample_description, [], no_update
@@ -764,7 +793,7 @@ def add_peptides_or_alleles(contents, select_n_clicks, add_alleles_n_clicks, can
         else:
             first_content_type, content_string = contents[0].split(',')
             first_decoded = base64.b64decode(content_string)
-            first_lines = io.StringIO(first_decoded.decode('utf-8')).readlines()
+            first_lines = io.StringIO(upload_to_text(first_decoded)).readlines()
 
             if ',' in first_lines[0]:
                 return '', True, [{'label': x, 'value': x} for x in first_lines[0].split(
@@ -776,7 +805,7 @@ def add_peptides_or_alleles(contents, select_n_clicks, add_alleles_n_clicks, can
                 for file, content in zip(filename, contents):
                     content_type, content_string = content.split(',')
                     decoded = base64.b64decode(content_string)
-                    lines = io.StringIO(decoded.decode('utf-8')).readlines()
+                    lines = io.StringIO(upload_to_text(decoded)).readlines()
                     peps = [x.replace('"', '').strip() for x in lines]
                     peptide_data[file] = {'description': file, 'peptides': peps}
                     data_table.append(
@@ -808,7 +837,7 @@ def add_peptides_or_alleles(contents, select_n_clicks, add_alleles_n_clicks, can
             for file, content in zip(filename, contents):
                 content_type, content_string = content.split(',')
                 decoded = base64.b64decode(content_string)
-                lines = io.StringIO(decoded.decode('utf-8')).readlines()
+                lines = io.StringIO(upload_to_text(decoded)).readlines()
                 if ',' in lines[0]:
                     headers = lines[0].split(',')
                     sep = ','
@@ -882,16 +911,8 @@ def add_peptides_or_alleles(contents, select_n_clicks, add_alleles_n_clicks, can
         raise PreventUpdate
 
 
-@app.callback([Output('link-to-report', 'children'),
-               Output('link-to-report', 'href'),
-               Output('link-to-figures', 'href'),
-               Output('link-to-archive', 'href'),
-               Output('tmp-location', 'children'),
-               Output('is-there-a-problem', 'children'),
-               Output('loading', 'children'),
-               Output('modal2', 'is_open'),
-               Output('runtime-error-textarea', 'value'),
-               Output('runtime-errors', 'is_open')],
+@app.callback([Output('is-there-a-problem', 'children'),
+               Output('analysis-job', 'data')],
               [Input('run-analysis', 'n_clicks')],
               [State('peptides', 'data'),
                State('submitter-name', 'value'),
@@ -901,43 +922,25 @@ def add_peptides_or_alleles(contents, select_n_clicks, add_alleles_n_clicks, can
                State('sample-data-table', 'data')])
 def run_analysis(n_clicks, peptides, submitter_name, description, mhc_class, exp_info, sample_info_datatable):
     if (len(sample_info_datatable) == 0) and (n_clicks is not None):
-        return (no_update,
-                no_update,
-                no_update,
-                no_update,
-                no_update,
-                [dbc.Alert(id=str(uniform(0, 1)), color='danger',
+        return ([dbc.Alert(id=str(uniform(0, 1)), color='danger',
                            children='You need to load some data first.',
                            style={'width': '360px', 'margin-top': '2px'})],
-                no_update,
-                False, '', False)
+                no_update)
     alleles = []
     for sample in sample_info_datatable:
         # get the list of unique alleles
         sample_alleles = [x.strip() for x in sample['sample-alleles'].split(',') if x.strip() not in ['', None]]
         # check length of allele lists
         if len(sample_alleles) == 0:
-            return (no_update,
-                    no_update,
-                    no_update,
-                    no_update,
-                    no_update,
-                    [dbc.Alert(id=str(uniform(0, 1)), color='danger',
+            return ([dbc.Alert(id=str(uniform(0, 1)), color='danger',
                                children="Don't forget to enter alleles for all samples in the sample table.",
                                style={'width': '360px', 'margin-top': '2px'})],
-                    no_update,
-                    False, '', False)
+                    no_update)
         if len(sample_alleles) > 6:
-            return (no_update,
-                    no_update,
-                    no_update,
-                    no_update,
-                    no_update,
-                    [dbc.Alert(id=str(uniform(0, 1)), color='danger',
+            return ([dbc.Alert(id=str(uniform(0, 1)), color='danger',
                                children="The maximum number of alleles per sample is 6.",
                                style={'width': '360px', 'margin-top': '2px'})],
-                    no_update,
-                    False, '', False)
+                    no_update)
         alleles += sample_alleles
     # check for unrecognized alleles
     unrecognized_alleles = []
@@ -949,35 +952,23 @@ def run_analysis(n_clicks, peptides, submitter_name, description, mhc_class, exp
             if allele not in [x['value'] for x in class_ii_alleles]:
                 unrecognized_alleles.append(allele)
     if len(unrecognized_alleles) > 0:
-        return (no_update,
-                no_update,
-                no_update,
-                no_update,
-                no_update,
-                [dbc.Alert(id=str(uniform(0, 1)), color='danger',
+        return ([dbc.Alert(id=str(uniform(0, 1)), color='danger',
                            children=f"The following alleles are not recognized by "
                                     f"NetMHC{mhc_class if mhc_class == 'II' else ''}pan: "
                                     f"{unrecognized_alleles} Please check for the "
                                     f"the allele in the \"available alleles\" dropdown menu above.",
                            style={'width': '360px', 'margin-top': '2px'})],
-                no_update,
-                False, '', False)
+                no_update)
     # check for alleles with colons in them. we can't run these on Windows yet...
     if platform.system().lower() == 'windows':
         for allele in set(alleles):
             if ':' in allele:
-                return (no_update,
-                        no_update,
-                        no_update,
-                        no_update,
-                        no_update,
-                        [dbc.Alert(id=str(uniform(0, 1)), color='danger',
+                return ([dbc.Alert(id=str(uniform(0, 1)), color='danger',
                                    children=f"Due to limitations in the Windows filesystem, MhcVizPipe cannot currently "
                                             f"run alleles which contain colons. This will be addressed in a future "
                                             f"release.",
                                    style={'width': '360px', 'margin-top': '2px'})],
-                        no_update,
-                        False, '', False)
+                        no_update)
     if n_clicks is None:
         raise PreventUpdate
 
@@ -987,16 +978,10 @@ def run_analysis(n_clicks, peptides, submitter_name, description, mhc_class, exp
     sample_peptides = {}  # this will be filled in below
     # check that there are no duplicate filenames
     if len(samples_to_use) != len(set(samples_to_use)):
-        return (no_update,
-                no_update,
-                no_update,
-                no_update,
-                no_update,
-                [dbc.Alert(id=str(uniform(0, 1)), color='danger',
+        return ([dbc.Alert(id=str(uniform(0, 1)), color='danger',
                            children="All sample names must be unique.",
                            style={'width': '360px', 'margin-top': '2px'})],
-                no_update,
-                False, '', False)
+                no_update)
     try:
         if mhc_class == 'I':
             min_length = 8
@@ -1005,58 +990,89 @@ def run_analysis(n_clicks, peptides, submitter_name, description, mhc_class, exp
             min_length = 9
             max_length = Parameters.CLASS_II_MAX_LENGTH
         for sample_name in samples_to_use:
-            peps = [p.strip() for p in peptides[sample_name]['peptides'] if len(p.strip()) != 0]
-            peps = clean_peptides(peps)
+            # whitespace and empty lines are removed by clean_peptides
+            peps = clean_peptides(peptides[sample_name]['peptides'])
             sample_peptides[sample_name] = peps
         time = str(datetime.now()).replace(' ', '_').replace(':', '-')
         analysis_location = str(Path(Parameters.TMP_DIR)/time)
 
-        cl_tools = MhcToolHelper(
-            sample_info_datatable=sample_info_datatable,
-            mhc_class=mhc_class,
-            sample_peptides=sample_peptides,
-            tmp_directory=analysis_location,
-            min_length=min_length,
-            max_length=max_length
-        )
-        cl_tools.make_binding_predictions()
-        cl_tools.write_binding_predictions()
-        cl_tools.make_cluster_with_gibbscluster_jobs()
-        cl_tools.make_cluster_with_gibbscluster_by_allele_jobs()
-        cl_tools.order_gibbs_runs()
-        cl_tools.run_jobs()
-        cl_tools.find_best_files()
-        analysis = report.mhc_report(cl_tools, mhc_class, Parameters.THREADS, description, submitter_name, exp_info)
-        _ = analysis.make_report()
-        download_href = f'/download/{urlquote(time+"/"+"report.html")}'
-        # put everything in an archive
-        with zipfile.ZipFile(f'{analysis_location}/MVP_analysis.zip', 'w', zipfile.ZIP_STORED) as zipf:
-            netmhcpan_files = [str(x) for x in Path(analysis_location).glob('*_predictions.tsv')]
-            for f in netmhcpan_files:
-                zipf.write(f, arcname=Path(f).name)
-            zipf.write(str(Path(analysis_location)/'sample_metrics.txt'), arcname='sample_metrics.txt')
-            for root, dirs, files in os_walk(f'{analysis_location}/gibbs'):
-                for file in files:
-                    p = Path(root, file)
-                    zipf.write(str(p), p.relative_to(analysis_location))
-            zipf.write(f'{analysis_location}/report.html', 'report.html')
-        archive_href = f'/download/{urlquote(time+"/"+"MVP_analysis.zip")}'
-        # put figures in an archive
-        with zipfile.ZipFile(f'{analysis_location}/MVP_figures.zip', 'w', zipfile.ZIP_STORED) as zipf:
-            for root, dirs, files in os_walk(f'{analysis_location}/figures'):
-                for file in files:
-                    p = Path(root, file)
-                    zipf.write(str(p), p.relative_to(analysis_location))
-        figures_href = f'/download/{urlquote(time+"/"+"MVP_figures.zip")}'
-
-        tmp_location = f"If you wish to access the files directly, the location for this analysis is: " \
-                       f"{analysis_location}."
+        job_id = get_analysis_queue().submit(analysis_location,
+                                             sample_info_datatable=sample_info_datatable,
+                                             sample_peptides=sample_peptides,
+                                             mhc_class=mhc_class,
+                                             min_length=min_length,
+                                             max_length=max_length,
+                                             description=description,
+                                             submitter_name=submitter_name,
+                                             exp_info=exp_info)
     except Exception:
         error = traceback.format_exc()
+        return [dbc.Alert(id=str(uniform(0, 1)), color='danger',
+                          children=f'The analysis could not be started: {error}',
+                          style={'width': '360px', 'margin-top': '2px'})], no_update
 
-        return no_update, no_update, no_update, no_update, no_update, [], no_update, False, error, True
+    return [], {'id': job_id, 'time': time}
 
-    return 'Link to report', download_href, figures_href, archive_href, tmp_location, [], '', True, '', False
+
+@app.callback([Output('link-to-report', 'children'),
+               Output('link-to-report', 'href'),
+               Output('link-to-figures', 'href'),
+               Output('link-to-archive', 'href'),
+               Output('tmp-location', 'children'),
+               Output('analysis-progress', 'children'),
+               Output('cancel-analysis', 'hidden'),
+               Output('analysis-poll', 'disabled'),
+               Output('modal2', 'is_open'),
+               Output('runtime-error-textarea', 'value'),
+               Output('runtime-errors', 'is_open')],
+              [Input('analysis-job', 'data'),
+               Input('analysis-poll', 'n_intervals')])
+def check_analysis(job, n_intervals):
+    """
+    Polls the analysis queue for the status of the submitted analysis, and shows the links to the results when it
+    is finished.
+    """
+    if job is None:
+        raise PreventUpdate
+    status = get_analysis_queue().status(job['id'])
+    if status['status'] == job_queue.QUEUED:
+        progress = f'Waiting for {status["position"]} other analyses to finish before starting...' \
+            if status['position'] > 0 else 'Starting analysis...'
+        return no_update, no_update, no_update, no_update, no_update, progress, False, False, False, '', False
+    if status['status'] == job_queue.RUNNING:
+        stage = status['stage'] or STAGES[0]
+        progress = f'Step {STAGES.index(stage) + 1} of {len(STAGES)}: {STAGE_DESCRIPTIONS[stage]}...'
+        return no_update, no_update, no_update, no_update, no_update, progress, False, False, False, '', False
+    if status['status'] == job_queue.CANCELLED:
+        return no_update, no_update, no_update, no_update, no_update, 'The analysis was cancelled.', True, True, \
+            False, '', False
+    if status['status'] == job_queue.FAILED:
+        return no_update, no_update, no_update, no_update, no_update, '', True, True, False, status['error'], True
+
+    time = job['time']
+    download_href = f'/download/{urlquote(time+"/"+"report.html")}'
+    archive_href = f'/download/{urlquote(time+"/"+"MVP_analysis.zip")}'
+    figures_href = f'/download/{urlquote(time+"/"+"MVP_figures.zip")}'
+    tmp_location = f"If you wish to access the files directly, the location for this analysis is: " \
+                   f"{status['location']}."
+    return 'Link to report', download_href, figures_href, archive_href, tmp_location, '', True, True, True, '', False
+
+
+@app.callback(Output('cancel-analysis', 'disabled'),
+              [Input('cancel-analysis', 'n_clicks'),
+               Input('analysis-job', 'data')])
+def cancel_analysis(n_clicks, job):
+    """
+    Cancels the current analysis. The button is enabled again when a new analysis is submitted.
+    """
+    ctx = dash.callback_context
+    triggered_by = ctx.triggered[0]['prop_id'].split('.')[0]
+    if triggered_by == 'analysis-job':
+        return False
+    if n_clicks is None or job is None:
+        raise PreventUpdate
+    get_analysis_queue().cancel(job['id'])
+    return True
 
 
 @app.callback([Output('upgrade-modal', 'is_open'),
@@ -1160,10 +1176,19 @@ def check_if_version_is_uptodate(name: str) -> (bool, str, str):
 @app.server.route("/download/<path:path>")
 def get_report(path):
     """
-    Downloads the MVP report.
+    Downloads the MVP report, or an archive of an analysis. The archives are streamed as they are made (see
+    Tools/archives.py). Add ?gibbs=all to the link of an archive to include all the GibbsCluster files.
     :param path:
     :return:
     """
+    tmp_dir = Path(Parameters.TMP_DIR).resolve()
+    requested = (tmp_dir / path).resolve()
+    if requested.name in ARCHIVES and not requested.exists() and tmp_dir in requested.parents \
+            and (requested.parent / 'report.html').exists():
+        stream = stream_archive(requested.parent, requested.name,
+                                all_gibbs_files=flask.request.args.get('gibbs') == 'all')
+        return flask.Response(flask.stream_with_context(stream), mimetype='application/zip',
+                              headers={'Content-Disposition': f'attachment; filename={requested.name}'})
     return flask.send_from_directory(Parameters.TMP_DIR, path)
 
 
@@ -1296,6 +1321,9 @@ if __name__ == '__main__':
     if '--standalone' in argv:
         initialize()
 
+    # start running any analyses which were still queued when MhcVizPipe was last stopped
+    get_analysis_queue()
+
     if 'debug' in argv or '-debug' in argv or '--debug' in argv:
         print(debug_welcome)
         app.run_server(debug=True, port=8971, host=Parameters.HOSTNAME)
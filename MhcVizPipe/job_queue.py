@@ -0,0 +1,200 @@
+import json
+import multiprocessing
+import os
+import signal
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+from typing import Union
+
+# status of an analysis in the job table
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class AnalysisCancelled(Exception):
+    pass
+
+
+def _connect(db: Union[str, Path]):
+    return sqlite3.connect(str(db), timeout=60)
+
+
+def _update(db: Union[str, Path], job_id: str, **values):
+    with _connect(db) as con:
+        con.execute(f'UPDATE analyses SET {", ".join(f"{key} = ?" for key in values)} WHERE id = ?',
+                    list(values.values()) + [job_id])
+
+
+def _run_queued_analysis(db: str, job_id: str, analysis_location: str):
+    """
+    Run an analysis in a worker process. The inputs are read from request.json in the analysis directory and the
+    progress is written to the job table.
+    """
+    if hasattr(os, 'setsid'):
+        # put the analysis and all the processes it starts in its own process group so it can be cancelled
+        os.setsid()
+
+    def progress(stage: str):
+        with _connect(db) as con:
+            cancel = con.execute('SELECT cancel_requested FROM analyses WHERE id = ?', [job_id]).fetchone()[0]
+        if cancel:
+            raise AnalysisCancelled()
+        _update(db, job_id, stage=stage)
+
+    try:
+        from MhcVizPipe.pipeline import run_analysis
+        from MhcVizPipe.Tools.instrumentation import StageProfiler
+        from MhcVizPipe.parameters import Parameters
+        with open(Path(analysis_location) / 'request.json', 'r') as f:
+            request = json.load(f)
+        profiler = StageProfiler(Parameters().PROFILING)
+        # the archives are not made here, they are streamed when they are downloaded
+        run_analysis(analysis_location=analysis_location, progress=progress, profiler=profiler, **request)
+        _update(db, job_id, status=DONE, finished=time.time())
+    except AnalysisCancelled:
+        _update(db, job_id, status=CANCELLED, finished=time.time())
+    except Exception:
+        _update(db, job_id, status=FAILED, finished=time.time(), error=traceback.format_exc())
+
+
+class AnalysisQueue:
+    """
+    A queue of analyses which are run in the background by worker processes, so that long analyses do not block the
+    GUI server. The queue is kept in an SQLite job table, so the status of an analysis can be checked from any thread
+    (or process) and queued analyses survive a restart of the server. At most max_concurrent analyses are run at the
+    same time.
+    """
+    def __init__(self, location: Union[str, Path], max_concurrent: int = 1, poll_interval: float = 0.5):
+        self.location = Path(location)
+        if not self.location.parent.exists():
+            self.location.parent.mkdir(parents=True)
+        self.max_concurrent = max(1, max_concurrent)
+        self.poll_interval = poll_interval
+        self.processes = {}
+        self._lock = threading.Lock()
+        self._dispatcher = None
+        # spawn rather than fork, because the GUI server is multithreaded
+        self._context = multiprocessing.get_context('spawn')
+        with _connect(self.location) as con:
+            con.execute('CREATE TABLE IF NOT EXISTS analyses ('
+                        'id TEXT PRIMARY KEY, status TEXT, stage TEXT, location TEXT, error TEXT, '
+                        'submitted REAL, started REAL, finished REAL, cancel_requested INTEGER DEFAULT 0)')
+
+    def start(self):
+        """
+        Start dispatching queued analyses. Analyses which were running when the server was last stopped are marked
+        as failed, and analyses which were queued are run.
+        :return: None
+        """
+        with self._lock:
+            if self._dispatcher is not None:
+                return
+            with _connect(self.location) as con:
+                con.execute('UPDATE analyses SET status = ?, finished = ?, error = ? WHERE status = ?',
+                            [FAILED, time.time(), 'The server was stopped while the analysis was running.', RUNNING])
+            self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+            self._dispatcher.start()
+
+    def submit(self, analysis_location: Union[str, Path], **request) -> str:
+        """
+        Add an analysis to the queue.
+        :param analysis_location: The directory of the analysis
+        :param request: The keyword arguments to pass to pipeline.run_analysis
+        :return: The id of the analysis
+        """
+        analysis_location = Path(analysis_location)
+        analysis_location.mkdir(parents=True, exist_ok=True)
+        with open(analysis_location / 'request.json', 'w') as f:
+            json.dump(request, f)
+        job_id = uuid.uuid4().hex
+        with _connect(self.location) as con:
+            con.execute('INSERT INTO analyses (id, status, location, submitted) VALUES (?, ?, ?, ?)',
+                        [job_id, QUEUED, str(analysis_location), time.time()])
+        self.start()
+        return job_id
+
+    def status(self, job_id: str) -> dict:
+        """
+        :param job_id: The id of the analysis
+        :return: A dictionary with the status, stage, location, error and times of the analysis. For queued analyses,
+        "position" is the number of analyses ahead of it in the queue.
+        """
+        with _connect(self.location) as con:
+            con.row_factory = sqlite3.Row
+            row = con.execute('SELECT * FROM analyses WHERE id = ?', [job_id]).fetchone()
+            if row is None:
+                raise KeyError(f'No analysis with id {job_id}')
+            status = dict(row)
+            if status['status'] == QUEUED:
+                status['position'] = con.execute('SELECT COUNT(*) FROM analyses WHERE status = ? AND submitted < ?',
+                                                  [QUEUED, status['submitted']]).fetchone()[0]
+        return status
+
+    def cancel(self, job_id: str):
+        """
+        Cancel an analysis. Queued analyses are removed from the queue and running analyses are stopped, along with
+        any NetMHCpan or GibbsCluster processes they started.
+        :param job_id: The id of the analysis
+        :return: None
+        """
+        with _connect(self.location) as con:
+            con.execute('UPDATE analyses SET cancel_requested = 1 WHERE id = ?', [job_id])
+            con.execute('UPDATE analyses SET status = ?, finished = ? WHERE id = ? AND status = ?',
+                        [CANCELLED, time.time(), job_id, QUEUED])
+        with self._lock:
+            process = self.processes.get(job_id)
+        if process is not None and process.is_alive():
+            if hasattr(os, 'killpg'):
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            else:
+                process.terminate()
+
+    def _dispatch(self):
+        while True:
+            try:
+                self._reap()
+                self._start_queued()
+            except sqlite3.Error:
+                traceback.print_exc()
+            time.sleep(self.poll_interval)
+
+    def _reap(self):
+        with self._lock:
+            finished = [(job_id, p) for job_id, p in self.processes.items() if not p.is_alive()]
+            for job_id, _ in finished:
+                del self.processes[job_id]
+        for job_id, process in finished:
+            process.join()
+            # the worker records its own status unless it was killed
+            with _connect(self.location) as con:
+                cancelled = con.execute('SELECT cancel_requested FROM analyses WHERE id = ?', [job_id]).fetchone()[0]
+                con.execute('UPDATE analyses SET status = ?, finished = ?, error = ? WHERE id = ? AND status = ?',
+                            [CANCELLED if cancelled else FAILED, time.time(),
+                             None if cancelled else f'The analysis stopped unexpectedly (exit code {process.exitcode}).',
+                             job_id, RUNNING])
+
+    def _start_queued(self):
+        with self._lock:
+            free = self.max_concurrent - len(self.processes)
+        if free <= 0:
+            return
+        with _connect(self.location) as con:
+            queued = con.execute('SELECT id, location FROM analyses WHERE status = ? ORDER BY submitted LIMIT ?',
+                                 [QUEUED, free]).fetchall()
+            for job_id, _ in queued:
+                con.execute('UPDATE analyses SET status = ?, started = ? WHERE id = ?', [RUNNING, time.time(), job_id])
+        for job_id, location in queued:
+            process = self._context.Process(target=_run_queued_analysis, args=(str(self.location), job_id, location))
+            process.start()
+            with self._lock:
+                self.processes[job_id] = process
@@ -4,6 +4,7 @@ from pathlib import Path
 from sys import executable, argv
 import platform
 from tempfile import gettempdir
+from typing import List
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 if '--standalone' in argv:
@@ -75,6 +76,11 @@ class Parameters:
         self.config.read(config_file)
         return self.config['SERVER']['PORT']
 
+    @property
+    def MAX_CONCURRENT_ANALYSES(self) -> int:
+        self.config.read(config_file)
+        return int(self.config['SERVER'].get('max concurrent analyses', '2'))
+
     @property
     def HOBOHM(self) -> str:
         self.config.read(config_file)
@@ -98,6 +104,69 @@ class Parameters:
             threads = os.cpu_count()
         return threads
 
+    @property
+    def PREDICTION_CACHE(self) -> bool:
+        self.config.read(config_file)
+        return self.config['ANALYSIS'].get('prediction cache', 'yes').lower() in ['yes', 'true', '1']
+
+    @property
+    def FIGURE_EXPORT(self) -> str:
+        self.config.read(config_file)
+        mode = self.config['ANALYSIS'].get('pdf figures', 'now').lower()
+        if mode not in ['now', 'defer', 'skip']:
+            raise ValueError('`pdf figures` must be one of "now", "defer" or "skip".')
+        return mode
+
+    @property
+    def REUSE_RESULTS(self) -> bool:
+        self.config.read(config_file)
+        return self.config['ANALYSIS'].get('reuse results', 'yes').lower() in ['yes', 'true', '1']
+
+    @property
+    def GIBBS_SWEEP(self) -> str:
+        self.config.read(config_file)
+        mode = self.config['ANALYSIS'].get('gibbs sweep', 'full').lower()
+        if mode not in ['full', 'adaptive', 'single']:
+            raise ValueError('`gibbs sweep` must be one of "full", "adaptive" or "single".')
+        return mode
+
+    @property
+    def GIBBS_SWEEP_MARGIN(self) -> float:
+        self.config.read(config_file)
+        return float(self.config['ANALYSIS'].get('gibbs sweep margin', '0.05'))
+
+    @property
+    def PREDICTION_INDEX_THRESHOLD(self) -> int:
+        self.config.read(config_file)
+        return int(self.config['ANALYSIS'].get('prediction index threshold', '50000000'))
+
+    @property
+    def PREDICTION_FORMATS(self) -> List[str]:
+        self.config.read(config_file)
+        formats = [f.strip().lower() for f in self.config['ANALYSIS'].get('prediction formats', 'tsv').split(',')]
+        for file_format in formats:
+            if file_format not in ['tsv', 'parquet', 'feather']:
+                raise ValueError('`prediction formats` must be a comma-separated list of "tsv", "parquet" and '
+                                 '"feather".')
+        # the tab-delimited files are always written, they are part of the report components
+        return ['tsv'] + [f for f in formats if f != 'tsv']
+
+    @property
+    def ARCHIVE_COMPRESSION(self) -> str:
+        self.config.read(config_file)
+        mode = self.config['ANALYSIS'].get('archive compression', 'deflate').lower()
+        if mode not in ['deflate', 'stored']:
+            raise ValueError('`archive compression` must be one of "deflate" or "stored".')
+        return mode
+
+    @property
+    def PROFILING(self) -> str:
+        self.config.read(config_file)
+        mode = self.config['ANALYSIS'].get('profiling', 'off').lower()
+        if mode not in ['off', 'stages', 'cprofile']:
+            raise ValueError('`profiling` must be one of "off", "stages" or "cprofile".')
+        return mode
+
     @property
     def CLASS_I_MAX_LENGTH(self) -> int:
         self.config.read(config_file)
@@ -0,0 +1,137 @@
+import concurrent.futures
+from pathlib import Path
+from typing import Callable, List
+from MhcVizPipe.Tools.cl_tools import MhcToolHelper
+from MhcVizPipe.Tools.instrumentation import StageProfiler
+from MhcVizPipe.Tools.prediction_cache import PredictionCache
+from MhcVizPipe.Tools.prediction_planner import PredictionPlanner
+from MhcVizPipe.Reporting import report
+from MhcVizPipe.Reporting.figure_export import FigureExporter, renderer_pool
+from MhcVizPipe.parameters import Parameters
+
+# the stages of an analysis, in the order they are run
+STAGES = ['predictions', 'gibbscluster', 'report']
+STAGE_DESCRIPTIONS = {'predictions': 'Running NetMHCpan/NetMHCIIpan',
+                      'gibbscluster': 'Running GibbsCluster',
+                      'report': 'Creating report'}
+
+
+class AnalysisResources:
+    """
+    Resources shared by several analyses run one after another in the same process (e.g. a batch of analyses from
+    the command line), so they are only set up once: the prediction cache, a prediction planner per MHC class (so
+    each peptide and allele is only predicted once), the process pool making the sequence logos and the pool of
+    kaleido renderers exporting the figures. Use it as a context manager, the pools are shut down on exit.
+    """
+    def __init__(self, n_workers: int = None):
+        """
+        :param n_workers: (optional) Number of worker processes in each pool. Defaults to the "max threads" setting.
+        """
+        parameters = Parameters()
+        self.n_workers = n_workers if n_workers else parameters.THREADS
+        self.figure_export = parameters.FIGURE_EXPORT
+        if parameters.PREDICTION_CACHE:
+            self.prediction_cache = PredictionCache(Path(parameters.TMP_DIR) / 'prediction_cache.sqlite')
+        else:
+            self.prediction_cache = None
+        self.prediction_planners = {}
+        self.logo_executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.n_workers)
+        # the renderers take a while to start, so they are only started if figures are rendered during the analyses
+        self.figure_executor = renderer_pool(self.n_workers) if self.figure_export == 'now' else None
+
+    def prediction_planner(self, mhc_class: str) -> PredictionPlanner:
+        """
+        Get the PredictionPlanner of an MHC class. Add the analyses to it before running them to predict all their
+        peptides together.
+        """
+        if mhc_class not in self.prediction_planners:
+            self.prediction_planners[mhc_class] = PredictionPlanner(mhc_class, n_threads=self.n_workers,
+                                                                    cache=self.prediction_cache)
+        return self.prediction_planners[mhc_class]
+
+    def figure_exporter(self) -> FigureExporter:
+        """
+        Make a FigureExporter for an analysis, using the shared renderers.
+        """
+        return FigureExporter(n_workers=self.n_workers, mode=self.figure_export, executor=self.figure_executor)
+
+    def close(self):
+        self.logo_executor.shutdown()
+        if self.figure_executor is not None:
+            self.figure_executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def run_analysis(sample_info_datatable: List[dict],
+                 sample_peptides: dict,
+                 mhc_class: str,
+                 analysis_location: str,
+                 min_length: int,
+                 max_length: int,
+                 description: str = None,
+                 submitter_name: str = None,
+                 exp_info: str = None,
+                 progress: Callable[[str], None] = None,
+                 profiler: StageProfiler = None,
+                 resources: AnalysisResources = None) -> str:
+    """
+    Run an MhcVizPipe analysis: binding predictions, GibbsCluster and the report.
+    :param sample_info_datatable: List of {'sample-name': ..., 'sample-description': ..., 'sample-alleles': ...}
+    :param sample_peptides: Dictionary of {sample name: [peptides]}
+    :param mhc_class: The MHC class, I or II
+    :param analysis_location: The directory to put the analysis in
+    :param min_length: Minimum peptide length
+    :param max_length: Maximum peptide length
+    :param description: (optional) Description of the experiment
+    :param submitter_name: (optional) Name of the submitter
+    :param exp_info: (optional) Experimental details
+    :param progress: (optional) A function which is called with the name of each stage (see STAGES) when it starts.
+    :param profiler: (optional) A StageProfiler to time the analysis with. By default one is made using the
+    "profiling" setting. If profiling is on, the timings are written to the profile folder of the analysis.
+    :param resources: (optional) AnalysisResources shared with other analyses. By default the analysis sets up its own.
+    :return: The location of the report
+    """
+    parameters = Parameters()
+    if progress is None:
+        progress = lambda stage: None
+    if profiler is None:
+        profiler = StageProfiler(parameters.PROFILING)
+
+    progress('predictions')
+    with profiler.stage('setup'):
+        cl_tools = MhcToolHelper(
+            sample_info_datatable=sample_info_datatable,
+            mhc_class=mhc_class,
+            sample_peptides=sample_peptides,
+            tmp_directory=analysis_location,
+            min_length=min_length,
+            max_length=max_length,
+            prediction_cache=resources.prediction_cache if resources is not None else None,
+            prediction_planner=resources.prediction_planner(mhc_class) if resources is not None else None
+        )
+    # GibbsCluster runs alongside the predictions, so the "gibbscluster" stage starts when the predictions are done
+    with profiler.stage('predictions_and_gibbscluster'):
+        cl_tools.run_predictions_and_gibbscluster(progress=progress)
+    with profiler.stage('find_best_files'):
+        cl_tools.find_best_files()
+    with profiler.stage('save_artifacts'):
+        cl_tools.save_artifacts()
+        cl_tools.write_run_profile()
+
+    progress('report')
+    with profiler.stage('report'):
+        if resources is not None:
+            analysis = report.mhc_report(cl_tools, mhc_class, parameters.THREADS, description, submitter_name,
+                                         exp_info, figure_exporter=resources.figure_exporter(), profiler=profiler,
+                                         logo_executor=resources.logo_executor)
+        else:
+            analysis = report.mhc_report(cl_tools, mhc_class, parameters.THREADS, description, submitter_name,
+                                         exp_info, profiler=profiler)
+        loc = analysis.make_report()
+    profiler.write(Path(analysis_location) / 'profile')
+    return loc
@@ -0,0 +1,103 @@
+"""
+Memory benchmark for binding predictions.
+
+Compares the memory used by predictions stored as nested dictionaries ({peptide: {allele: {field: value}}}, as
+previously used by NetMHCpanHelper.predict_dict and MhcToolHelper.prediction_dict) with the columnar PredictionTable,
+and the memory used to query the predictions of one sample from the on-disk PredictionIndex.
+Predictions are randomly generated, so the DTU tools are not needed.
+
+usage (from the repository root): PYTHONPATH=. python benchmarks/bench_prediction_memory.py [-n N_PEPTIDES]
+[--sample_fraction FRACTION]
+"""
+import argparse
+import gc
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+from MhcVizPipe.Tools.netmhcpan_helper import NetMHCOutputParser
+from MhcVizPipe.Tools.prediction_index import PredictionIndex
+from MhcVizPipe.Tools.prediction_table import PredictionTable
+
+ALLELES = ['HLA-A01:01', 'HLA-A02:01', 'HLA-B07:02', 'HLA-B08:01', 'HLA-C07:01', 'HLA-C07:02']
+AMINO_ACIDS = np.array(list('ARNDCQEGHILKMFPSTWYV'))
+
+
+def random_peptides(n: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(8, 13, n)
+    residues = AMINO_ACIDS[rng.integers(0, 20, lengths.sum())]
+    ends = np.cumsum(lengths)
+    return [''.join(residues[end - length:end]) for end, length in zip(ends, lengths)]
+
+
+def filled_parser(peptides, seed: int = 0) -> NetMHCOutputParser:
+    rng = np.random.default_rng(seed)
+    parser = NetMHCOutputParser('I')
+    parser.alleles = list(ALLELES)
+    n = len(peptides) * len(ALLELES)
+    parser.peptides = [pep for _ in ALLELES for pep in peptides]
+    parser.allele.extend(np.repeat(np.arange(len(ALLELES)), len(peptides)).tolist())
+    for column in ['el_score', 'aff_score']:
+        getattr(parser, column).extend(rng.random(n).round(6).tolist())
+    for column in ['el_rank', 'aff_rank']:
+        getattr(parser, column).extend((rng.random(n) * 100).round(3).tolist())
+    parser.aff_nM.extend((rng.random(n) * 50000).round(2).tolist())
+    parser.binder.extend(rng.integers(0, 3, n).tolist())
+    return parser
+
+
+def nested_dict(parser: NetMHCOutputParser):
+    predictions = {}
+    for peptide, allele, values in parser.records():
+        predictions.setdefault(peptide, {})[allele] = {'EL_score': values['el_score'],
+                                                       'EL_Rank': values['el_rank'],
+                                                       'Aff_Score': values['aff_score'],
+                                                       'Aff_Rank': values['aff_rank'],
+                                                       'Aff_nM': values['aff_nM'],
+                                                       'Binder': values['binder']}
+    return predictions
+
+
+def measure(build, *args):
+    gc.collect()
+    tracemalloc.start()
+    result = build(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    gc.collect()
+    return current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the memory used by nested prediction dictionaries and '
+                                                 'PredictionTable.')
+    parser.add_argument('-n', '--n_peptides', type=int, default=500000)
+    parser.add_argument('--sample_fraction', type=float, default=0.05,
+                        help='The fraction of the peptides in the sample queried from the index.')
+    args = parser.parse_args()
+
+    peptides = random_peptides(args.n_peptides)
+    predictions = filled_parser(peptides)
+    print(f'{args.n_peptides} peptides x {len(ALLELES)} alleles = {len(predictions)} predictions\n')
+    print(f'{"storage":<20}{"retained (MB)":>16}{"peak (MB)":>12}{"bytes/prediction":>20}')
+    for name, build in [('nested dict', nested_dict), ('PredictionTable', PredictionTable.from_parser)]:
+        current, peak = measure(build, predictions)
+        print(f'{name:<20}{current / 1e6:>16.1f}{peak / 1e6:>12.1f}{current / len(predictions):>20.1f}')
+
+    table = PredictionTable.from_parser(predictions)
+    sample = peptides[:int(len(peptides) * args.sample_fraction)]
+    with tempfile.TemporaryDirectory() as directory:
+        index = PredictionIndex.build(table, directory)
+        del table
+        gc.collect()
+        print(f'\nPredictionIndex: {index.disk_usage() / 1e6:.1f} MB on disk')
+        print(f'{"query":<20}{"retained (MB)":>16}{"peak (MB)":>12}')
+        current, peak = measure(index.lookup, sample, ALLELES)
+        print(f'{f"{len(sample)} peptides":<20}{current / 1e6:>16.1f}{peak / 1e6:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
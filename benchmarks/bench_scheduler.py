@@ -0,0 +1,131 @@
+"""
+Benchmark for the NetMHCpan job scheduler.
+
+Compares the previous scheduling (shuffle the peptides and cut them into len/n_threads chunks which are mapped onto
+the pool) with the cost-balanced work units dispatched one at a time as workers become free. Both schedules run the
+fake NetMHCpan/NetMHCIIpan in benchmarks/stubs (see stub_tools.py), so the licensed DTU tools are not needed, and the
+start and end of every job are timed. The makespan is the wall time from the first job starting to the last one
+finishing, and the tail idle time is the total time workers spend idle while waiting for the last job to finish.
+
+The cost of the fake tools is set with --cpu_cost (CPU work per peptide, proportional to the peptide length like the
+real tools), --latency (seconds per peptide, whatever the length) and --startup (seconds per run). --cpu_cost only
+gives meaningful times with at least as many CPUs as threads.
+
+usage (from the repository root):
+PYTHONPATH=. python benchmarks/bench_scheduler.py [-n N_THREADS ...] [-r REPEATS] [--cpu_cost C] [--latency L]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from multiprocessing import Pool
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from MhcVizPipe.Tools.netmhcpan_helper import Job, NetMHCOutputParser, chunk_list, make_work_units
+from MhcVizPipe.Tools.utils import clean_peptides
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+STUBS_DIR = Path(__file__).resolve().parent / 'stubs'
+DATASETS = {
+    'class_I': (REPO_DIR / 'test_data' / 'class_I' / 'mouse_liver.txt', 'I', 8, 12, 'H-2-Kb,H-2-Db'),
+    'class_II': (REPO_DIR / 'test_data' / 'class_II' / 'MAVER-1_DQ.tsv', 'II', 9, 22,
+                 'HLA-DQA10501-DQB10201,HLA-DQA10501-DQB10301'),
+}
+
+
+def run_timed(job: Job) -> Tuple[int, float, float]:
+    """
+    Run a job in a pool worker, bypassing the CPU scheduler so only the pool decides when jobs start.
+    :return: (worker process ID, start time, end time)
+    """
+    start = time.time()
+    job._run(job.command)
+    if job.returncode != 0:
+        raise ChildProcessError(job.stderr.decode())
+    return os.getpid(), start, time.time()
+
+
+def make_jobs(chunks: List[List[str]], mhc_class: str, alleles: str, directory: Path) -> List[Job]:
+    jobs = []
+    for i, chunk in enumerate(chunks):
+        fname = directory / f'peplist_{i}.csv'
+        with open(fname, 'w') as f:
+            f.write('\n'.join(chunk))
+        if mhc_class == 'I':
+            command = [str(STUBS_DIR / 'netMHCpan'), '-p', '-f', str(fname), '-a', alleles, '-BA']
+        else:
+            command = [str(STUBS_DIR / 'netMHCIIpan'), '-inptype', '1', '-f', str(fname), '-a', alleles, '-BA']
+        jobs.append(Job(command=command, working_directory=directory, peptides=chunk,
+                        parser=NetMHCOutputParser(mhc_class)))
+    return jobs
+
+
+def measure(timings: List[Tuple[int, float, float]], n_threads: int) -> Tuple[float, float]:
+    """
+    :return: (makespan, tail idle time), in seconds
+    """
+    first_start = min(start for _, start, _ in timings)
+    last_end = max(end for _, _, end in timings)
+    worker_ends = {}
+    for pid, _, end in timings:
+        worker_ends[pid] = max(end, worker_ends.get(pid, first_start))
+    # workers which got no job were idle the whole time
+    idle = [last_end - end for end in worker_ends.values()] + [last_end - first_start] * (n_threads - len(worker_ends))
+    return last_end - first_start, sum(idle)
+
+
+def previous_schedule(peptides: List[str], mhc_class: str, alleles: str, n_threads: int, directory: Path):
+    peptides = list(peptides)
+    random.shuffle(peptides)
+    chunks = list(chunk_list(peptides, int(len(peptides) / n_threads)))
+    jobs = make_jobs(chunks, mhc_class, alleles, directory)
+    with Pool(n_threads) as pool:
+        # Pool.map splits the jobs into chunks of ceil(n_jobs / (4 * n_processes))
+        timings = pool.map(run_timed, jobs)
+    return measure(timings, n_threads)
+
+
+def balanced_schedule(peptides: List[str], mhc_class: str, alleles: str, n_threads: int, directory: Path):
+    units = make_work_units(list(peptides), mhc_class, n_threads)
+    jobs = make_jobs(units, mhc_class, alleles, directory)
+    with Pool(n_threads) as pool:
+        timings = list(pool.imap_unordered(run_timed, jobs, chunksize=1))
+    return measure(timings, n_threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the NetMHCpan job scheduler.')
+    parser.add_argument('-n', '--n_threads', type=int, nargs='+', default=[4, 8])
+    parser.add_argument('-r', '--repeats', type=int, default=3,
+                        help='Number of runs of each schedule to average (the previous schedule is shuffled each time).')
+    parser.add_argument('--cpu_cost', type=float, default=0, help='MVP_STUB_CPU_COST of the fake tools')
+    parser.add_argument('--latency', type=float, default=0.005, help='MVP_STUB_LATENCY of the fake tools')
+    parser.add_argument('--startup', type=float, default=0.2, help='MVP_STUB_STARTUP of the fake tools')
+    args = parser.parse_args()
+    os.environ['MVP_STUB_CPU_COST'] = str(args.cpu_cost)
+    os.environ['MVP_STUB_LATENCY'] = str(args.latency)
+    os.environ['MVP_STUB_STARTUP'] = str(args.startup)
+
+    print(f'{"dataset":<10}{"threads":>8}{"makespan (before)":>20}{"makespan (after)":>18}'
+          f'{"tail idle (before)":>20}{"tail idle (after)":>19}')
+    with tempfile.TemporaryDirectory() as directory:
+        for name, (path, mhc_class, min_length, max_length, alleles) in DATASETS.items():
+            with open(path, 'r') as f:
+                peptides = clean_peptides([line.strip() for line in f if line.strip()])
+            peptides = sorted({p for p in peptides if min_length <= len(p) <= max_length})
+            for n_threads in args.n_threads:
+                before = np.mean([previous_schedule(peptides, mhc_class, alleles, n_threads, Path(directory))
+                                  for _ in range(args.repeats)], axis=0)
+                after = np.mean([balanced_schedule(peptides, mhc_class, alleles, n_threads, Path(directory))
+                                 for _ in range(args.repeats)], axis=0)
+                print(f'{name:<10}{n_threads:>8}{before[0]:>20.2f}{after[0]:>18.2f}'
+                      f'{before[1]:>20.2f}{after[1]:>19.2f}')
+    print('\nTimes are wall-clock seconds of the fake tools.')
+
+
+if __name__ == '__main__':
+    main()
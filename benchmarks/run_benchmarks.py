@@ -0,0 +1,296 @@
+"""
+Benchmark suite for the stages of an MhcVizPipe analysis.
+
+Runs the pipeline stages (loading and cleaning the peptides, the binding predictions and GibbsCluster, joining the
+predictions, the report and its figures, and packaging the report) on the test datasets, the multi-sample mouse
+tissue dataset of Figure S14 and synthetic cohorts of any size. The stub tools in benchmarks/stubs are used instead
+of NetMHCpan, NetMHCIIpan and GibbsCluster, so the licensed DTU tools are not needed. Their cost can be set with
+--cpu_cost, --latency and --startup.
+
+The results (time of each stage, and the time and resources used by the stub tools) are saved as a JSON file in
+benchmarks/results, named after the date and the git commit. Use --baseline to compare a run with a previous one, or
+--compare to compare two saved runs without running anything.
+
+usage (from the repository root):
+PYTHONPATH=. python benchmarks/run_benchmarks.py [-d DATASET ...] [-s SIZE ...] [-n N_THREADS] [--cpu_cost ROUNDS]
+    [--latency SECONDS] [--startup SECONDS] [--baseline RESULTS] [--compare RESULTS RESULTS] [--keep]
+
+e.g. PYTHONPATH=. python benchmarks/run_benchmarks.py -d test_class_I synthetic -s 10000 100000 1000000
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import traceback
+from configparser import ConfigParser
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from MhcVizPipe import parameters
+from MhcVizPipe import __version__
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+STUBS_DIR = REPO_DIR / 'benchmarks' / 'stubs'
+RESULTS_DIR = REPO_DIR / 'benchmarks' / 'results'
+AMINO_ACIDS = np.array(list('ARNDCQEGHILKMFPSTWYV'))
+
+# name: (files, alleles, MHC class)
+DATASETS = {
+    'test_class_I': ([REPO_DIR / 'test_data' / 'class_I' / 'mouse_liver.txt'], ['H-2-Kb', 'H-2-Db'], 'I'),
+    'test_class_II': ([REPO_DIR / 'test_data' / 'class_II' / 'MAVER-1_DQ.tsv'],
+                      ['HLA-DQA10101-DQB10501', 'HLA-DQA10103-DQB10603'], 'II'),
+    'figure_S14': (sorted((REPO_DIR / 'example_data' / 'Figure_S14').glob('*.txt')), ['H-2-Db'], 'I'),
+}
+SYNTHETIC_ALLELES = ['HLA-A02:01', 'HLA-B07:02', 'HLA-C07:02']
+# fraction of peptides of each length in a typical class I and class II immunopeptidome
+LENGTHS = {'I': {7: 0.01, 8: 0.1, 9: 0.55, 10: 0.18, 11: 0.1, 12: 0.04, 13: 0.01, 14: 0.01},
+           'II': {10: 0.02, 11: 0.03, 12: 0.07, 13: 0.12, 14: 0.16, 15: 0.18, 16: 0.15, 17: 0.11, 18: 0.07, 19: 0.04,
+                  20: 0.02, 21: 0.01, 22: 0.01, 23: 0.01}}
+MAX_LENGTH = {'I': 12, 'II': 22}
+MIN_LENGTH = {'I': 8, 'II': 9}
+
+
+def synthetic_cohort(n_peptides: int, mhc_class: str = 'I', n_samples: int = 4, seed: int = 0) -> Dict[str, List[str]]:
+    """
+    Generate random samples with a realistic length distribution which share some of their peptides. As in real data,
+    some peptides have flanking residues (e.g. K.AAGLTRDAK.L) or modifications (e.g. M[+15.99]) and a few have
+    uncommon amino acids, so they are removed by clean_peptides.
+    :param n_peptides: The total number of peptides in the cohort
+    :param mhc_class: The MHC class
+    :param n_samples: The number of samples
+    :param seed: The random seed
+    :return: Dictionary of {sample name: [peptides]}
+    """
+    rng = np.random.default_rng(seed)
+    pool_size = max(1, int(n_peptides * 0.6))
+    lengths = rng.choice(list(LENGTHS[mhc_class].keys()), pool_size, p=list(LENGTHS[mhc_class].values()))
+    residues = AMINO_ACIDS[rng.integers(0, 20, lengths.sum())]
+    ends = np.cumsum(lengths)
+    pool = np.array([''.join(residues[end - length:end]) for end, length in zip(ends, lengths)], dtype=object)
+    decoration = rng.random(pool_size)
+    flanks = AMINO_ACIDS[rng.integers(0, 20, (pool_size, 2))]
+    for i in np.flatnonzero(decoration < 0.05):
+        pool[i] = f'{flanks[i, 0]}.{pool[i]}.{flanks[i, 1]}'
+    for i in np.flatnonzero((decoration >= 0.05) & (decoration < 0.1)):
+        pool[i] = f'{pool[i][:2]}M[+15.99]{pool[i][2:]}'
+    for i in np.flatnonzero((decoration >= 0.1) & (decoration < 0.11)):
+        pool[i] = f'{pool[i][:-1]}X'
+    per_sample = max(1, n_peptides // n_samples)
+    return {f'sample_{i + 1}': list(rng.choice(pool, min(per_sample, pool_size), replace=False))
+            for i in range(n_samples)}
+
+
+def write_config(location: Path, n_threads: int, gibbs_sweep: str, pdf_figures: str) -> Path:
+    """
+    Write a settings file which uses the stub tools and keeps everything in the benchmark directory, and make
+    MhcVizPipe use it. The prediction cache and result reuse are turned off, so every stage does all its work.
+    """
+    config = ConfigParser()
+    config.read(parameters.default_config_file)
+    config['DIRECTORIES']['NetMHCpan path'] = str(STUBS_DIR / 'netMHCpan')
+    config['DIRECTORIES']['NetMHCIIpan path'] = str(STUBS_DIR / 'netMHCIIpan')
+    config['DIRECTORIES']['GibbsCluster path'] = str(STUBS_DIR / 'gibbscluster')
+    config['DIRECTORIES']['temp directory'] = str(location / 'tmp')
+    config['ANALYSIS']['max threads'] = str(n_threads)
+    config['ANALYSIS']['prediction cache'] = 'no'
+    config['ANALYSIS']['reuse results'] = 'no'
+    config['ANALYSIS']['pdf figures'] = pdf_figures
+    config['ANALYSIS']['gibbs sweep'] = gibbs_sweep
+    config['ANALYSIS']['profiling'] = 'off'
+    fname = location / 'benchmark.config'
+    with open(fname, 'w') as f:
+        config.write(f)
+    parameters.config_file = str(fname)
+    return fname
+
+
+def benchmark_dataset(name: str, files: List[Path], alleles: List[str], mhc_class: str, location: Path) -> dict:
+    """
+    Run the stages of an analysis on a dataset and time them.
+    :return: Dictionary with the dataset size, the stage timings and a summary of the tool jobs
+    """
+    # imported here so they use the benchmark settings
+    from MhcVizPipe.Tools.utils import load_peptide_file, clean_peptides, sanitize_sample_name
+    from MhcVizPipe.Tools.archives import write_archive
+    from MhcVizPipe.Tools.cl_tools import MhcToolHelper
+    from MhcVizPipe.Tools.instrumentation import StageProfiler, summarize_job_profiles
+    from MhcVizPipe.Reporting.report import mhc_report
+
+    analysis_location = location / 'analyses' / name
+    profiler = StageProfiler('stages')
+    result = {'mhc_class': mhc_class, 'n_samples': len(files), 'n_alleles': len(alleles), 'n_peptides': None,
+              'stages': [], 'tools': {}, 'error': None}
+    cl_tools = None
+    try:
+        with profiler.stage('load_peptide_file'):
+            raw_peptides = {sanitize_sample_name(f.name): load_peptide_file(f) for f in files}
+        result['n_peptides'] = sum(len(peptides) for peptides in raw_peptides.values())
+        with profiler.stage('clean_peptides'):
+            sample_peptides = {sample: clean_peptides(peptides) for sample, peptides in raw_peptides.items()}
+        sample_info = [{'sample-name': sample, 'sample-description': '', 'sample-alleles': ', '.join(alleles)}
+                       for sample in sample_peptides]
+        with profiler.stage('setup'):
+            cl_tools = MhcToolHelper(sample_info_datatable=sample_info,
+                                     sample_peptides=sample_peptides,
+                                     tmp_directory=str(analysis_location),
+                                     mhc_class=mhc_class,
+                                     min_length=MIN_LENGTH[mhc_class],
+                                     max_length=MAX_LENGTH[mhc_class])
+        with profiler.stage('predictions_and_gibbscluster'):
+            cl_tools.run_predictions_and_gibbscluster()
+        # the joining and writing of the predictions are part of the previous stage, but are run again here to time
+        # them without the tools
+        if cl_tools.prediction_index is None:
+            with profiler.stage('aggregate_predictions'):
+                cl_tools.binding_predictions = cl_tools._join_binding_predictions(cl_tools.samples)
+        with profiler.stage('write_binding_predictions'):
+            cl_tools.write_binding_predictions()
+        with profiler.stage('find_best_files'):
+            cl_tools.find_best_files()
+        with profiler.stage('report'):
+            analysis = mhc_report(cl_tools, mhc_class, cl_tools.Parameters.THREADS, profiler=profiler)
+            analysis.make_report()
+        with profiler.stage('package_report'):
+            write_archive(analysis_location, 'MVP_report_components.zip',
+                          analysis_location / 'MVP_report_components.zip')
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['stages'] = profiler.summary()
+    if cl_tools is not None:
+        result['tools'] = summarize_job_profiles(cl_tools.run_profiles())
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_result(name: str, result: dict):
+    print(f'\n{name}: {result["n_samples"]} samples, {result["n_peptides"]} peptides, '
+          f'{result["n_alleles"]} alleles (class {result["mhc_class"]})')
+    print(f'{"stage":<40}{"wall time (s)":>15}{"CPU time (s)":>15}')
+    for stage in result['stages']:
+        print(f'{stage["name"]:<40}{stage["wall_time"]:>15.3f}{stage["cpu_time"]:>15.3f}')
+    if result['error']:
+        print(f'FAILED:\n{result["error"]}')
+
+
+def compare(baseline: dict, results: dict):
+    """
+    Print the wall time of each stage in two benchmark runs.
+    """
+    print(f'\nComparison with {baseline["git_commit"]} ({baseline["started"]}) -> '
+          f'{results["git_commit"]} ({results["started"]})')
+    print(f'{"dataset":<20}{"stage":<40}{"before (s)":>12}{"after (s)":>12}{"change":>10}')
+    for name, result in results['datasets'].items():
+        if name not in baseline['datasets']:
+            continue
+        before = {stage['name']: stage['wall_time'] for stage in baseline['datasets'][name]['stages']}
+        for stage in result['stages']:
+            if stage['name'] not in before:
+                continue
+            change = f'{stage["wall_time"] / before[stage["name"]]:.2f}x' if before[stage['name']] > 0 else ''
+            print(f'{name:<20}{stage["name"]:<40}{before[stage["name"]]:>12.3f}{stage["wall_time"]:>12.3f}'
+                  f'{change:>10}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of an MhcVizPipe analysis.')
+    parser.add_argument('-d', '--datasets', type=str, nargs='+', default=list(DATASETS.keys()) + ['synthetic'],
+                        choices=list(DATASETS.keys()) + ['synthetic'])
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[10000, 100000],
+                        help='Total number of peptides in each synthetic cohort (e.g. 10000 100000 1000000).')
+    parser.add_argument('--synthetic_samples', type=int, default=4, help='Number of samples in synthetic cohorts.')
+    parser.add_argument('-n', '--n_threads', type=int, default=os.cpu_count())
+    parser.add_argument('--cpu_cost', type=float, default=0.0,
+                        help='CPU work the stub tools do for each peptide, in hash rounds for a 9-mer (times the number '
+                             'of alleles for NetMHCpan and NetMHCIIpan, and the number of groups for GibbsCluster).')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Time the stub tools take for each peptide (seconds, times the number of alleles for '
+                             'NetMHCpan and NetMHCIIpan).')
+    parser.add_argument('--startup', type=float, default=0.0, help='Time the stub tools take to start (seconds).')
+    parser.add_argument('--gibbs_sweep', type=str, default='full', choices=['full', 'adaptive', 'single'])
+    parser.add_argument('--pdf_figures', type=str, default='skip', choices=['now', 'defer', 'skip'],
+                        help='Whether to render the PDF figures (requires kaleido).')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help=f'Where to save the results. Defaults to {RESULTS_DIR}/<date>_<commit>.json.')
+    parser.add_argument('--baseline', type=str, default=None, help='Results of a previous run to compare with.')
+    parser.add_argument('--compare', type=str, nargs=2, default=None, metavar=('BEFORE', 'AFTER'),
+                        help='Compare two saved results and exit.')
+    parser.add_argument('--keep', action='store_true', help='Keep the analysis directories.')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0], 'r') as f:
+            before = json.load(f)
+        with open(args.compare[1], 'r') as f:
+            after = json.load(f)
+        compare(before, after)
+        return
+
+    location = Path(tempfile.mkdtemp(prefix='mvp_benchmark_'))
+    write_config(location, args.n_threads, args.gibbs_sweep, args.pdf_figures)
+    os.environ['MVP_STUB_CPU_COST'] = str(args.cpu_cost)
+    os.environ['MVP_STUB_LATENCY'] = str(args.latency)
+    os.environ['MVP_STUB_STARTUP'] = str(args.startup)
+
+    datasets = {name: DATASETS[name] for name in args.datasets if name in DATASETS}
+    if 'synthetic' in args.datasets:
+        for size in args.sizes:
+            name = f'synthetic_{size}'
+            directory = location / 'datasets' / name
+            directory.mkdir(parents=True)
+            files = []
+            for sample, peptides in synthetic_cohort(size, 'I', args.synthetic_samples).items():
+                files.append(directory / f'{sample}.txt')
+                with open(files[-1], 'w') as f:
+                    f.write('\n'.join(peptides) + '\n')
+            datasets[name] = (files, SYNTHETIC_ALLELES, 'I')
+
+    results = {'started': str(datetime.now()),
+               'mhcvizpipe_version': __version__,
+               'git_commit': git_commit(),
+               'python_version': platform.python_version(),
+               'platform': platform.platform(),
+               'cpus': os.cpu_count(),
+               'settings': {'n_threads': args.n_threads, 'cpu_cost': args.cpu_cost, 'latency': args.latency,
+                            'startup': args.startup,
+                            'gibbs_sweep': args.gibbs_sweep, 'pdf_figures': args.pdf_figures},
+               'datasets': {}}
+    try:
+        for name, (files, alleles, mhc_class) in datasets.items():
+            start = time.perf_counter()
+            results['datasets'][name] = benchmark_dataset(name, files, alleles, mhc_class, location)
+            results['datasets'][name]['total_time'] = time.perf_counter() - start
+            print_result(name, results['datasets'][name])
+    finally:
+        if args.keep:
+            print(f'\nThe analyses are in {location}')
+        else:
+            shutil.rmtree(location, ignore_errors=True)
+
+    output = Path(args.output) if args.output else \
+        RESULTS_DIR / f'{datetime.now().strftime("%Y-%m-%d_%H%M%S")}_{results["git_commit"]}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nResults saved to {output}')
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""
+Fake NetMHCpan 4.1, NetMHCIIpan 4.0 and GibbsCluster 2.0 for benchmarks and load tests, so the licensed DTU tools are
+not needed. They take the same command lines MhcVizPipe builds (netMHCpan -p -f FILE -a ALLELES -BA, netMHCIIpan
+-inptype 1 -f FILE -a ALLELES -BA and gibbscluster -f FILE -P PREFIX -g GROUPS -l LENGTH -k -T -j -C -D -I -G) and
+write their output in the same layout as the real tools: the prediction tables on stdout and, for GibbsCluster, a
+<PREFIX>_<pid> directory with images/gibbs.KLDvsClusters.tab, cores/gibbs.<i>of<n>.core, res/gibbs.<n>g.out and
+res/gibbs.<n>g.ds.out.
+
+The output is deterministic: scores are derived from a hash of the peptide and allele, and GibbsCluster groups the
+peptides by their anchor residues, so the same input always gives the same output. The cost of a run is set with
+environment variables:
+
+MVP_STUB_CPU_COST: CPU work per peptide (hash rounds for a 9-mer, scaled with the length; default 0). This is a fixed
+    amount of work rather than a time, so it is reproducible on a given machine.
+MVP_STUB_LATENCY: seconds to wait for each peptide (default 0)
+MVP_STUB_STARTUP: seconds to wait every time a tool is started (default 0)
+MVP_STUB_SEED: changes all the scores (default 0)
+
+The predictors multiply the per-peptide cost by the number of alleles, and GibbsCluster by the number of groups.
+"""
+import hashlib
+import math
+import os
+import sys
+import time
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import List
+
+AMINO_ACIDS = 'ARNDCQEGHILKMFPSTWYV'
+LINE_I = '-' * 119
+LINE_II = '-' * 140
+
+
+def _option(args: List[str], flag: str, default: str = None) -> str:
+    if flag not in args:
+        return default
+    i = args.index(flag)
+    if i + 1 >= len(args):
+        _fail(f'Missing value for {flag}')
+    return args[i + 1]
+
+
+def _fail(message: str):
+    print(f'ERROR: {message}', file=sys.stderr)
+    sys.exit(1)
+
+
+def _hash(*parts: str) -> float:
+    """
+    A number in [0, 1) which depends only on the parts (and MVP_STUB_SEED)
+    """
+    return zlib.crc32('|'.join((os.environ.get('MVP_STUB_SEED', '0'),) + parts).encode()) / 2 ** 32
+
+
+def _burn(peptides: List[str], repeats: int, reference_length: int):
+    """
+    Do a fixed amount of CPU work for each peptide, proportional to its length.
+    """
+    cost = float(os.environ.get('MVP_STUB_CPU_COST', 0))
+    if cost <= 0:
+        return
+    for peptide in peptides:
+        digest = peptide.encode()
+        for _ in range(int(cost * repeats * len(peptide) / reference_length)):
+            digest = hashlib.sha256(digest).digest()
+
+
+def _wait(n_peptides: int):
+    time.sleep(float(os.environ.get('MVP_STUB_STARTUP', 0)) +
+               n_peptides * float(os.environ.get('MVP_STUB_LATENCY', 0)))
+
+
+def _read_peptides(args: List[str]) -> List[str]:
+    fname = _option(args, '-f')
+    if fname is None:
+        _fail('No input file given (-f)')
+    if not Path(fname).is_file():
+        _fail(f'Cannot open file {fname}')
+    with open(fname, 'r') as f:
+        peptides = [line.strip() for line in f if line.strip()]
+    for peptide in peptides:
+        if any(aa not in AMINO_ACIDS for aa in peptide.upper()):
+            _fail(f'Wrong format of peptide {peptide}')
+    return peptides
+
+
+def _alleles(args: List[str]) -> List[str]:
+    alleles = _option(args, '-a')
+    if not alleles:
+        _fail('No alleles given (-a)')
+    return alleles.split(',')
+
+
+def _rank(peptide: str, allele: str) -> float:
+    # eluted ligands are mostly binders, so ranks are skewed towards 0 (about a third are below 2%)
+    return 100 * _hash(peptide, allele) ** 3.5
+
+
+def _class_i_core(peptide: str):
+    """
+    The 9-mer binding core of a peptide, with the deletion (Gp, Gl) or insertion (Ip, Il) used to make it
+    """
+    if len(peptide) > 9:
+        gl = len(peptide) - 9
+        return peptide[:3] + peptide[3 + gl:], 3, gl, 0, 0
+    if len(peptide) < 9:
+        il = 9 - len(peptide)
+        return peptide[:5] + '-' * il + peptide[5:], 0, 0, 5, il
+    return peptide, 0, 0, 0, 0
+
+
+def netmhcpan():
+    args = sys.argv[1:]
+    if '-p' not in args:
+        _fail('Only peptide input (-p) is supported')
+    peptides = _read_peptides(args)
+    alleles = _alleles(args)
+    _burn(peptides, len(alleles), 9)
+    _wait(len(peptides) * len(alleles))
+    out = sys.stdout
+    out.write('# NetMHCpan version 4.1b\n\n# Input is in PEPTIDE format\n\n')
+    out.write(f'# Make {"EL and BA" if "-BA" in args else "EL"} predictions\n\n')
+    for allele in alleles:
+        mhc = f'{allele[:5]}*{allele[5:]}' if allele.startswith('HLA-') and '*' not in allele else allele
+        out.write(f'{allele} : Distance to training data  0.000 (using nearest neighbor {allele})\n\n')
+        out.write('# Rank Threshold for Strong binding peptides   0.500\n')
+        out.write('# Rank Threshold for Weak binding peptides   2.000\n')
+        out.write(f'{LINE_I}\n')
+        out.write(' Pos         MHC        Peptide      Core Of Gp Gl Ip Il        Icore        Identity  Score_EL '
+                  '%Rank_EL Score_BA %Rank_BA  Aff(nM) BindLevel\n')
+        out.write(f'{LINE_I}\n')
+        n_strong = n_weak = 0
+        for i, peptide in enumerate(peptides):
+            rank = _rank(peptide, allele)
+            score = 1 - (rank / 100) ** 0.3
+            ba_rank = min(100.0, rank * 2)
+            ba_score = score * 0.8
+            affinity = 50000 ** (1 - ba_score)
+            core, gp, gl, ip, il = _class_i_core(peptide)
+            bind_level = ''
+            if rank <= 0.5:
+                bind_level = ' <= SB'
+                n_strong += 1
+            elif rank <= 2:
+                bind_level = ' <= WB'
+                n_weak += 1
+            out.write(f'{i + 1:>4} {mhc:>11} {peptide:>14} {core:>9} {0:>2} {gp:>2} {gl:>2} {ip:>2} {il:>2} '
+                      f'{peptide:>12} {"PEPLIST":>15} {score:.7f} {rank:8.3f} {ba_score:.6f} {ba_rank:8.3f} '
+                      f'{affinity:8.2f}{bind_level}\n')
+        out.write(f'{LINE_I}\n\n')
+        out.write(f'Protein PEPLIST. Allele {mhc}. Number of high binders {n_strong}. Number of weak binders '
+                  f'{n_weak}. Number of peptides {len(peptides)}\n\n')
+        out.write(f'{LINE_I}\n')
+
+
+def netmhciipan():
+    args = sys.argv[1:]
+    if _option(args, '-inptype') != '1':
+        _fail('Only peptide input (-inptype 1) is supported')
+    peptides = _read_peptides(args)
+    alleles = _alleles(args)
+    _burn(peptides, len(alleles), 15)
+    _wait(len(peptides) * len(alleles))
+    out = sys.stdout
+    out.write('# NetMHCIIpan version 4.0\n\n# Input is in PEPTIDE format\n\n')
+    out.write(f'# Prediction Mode: {"EL+BA" if "-BA" in args else "EL"}\n\n')
+    out.write('# Threshold for Strong binding peptides (%Rank)\t2%\n')
+    out.write('# Threshold for Weak binding peptides (%Rank)\t10%\n')
+    for allele in alleles:
+        out.write(f'\n# Allele: {allele}\n')
+        out.write(f'{LINE_II}\n')
+        out.write(' Pos           MHC              Peptide   Of        Core  Core_Rel        Identity      Score_EL '
+                  '%Rank_EL Exp_Bind      Score_BA  Affinity(nM) %Rank_BA  BindLevel\n')
+        out.write(f'{LINE_II}\n')
+        n_strong = n_weak = 0
+        for i, peptide in enumerate(peptides):
+            rank = _rank(peptide, allele)
+            score = 1 - (rank / 100) ** 0.3
+            ba_rank = min(100.0, rank * 2)
+            ba_score = score * 0.6
+            affinity = 50000 ** (1 - ba_score)
+            offset = int(_hash(peptide, allele, 'core') * max(1, len(peptide) - 8))
+            core = peptide[offset:offset + 9]
+            bind_level = ''
+            if rank <= 2:
+                bind_level = ' <=SB'
+                n_strong += 1
+            elif rank <= 10:
+                bind_level = ' <=WB'
+                n_weak += 1
+            out.write(f'{i + 1:>4} {allele:>13} {peptide:>20} {offset:>4} {core:>11} {0.4 + score * 0.6:9.3f} '
+                      f'{"Sequence":>15} {score:13.6f} {rank:8.2f} {"NA":>8} {ba_score:13.6f} {affinity:13.2f} '
+                      f'{ba_rank:8.2f}{bind_level}\n')
+        out.write(f'{LINE_II}\n')
+        out.write(f'Number of strong binders: {n_strong} Number of weak binders: {n_weak}\n')
+        out.write(f'{LINE_II}\n')
+
+
+def _cluster_kld(cores: List[str], n_total: int, prior_weight: float = 50) -> float:
+    """
+    The Kullback-Leibler distance of a cluster's amino acid frequencies from a flat background, with pseudo counts
+    (so small clusters score lower) and weighted by the size of the cluster.
+    """
+    if not cores:
+        return 0.0
+    kld = 0.0
+    for position in range(len(cores[0])):
+        counts = Counter(core[position] for core in cores)
+        for aa in AMINO_ACIDS:
+            frequency = (counts.get(aa, 0) + prior_weight * 0.05) / (len(cores) + prior_weight)
+            kld += frequency * math.log2(frequency / 0.05)
+    return kld * len(cores) / n_total * 10
+
+
+def gibbscluster():
+    args = sys.argv[1:]
+    peptides = _read_peptides(args)
+    groups = _option(args, '-g', '1-5').split('-')
+    groups = range(int(groups[0]), int(groups[-1]) + 1)
+    length = int(_option(args, '-l', '9'))
+    trash = '-T' in args
+    _burn(peptides, len(groups), 9)
+    _wait(len(peptides) * len(groups))
+
+    directory = Path(f'{_option(args, "-P", "gibbscluster")}_{os.getpid()}')
+    for sub_directory in ['images', 'cores', 'res', 'logos']:
+        (directory / sub_directory).mkdir(parents=True)
+    # the core is the first `length` residues with the C-terminus as the last position, so anchors line up
+    cores = [peptide[:length - 1] + peptide[-1] if len(peptide) >= length else None for peptide in peptides]
+    outliers = {i for i, peptide in enumerate(peptides)
+                if cores[i] is None or (trash and _hash(peptide, 'trash') < 0.02)}
+
+    klds = {}
+    for n in groups:
+        # group the peptides by their P2 and C-terminal anchors
+        assignment = [int(_hash(peptide[1:2], peptide[-1:], str(n)) * n) for peptide in peptides]
+        group_cores = [[cores[i] for i in range(len(peptides)) if assignment[i] == group and i not in outliers]
+                       for group in range(n)]
+        klds[n] = [_cluster_kld(c, len(peptides)) for c in group_cores]
+        for group in range(n):
+            with open(directory / 'cores' / f'gibbs.{group + 1}of{n}.core', 'w') as f:
+                f.writelines(core + '\n' for core in group_cores[group])
+        with open(directory / 'res' / f'gibbs.{n}g.out', 'w') as f:
+            f.write(f'# GibbsCluster 2.0 clustering of {len(peptides)} peptides in {n} groups\n')
+            f.write(f'# Motif length {length}\n')
+            for group in range(n):
+                f.write(f'# Cluster {group} size {len(group_cores[group])} KLD {klds[n][group]:.6f}\n')
+            f.write(f'# Trash cluster: removed {len(outliers)} outliers\n')
+        with open(directory / 'res' / f'gibbs.{n}g.ds.out', 'w') as f:
+            f.write('G\tGn\tNum\tSequence\tCore\to\tof\tip\tIP\til\tdp\tDP\tdl\tAnnotation\tsS\tSelf\tbgG\tbgS\tcS\n')
+            for i, peptide in enumerate(peptides):
+                if i in outliers:
+                    continue
+                score = _hash(peptide, str(n))
+                f.write(f'G {assignment[i]} {i + 1} {peptide} {cores[i]} 0 0 0 0 0 0 0 0 Sequence '
+                        f'{score * 4:.3f} {score * 3:.3f} 0 0.000 {score * 4:.3f}\n')
+    with open(directory / 'images' / 'gibbs.KLDvsClusters.tab', 'w') as f:
+        f.write('# Nclust\tKLD per cluster\n')
+        for n in groups:
+            f.write(f'{n}\t' + '\t'.join(f'{kld:.6f}' for kld in klds[n]) + '\n')
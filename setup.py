@@ -26,6 +26,10 @@ setup(
         'johnnydep',
         'structlog'
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'parquet': ['pyarrow']
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
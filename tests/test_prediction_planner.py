@@ -0,0 +1,67 @@
+import pytest
+from MhcVizPipe.Tools import prediction_planner
+from MhcVizPipe.Tools.prediction_planner import PredictionPlanner
+from MhcVizPipe.Tools.prediction_table import PredictionTable
+
+
+class FakeNetMHCpanHelper:
+    """
+    Stands in for NetMHCpanHelper. Predicts every peptide as a non-binder, and fails on the runs listed in fail_runs.
+    """
+    runs = 0
+    fail_runs = set()
+
+    def __init__(self, peptides, alleles, **kwargs):
+        self.peptides = peptides
+        self.alleles = alleles
+        self.job_profiles = [{'alleles': alleles}]
+
+    def predict_table(self) -> PredictionTable:
+        FakeNetMHCpanHelper.runs += 1
+        if FakeNetMHCpanHelper.runs in FakeNetMHCpanHelper.fail_runs:
+            raise RuntimeError('NetMHCpan failed')
+        return PredictionTable.from_records(
+            (peptide, allele, {'el_score': 0.1, 'el_rank': 50.0, 'aff_score': 0.1, 'aff_rank': 50.0,
+                               'aff_nM': 30000.0, 'binder': 'Non-binder'})
+            for allele in self.alleles for peptide in self.peptides
+        )
+
+
+@pytest.fixture
+def planner(monkeypatch, tmp_path):
+    monkeypatch.setattr(prediction_planner, 'NetMHCpanHelper', FakeNetMHCpanHelper)
+    FakeNetMHCpanHelper.runs = 0
+    FakeNetMHCpanHelper.fail_runs = set()
+    return PredictionPlanner(mhc_class='I', n_threads=1, tmp_dir=str(tmp_path))
+
+
+# the alleles have no peptides in common, so they are predicted in separate runs, A1 first
+PEPTIDES_1 = ['AAAAAAAAA', 'AAAAAAAAC', 'AAAAAAAAD']
+PEPTIDES_2 = ['CCCCCCCCC', 'CCCCCCCCD']
+
+
+def test_shared_pairs_are_predicted_once(planner):
+    planner.add({'s1': ['A1']}, {'s1': PEPTIDES_1})
+    planner.add({'s2': ['A1'], 's3': ['A2']}, {'s2': PEPTIDES_1, 's3': PEPTIDES_2})
+    assert planner.requested_pairs == 8
+    assert planner.unique_pairs == 5
+    planner.predict()
+    assert len(planner.predictions(['A1'], PEPTIDES_1)) == 3
+    assert len(planner.predictions(['A2'], PEPTIDES_2)) == 2
+    assert FakeNetMHCpanHelper.runs == 2
+    assert len(planner.take_job_profiles()) == 2
+    assert planner.take_job_profiles() == []
+
+
+def test_failed_run_leaves_its_pairs_pending(planner):
+    planner.add({'s1': ['A1']}, {'s1': PEPTIDES_1})
+    planner.add({'s2': ['A2']}, {'s2': PEPTIDES_2})
+    FakeNetMHCpanHelper.fail_runs = {2}
+    with pytest.raises(RuntimeError):
+        planner.predict()
+    assert set(planner.pending) == {'A2'}
+    # the predictions of the run which finished are kept, the pairs of the failed run are still pending
+    assert len(planner.predictions(['A1'], PEPTIDES_1)) == 3
+    assert len(planner.predictions(['A2'], PEPTIDES_2)) == 2
+    assert FakeNetMHCpanHelper.runs == 3
+    assert planner.pending == {}